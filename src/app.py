@@ -1,16 +1,32 @@
+import argparse
+import concurrent.futures
+import contextlib
 import ctypes
 import dataclasses
+import datetime
+import glob
 import io
 import os
-import struct
+import shutil
 import sys
+import tempfile
+import time
 import typing
 
-import zlib
-
+from bundle import iter_inflated, iter_messages
+from checkpoint import CheckpointReader, CheckpointWriter, LogIdentity, checkpoint_path
+from logfile import LogReader, DIRECTION_FROM_SERVER, DIRECTION_FROM_CLIENT, RECORD_HEADER, timestamp_to_ms
+from manager.actor_history import ActorHistory
 from manager.actor_manager import ActorManager
+from manager.actor_store import ActorColumnStore
 from manager.chat_manager import ChatManager
+from manager.decoders import hot_server_decoders
+from manager.dispatcher import IpcDispatcher
 from manager.effect_manager import EffectManager
+from manager.event_text import TextSink
+from manager.events import EventBus, EventSink, JsonLinesSink, LengthPrefixedSink
+from manager.metrics import DispatchMetrics, OpcodeStats
+from manager.resource_cache import CachingResourceReader, DEFAULT_CACHE_SIZE
 from pyxivdata.common import GameLanguage
 from pyxivdata.installation.resource_reader import GameResourceReader
 from pyxivdata.network.client_ipc.opcodes import ClientIpcOpcodes
@@ -19,76 +35,295 @@ from pyxivdata.network.server_ipc import ServerIpcOpcodes, IpcDirectorUpdate, Ip
 
 
 class Parser:
-    def __init__(self, reader: GameResourceReader):
-        server_opcodes = ServerIpcOpcodes()
-        client_opcodes = ClientIpcOpcodes()
-        self.actor_manager = ActorManager(reader, server_opcodes, client_opcodes)
+    def __init__(self, reader: GameResourceReader, fast_decode: bool = False, columnar_actors: bool = False,
+                 resource_cache_size: typing.Optional[int] = DEFAULT_CACHE_SIZE,
+                 history_capacity: typing.Optional[int] = None):
+        if resource_cache_size is not None:
+            reader = CachingResourceReader(reader, resource_cache_size)
+        self.resource_reader = reader
+        self._server_opcodes = server_opcodes = ServerIpcOpcodes()
+        self._client_opcodes = client_opcodes = ClientIpcOpcodes()
+        self.metrics: typing.Optional[DispatchMetrics] = None
+        self.events = EventBus()
+        self.actor_manager = ActorManager(
+            reader, server_opcodes, client_opcodes,
+            actor_store=ActorColumnStore() if columnar_actors else None,
+            history=None if history_capacity is None else ActorHistory(history_capacity))
         self.chat_manager = ChatManager(reader, server_opcodes, client_opcodes, self.actor_manager)
         self.effect_manager = EffectManager(reader, server_opcodes, client_opcodes, self.actor_manager)
+        self.dispatcher = IpcDispatcher(self.actor_manager, self.chat_manager, self.effect_manager,
+                                        decoders=hot_server_decoders() if fast_decode else None)
+        for target in (self.actor_manager, self.chat_manager, self.effect_manager):
+            target.set_event_bus(self.events)
 
-    def feed_from_server(self, packet_header: PacketHeader, message_data: bytearray):
-        self.actor_manager.feed_from_server(packet_header, message_data)
-        self.chat_manager.feed_from_server(packet_header, message_data)
-        self.effect_manager.feed_from_server(packet_header, message_data)
+    def enable_metrics(self, dump_interval: typing.Optional[float] = None,
+                       dump_to: typing.Optional[typing.TextIO] = None) -> DispatchMetrics:
+        self.metrics = DispatchMetrics(self._server_opcodes, self._client_opcodes, dump_interval, dump_to)
+        self.dispatcher.set_metrics(self.metrics)
+        return self.metrics
 
-    def feed_from_client(self, packet_header: PacketHeader, message_data: bytearray):
-        self.actor_manager.feed_from_client(packet_header, message_data)
-        self.chat_manager.feed_from_client(packet_header, message_data)
-        self.effect_manager.feed_from_client(packet_header, message_data)
+    def disable_metrics(self):
+        self.metrics = None
+        self.dispatcher.set_metrics(None)
 
+    def metrics_snapshot(self, direction: typing.Optional[str] = None) -> typing.List[OpcodeStats]:
+        return [] if self.metrics is None else self.metrics.snapshot(direction)
+
+    def export_state(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "actor_manager": self.actor_manager.export_state(),
+            "chat_manager": self.chat_manager.export_state(),
+            "effect_manager": self.effect_manager.export_state(),
+        }
+
+    def import_state(self, state: typing.Dict[str, typing.Any]):
+        # Actors first; the others refer to them.
+        self.actor_manager.import_state(state["actor_manager"])
+        self.chat_manager.import_state(state["chat_manager"])
+        self.effect_manager.import_state(state["effect_manager"])
+
+    def feed_from_server(self, packet_header: PacketHeader, message_data: typing.Union[bytearray, memoryview]):
+        self.dispatcher.feed_from_server(packet_header, message_data)
+
+    def feed_from_client(self, packet_header: PacketHeader, message_data: typing.Union[bytearray, memoryview]):
+        self.dispatcher.feed_from_client(packet_header, message_data)
+
+
+def dispatch_bundle(parser: Parser, direction: bytes, packet_header: PacketHeader, message_buffer: memoryview):
+    for message_header, message_data in iter_messages(message_buffer):
+        if message_header.type == MessageHeader.TYPE_IPC:
+            ipc_header = IpcMessageHeader.from_buffer(message_data)
+            ipc_data = message_data[ctypes.sizeof(ipc_header):]
+            if direction == DIRECTION_FROM_SERVER:
+                parser.feed_from_server(packet_header, message_data)
+
+                if ipc_header.type2 == ServerIpcOpcodes.PlaceWaymark:
+                    r = IpcPlaceWaymark.from_buffer(ipc_data)
+                    # breakpoint()
+                elif ipc_header.type2 == ServerIpcOpcodes.PlacePresetWaymark:
+                    r = IpcPlacePresetWaymark.from_buffer(ipc_data)
+                elif ipc_header.type2 == ServerIpcOpcodes.DirectorUpdate:
+                    r = IpcDirectorUpdate.from_buffer(ipc_data)
+                    parser.events.flush()
+                    print("DirectorUpdate", r.sequence, r.branch, bytes(r.data).hex(" "))
+
+            elif direction == DIRECTION_FROM_CLIENT:
+                parser.feed_from_client(packet_header, message_data)
 
-def __main__():
-    os.system("chcp 65001")
-    sys.stdout.reconfigure(encoding="utf-8")
-    # path = r"D:\OneDrive\Misc\xivcapture\Network_22106_20211025\204.2.229.113.55027.log"
-    path = r"D:\OneDrive\Misc\xivcapture\Network_22106_20211026\204.2.229.113.55027.log"
-    # path = r"D:\OneDrive\Misc\xivcapture\Network_22106_20211026\124.150.157.26.55007.log"
 
-    known_server_opcodes = [x.default for x in dataclasses.fields(ServerIpcOpcodes)]
+EVENTS_TEXT = "text"
+EVENTS_JSON_LINES = "jsonl"
+EVENTS_BINARY = "binary"
+EVENTS_NONE = "none"
+EVENT_FORMATS = (EVENTS_TEXT, EVENTS_JSON_LINES, EVENTS_BINARY, EVENTS_NONE)
+
+
+def open_event_sink(parser: Parser, path: str, events_format: str,
+                    stack: contextlib.ExitStack) -> typing.Optional[EventSink]:
+    # Text goes to stdout as it always did; the others go to a file next to the log, like checkpoints do.
+    if events_format == EVENTS_TEXT:
+        return TextSink(sys.stdout, parser.resource_reader, parser.actor_manager)
+    elif events_format == EVENTS_JSON_LINES:
+        return JsonLinesSink(stack.enter_context(open(path + ".events.jsonl", "w", encoding="utf-8")))
+    elif events_format == EVENTS_BINARY:
+        return LengthPrefixedSink(stack.enter_context(open(path + ".events.bin", "wb")))
+    elif events_format == EVENTS_NONE:
+        return None
+    raise ValueError(f"unknown event format {events_format}")
+
+
+@dataclasses.dataclass
+class LogResult:
+    path: str
+    size: int  # of the records read, which is less than the whole log with --from or --until
+    bundles: int
+    seconds: float
+    output_path: typing.Optional[str] = None
+    error: typing.Optional[str] = None
+
+    def describe(self) -> str:
+        if self.error is not None:
+            return f"{self.path}: failed after {self.seconds:,.2f}s: {self.error}"
+        seconds = max(self.seconds, 1e-9)
+        return (f"{self.path}: {self.bundles:,} bundles, {self.size / 1048576:,.1f} MB in {self.seconds:,.2f}s "
+                f"({self.bundles / seconds:,.0f} bundles/s, {self.size / 1048576 / seconds:,.2f} MB/s)")
+
+
+def process_log(path: str,
+                start: typing.Optional[datetime.datetime] = None, end: typing.Optional[datetime.datetime] = None,
+                inflate_workers: typing.Optional[int] = None, inflate_queue_depth: int = 64,
+                metrics: bool = False, metrics_interval: typing.Optional[float] = None,
+                fast_decode: bool = False,
+                checkpoint_interval: typing.Optional[float] = None, restore: bool = False,
+                events_format: str = EVENTS_TEXT) -> LogResult:
+    started = time.perf_counter()
+    bundle_count = 0
+    bytes_read = 0
 
     fp: typing.Union[io.BytesIO]
-    with open(path, "rb") as fp, GameResourceReader(default_language=[GameLanguage.English]) as res:
-        parser = Parser(res)
-        while True:
-            hdr = fp.read(5)
-            if not hdr:
-                break
-            direction, length = struct.unpack("<cI", hdr)
-            data = bytearray(length)
-            fp.readinto(data)
-
-            packet_header = PacketHeader.from_buffer(data)
-            message_buffer = data[ctypes.sizeof(packet_header):]
-            if packet_header.is_deflated:
-                try:
-                    message_buffer = bytearray(zlib.decompress(message_buffer))
-                except zlib.error as e:
-                    print(f"zlib error: {e}")
+    with open(path, "rb") as fp, LogReader(fp) as log, \
+            GameResourceReader(default_language=[GameLanguage.English]) as res, \
+            contextlib.ExitStack() as stack:
+        parser = Parser(res, fast_decode)
+        if metrics:
+            parser.enable_metrics(metrics_interval, sys.stderr)
+        sink = open_event_sink(parser, path, events_format, stack)
+        if sink is not None:
+            parser.events.add_sink(sink)
+            stack.callback(parser.events.close)  # before the file it writes to is closed
+        records = log if start is None and end is None else log.iter_range(start, end)
+
+        # Until start, bundles after the checkpoint only bring the state up to date, and publish or print nothing.
+        catch_up_until_ms = None
+        if restore and start is not None and os.path.exists(checkpoint_path(path)):
+            checkpoint = CheckpointReader(stack.enter_context(open(checkpoint_path(path), "rb")), fp).nearest(
+                timestamp_to_ms(start))
+            if checkpoint is not None:
+                parser.import_state(checkpoint.state)
+                records = log.iter_range(None, end, checkpoint.resume_offset)
+                catch_up_until_ms = timestamp_to_ms(start)
+                quiet = stack.enter_context(open(os.devnull, "w"))
+
+        checkpoints = None
+        if checkpoint_interval is not None and start is None:
+            checkpoints = CheckpointWriter(stack.enter_context(open(checkpoint_path(path), "wb")), checkpoint_interval,
+                                           LogIdentity.of(fp))
+
+        for bundle in iter_inflated(records, inflate_workers, inflate_queue_depth):
+            direction, packet_header, message_buffer = bundle.direction, bundle.packet_header, bundle.message_buffer
+            bytes_read += RECORD_HEADER.size + len(bundle.data)
+            if packet_header is None:
+                parser.events.flush()
+                print(f"skipped {len(bundle.data)} bytes")
+                continue
+
+            if bundle.error is not None:
+                parser.events.flush()
+                print(f"zlib error: {bundle.error}")
+                continue
+
+            bundle_count += 1
+            if catch_up_until_ms is not None:
+                if timestamp_to_ms(packet_header.timestamp) < catch_up_until_ms:
+                    with contextlib.redirect_stdout(quiet), parser.events.paused():
+                        dispatch_bundle(parser, direction, packet_header, message_buffer)
                     continue
-            msgptr = 0
-            while msgptr < len(message_buffer):
-                message_header = MessageHeader.from_buffer(message_buffer, msgptr)
-                if message_header.type == MessageHeader.TYPE_IPC:
-                    ipc_header = IpcMessageHeader.from_buffer(message_buffer, msgptr)
-                    ipc_data = message_buffer[msgptr + ctypes.sizeof(ipc_header):msgptr + ipc_header.size]
-                    if direction == b'<':
-                        parser.feed_from_server(packet_header, message_buffer[msgptr:msgptr + message_header.size])
-
-                        if ipc_header.type2 == ServerIpcOpcodes.PlaceWaymark:
-                            r = IpcPlaceWaymark.from_buffer(ipc_data)
-                            # breakpoint()
-                        elif ipc_header.type2 == ServerIpcOpcodes.PlacePresetWaymark:
-                            r = IpcPlacePresetWaymark.from_buffer(ipc_data)
-                        elif ipc_header.type2 == ServerIpcOpcodes.DirectorUpdate:
-                            r = IpcDirectorUpdate.from_buffer(ipc_data)
-                            print("DirectorUpdate", r.sequence, r.branch, bytes(r.data).hex(" "))
-
-                    elif direction == b'>':
-                        parser.feed_from_client(packet_header, message_buffer[msgptr:msgptr + message_header.size])
-
-                msgptr += message_header.size
-
-    return 0
+                catch_up_until_ms = None
+
+            dispatch_bundle(parser, direction, packet_header, message_buffer)
+
+            if checkpoints is not None and bundle.offset is not None:
+                timestamp_ms = timestamp_to_ms(packet_header.timestamp)
+                if checkpoints.due(timestamp_ms):
+                    checkpoints.write(timestamp_ms, bundle.offset + RECORD_HEADER.size + len(bundle.data),
+                                      parser.export_state())
+
+        if parser.metrics is not None:
+            print(f"{path}: dispatch metrics", file=sys.stderr)
+            parser.metrics.dump(sys.stderr)
+            print(f"{path}: pending effects: {parser.effect_manager.pending_effect_stats}", file=sys.stderr)
+            if isinstance(parser.resource_reader, CachingResourceReader):
+                print(f"{path}: resource lookups", file=sys.stderr)
+                parser.resource_reader.dump(sys.stderr)
+
+    return LogResult(path, bytes_read, bundle_count, time.perf_counter() - started)
+
+
+def _process_log_or_fail(path: str, *args) -> LogResult:
+    # A log that fails is reported as such, instead of taking down the results of every other log with it.
+    started = time.perf_counter()
+    try:
+        return process_log(path, *args)
+    except Exception as e:
+        return LogResult(path, 0, 0, time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+
+
+def _process_log_to_file(path: str, *args) -> LogResult:
+    # Runs in a pool worker; whatever the parser prints is kept aside, so that the parent can emit it in input order.
+    fd, output_path = tempfile.mkstemp(prefix="parse-", suffix=".txt")
+    with open(fd, "w", encoding="utf-8") as output, contextlib.redirect_stdout(output):
+        result = _process_log_or_fail(path, *args)
+    if result.error is not None:
+        os.unlink(output_path)
+        return result
+    result.output_path = output_path
+    return result
+
+
+def collect_log_paths(inputs: typing.Iterable[str]) -> typing.List[str]:
+    paths = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            paths.extend(sorted(glob.glob(os.path.join(entry, "**", "*.log"), recursive=True)))
+        elif glob.has_magic(entry):
+            paths.extend(sorted(glob.glob(entry, recursive=True)))
+        else:
+            paths.append(entry)
+    return list(dict.fromkeys(paths))
+
+
+def __main__():
+    if os.name == "nt":
+        os.system("chcp 65001")
+    sys.stdout.reconfigure(encoding="utf-8")
+
+    parser = argparse.ArgumentParser(description="Parses per-connection logs written by conv.py.")
+    parser.add_argument("inputs", nargs="+", help="log files, glob patterns, or directories to search for *.log")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="parse this many logs at once on worker processes; 0 to use every core (default: 1)")
+    parser.add_argument("--from", dest="start", type=datetime.datetime.fromisoformat,
+                        help="skip bundles older than this ISO 8601 timestamp")
+    parser.add_argument("--until", dest="end", type=datetime.datetime.fromisoformat,
+                        help="stop at the first bundle at or after this ISO 8601 timestamp")
+    parser.add_argument("--inflate-workers", type=int, default=None,
+                        help="threads inflating bundles ahead of the parser; 0 to inflate inline")
+    parser.add_argument("--inflate-queue-depth", type=int, default=64,
+                        help="how many bundles may be read ahead of the parser (default: 64)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="print per opcode message counts and handler times to stderr after each log")
+    parser.add_argument("--metrics-interval", type=float, default=None,
+                        help="with --metrics, also print them every this many seconds while parsing")
+    parser.add_argument("--fast-decode", action="store_true",
+                        help="decode the busiest message types with precompiled struct unpackers instead of ctypes")
+    parser.add_argument("--checkpoint-interval", type=float, default=None,
+                        help="when parsing a log from its start, save the parser state to LOG.ckpt every this many "
+                             "seconds of bundle time")
+    parser.add_argument("--restore", action="store_true",
+                        help="with --from, start off the last state in LOG.ckpt saved before then, instead of none")
+    parser.add_argument("--events", dest="events_format", choices=EVENT_FORMATS, default=EVENTS_TEXT,
+                        help="print events as text (default), write them to LOG.events.jsonl or as length prefixed "
+                             "records to LOG.events.bin, or skip building them at all")
+    args = parser.parse_args()
+
+    paths = collect_log_paths(args.inputs)
+    if not paths:
+        parser.error("no log files found")
+    options = (args.start, args.end, args.inflate_workers, args.inflate_queue_depth,
+               args.metrics, args.metrics_interval, args.fast_decode, args.checkpoint_interval, args.restore,
+               args.events_format)
+
+    started = time.perf_counter()
+    results: typing.List[LogResult] = []
+    if args.jobs == 1:
+        for path in paths:
+            results.append(_process_log_or_fail(path, *options))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+            for result in executor.map(_process_log_to_file, paths, *([x] * len(paths) for x in options)):
+                if result.output_path is not None:
+                    with open(result.output_path, "r", encoding="utf-8") as fp:
+                        shutil.copyfileobj(fp, sys.stdout)
+                    os.unlink(result.output_path)
+                results.append(result)
+    elapsed = time.perf_counter() - started
+
+    for result in results:
+        print(result.describe(), file=sys.stderr)
+    failed = sum(1 for x in results if x.error is not None)
+    total = LogResult(f"total ({len(results)} logs" + (f", {failed} failed)" if failed else ")"),
+                      sum(x.size for x in results), sum(x.bundles for x in results), elapsed)
+    print(total.describe(), file=sys.stderr)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
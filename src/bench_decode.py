@@ -0,0 +1,164 @@
+import argparse
+import ctypes
+import math
+import os
+import sys
+import time
+import typing
+
+from bundle import iter_inflated, iter_messages
+from logfile import LogReader, DIRECTION_FROM_SERVER
+from manager.decoders import ArrayView, HOT_SERVER_OPCODE_FIELDS, server_decoders
+from pyxivdata.network.packet import MessageHeader, IpcMessageHeader
+from pyxivdata.network.server_ipc import IpcActorControlStub, actor_control
+from pyxivdata.network.server_ipc.actor_control import ActorControlBase
+from pyxivdata.network.server_ipc.opcodes import ServerIpcOpcodes
+
+EFFECT_OPCODE_FIELDS = ("Effect01", "Effect08", "Effect16", "Effect24", "Effect32")
+
+
+def _field_names(cls: typing.Type[ctypes.Structure]) -> typing.List[str]:
+    return [name for base in reversed(cls.__mro__) for name, *_ in base.__dict__.get("_fields_", ())]
+
+
+def _property_names(cls: type) -> typing.List[str]:
+    return sorted({k for base in cls.__mro__ for k, v in vars(base).items() if isinstance(v, property)})
+
+
+def _actor_control_types() -> typing.List[typing.Type[ActorControlBase]]:
+    return [t for t in vars(actor_control).values()
+            if isinstance(t, type) and issubclass(t, ActorControlBase) and t is not ActorControlBase]
+
+
+def _plain(value: typing.Any, depth: int = 0) -> typing.Any:
+    # Something comparable out of either a ctypes value or its fast counterpart, properties included; actor control
+    # wrappers around either one are compared by their properties.
+    if depth > 8:
+        return repr(value)
+    ctypes_type = getattr(type(value), "_ctypes_type_", None)
+    if ctypes_type is not None or isinstance(value, (ctypes.Structure, ActorControlBase)):
+        cls = ctypes_type or type(value)
+        result = {} if isinstance(value, ActorControlBase) else {
+            k: _plain(getattr(value, k), depth + 1) for k in _field_names(cls)}
+        for k in _property_names(cls):
+            try:
+                result[k] = _plain(getattr(value, k), depth + 1)
+            except Exception as e:
+                result[k] = f"raised {type(e).__name__}"
+        return result
+    if isinstance(value, (ctypes.Array, ArrayView, tuple, list)):
+        return [_plain(x, depth + 1) for x in value]
+    if isinstance(value, dict):
+        return {k: _plain(v, depth + 1) for k, v in value.items()}
+    if isinstance(value, float) and math.isnan(value):
+        return "nan"
+    return value
+
+
+def _wrap(actor_control_type: typing.Type[ActorControlBase], ipc: typing.Any) -> typing.Any:
+    try:
+        return _plain(actor_control_type(ipc))
+    except Exception as e:
+        return f"raised {type(e).__name__}"
+
+
+def count_mismatches(t: type, fast_type: type, buffers: typing.List[bytearray]) -> int:
+    """Compares every field and property of what both decode out of each buffer, and for ActorControl* messages, of
+    every actor control wrapper around them, as the dispatcher hands fast decoded ones to the same wrappers."""
+    wrappers = _actor_control_types() if issubclass(t, IpcActorControlStub) else []
+    mismatches = 0
+    for b in buffers:
+        slow, fast = t.from_buffer(b), fast_type.from_buffer(b)
+        mismatches += _plain(slow) != _plain(fast)
+        mismatches += sum(_wrap(x, slow) != _wrap(x, fast) for x in wrappers)
+    return mismatches
+
+
+def collect_samples(paths: typing.Sequence[str], types_by_opcode: typing.Dict[int, type],
+                    limit: int) -> typing.Dict[type, typing.List[bytearray]]:
+    samples = {t: [] for t in types_by_opcode.values()}
+    for path in paths:
+        with open(path, "rb") as fp, LogReader(fp) as log:
+            for bundle in iter_inflated(log, 0):
+                if bundle.direction != DIRECTION_FROM_SERVER or bundle.message_buffer is None:
+                    continue
+                for message_header, message_data in iter_messages(bundle.message_buffer):
+                    if message_header.type != MessageHeader.TYPE_IPC:
+                        continue
+                    header = IpcMessageHeader.from_buffer(message_data)
+                    t = types_by_opcode.get(header.type2)
+                    if t is not None and len(samples[t]) < limit:
+                        samples[t].append(bytearray(message_data[ctypes.sizeof(header):header.size]))
+    return samples
+
+
+def _time(fn: typing.Callable[[], None], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _decode_only(t: type, buffers: typing.List[bytearray]) -> typing.Callable[[], None]:
+    def run():
+        from_buffer = t.from_buffer
+        for b in buffers:
+            from_buffer(b)
+    return run
+
+
+def _decode_and_read(t: type, buffers: typing.List[bytearray], names: typing.List[str]) -> typing.Callable[[], None]:
+    def run():
+        from_buffer = t.from_buffer
+        for b in buffers:
+            o = from_buffer(b)
+            for name in names:
+                getattr(o, name)
+    return run
+
+
+def __main__():
+    parser = argparse.ArgumentParser(
+        description="Compares ctypes from_buffer against the precompiled struct decoders for the busiest messages.")
+    parser.add_argument("logs", nargs="*", help="logs to take message samples from; random bytes if none are given")
+    parser.add_argument("-n", "--samples", type=int, default=20000, help="messages per type (default: 20000)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per measurement; the best one counts")
+    parser.add_argument("--opcodes", nargs="+", default=HOT_SERVER_OPCODE_FIELDS + EFFECT_OPCODE_FIELDS,
+                        help="server opcode names whose structures to compare (default: the hot ones, and Effect*)")
+    args = parser.parse_args()
+
+    opcodes = ServerIpcOpcodes()
+    decoders = server_decoders(tuple(args.opcodes))
+    types_by_opcode = {getattr(opcodes, t.OPCODE_FIELD): t for t in decoders}
+    if args.logs:
+        samples = collect_samples(args.logs, types_by_opcode, args.samples)
+    else:
+        samples = {t: [bytearray(os.urandom(ctypes.sizeof(t))) for _ in range(args.samples)] for t in decoders}
+
+    print(f"{'type':<28}{'samples':>9}{'ctypes ns':>11}{'struct ns':>11}{'speedup':>9}"
+          f"{'+fields ctypes':>16}{'+fields struct':>16}{'speedup':>9}  verified")
+    failed = False
+    for t, fast_type in decoders.items():
+        buffers = samples[t]
+        if not buffers:
+            continue
+        mismatches = count_mismatches(t, fast_type, buffers[:256])
+        failed = failed or mismatches != 0
+
+        names = _field_names(t)
+        results = []
+        for make in (lambda x: _decode_only(x, buffers), lambda x: _decode_and_read(x, buffers, names)):
+            slow = _time(make(t), args.repeat) / len(buffers) * 1e9
+            fast = _time(make(fast_type), args.repeat) / len(buffers) * 1e9
+            results.append((slow, fast))
+        (decode_slow, decode_fast), (read_slow, read_fast) = results
+        print(f"{t.__name__:<28}{len(buffers):>9,}{decode_slow:>11,.0f}{decode_fast:>11,.0f}"
+              f"{decode_slow / decode_fast:>8.2f}x{read_slow:>16,.0f}{read_fast:>16,.0f}{read_slow / read_fast:>8.2f}x"
+              f"  {'yes' if not mismatches else f'{mismatches} mismatches'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(__main__())
@@ -0,0 +1,101 @@
+import collections
+import concurrent.futures
+import ctypes
+import dataclasses
+import typing
+
+import zlib
+
+from pyxivdata.network.packet import PacketHeader, MessageHeader
+
+BUNDLE_HEADER_SIZE = ctypes.sizeof(PacketHeader)
+MESSAGE_HEADER_SIZE = ctypes.sizeof(MessageHeader)
+
+BufferType = typing.Union[bytearray, memoryview]
+
+
+def read_bundle_header(data: BufferType) -> typing.Optional[PacketHeader]:
+    if len(data) < BUNDLE_HEADER_SIZE or bytes(data[:len(PacketHeader.SIGNATURE_1)]) not in (
+            PacketHeader.SIGNATURE_1, PacketHeader.SIGNATURE_2):
+        return None
+    return PacketHeader.from_buffer(data)
+
+
+def inflate_bundle(packet_header: PacketHeader, data: BufferType) -> memoryview:
+    # Raises zlib.error if a deflated bundle does not inflate.
+    message_buffer = memoryview(data)[BUNDLE_HEADER_SIZE:]
+    if packet_header.is_deflated:
+        message_buffer = memoryview(bytearray(zlib.decompress(message_buffer)))
+    return message_buffer
+
+
+def iter_messages(message_buffer: memoryview) -> typing.Iterator[typing.Tuple[MessageHeader, memoryview]]:
+    msgptr = 0
+    while msgptr + MESSAGE_HEADER_SIZE <= len(message_buffer):
+        message_header = MessageHeader.from_buffer(message_buffer, msgptr)
+        if message_header.size == 0:
+            return
+        yield message_header, message_buffer[msgptr:msgptr + message_header.size]
+        msgptr += message_header.size
+
+
+@dataclasses.dataclass
+class InflatedBundle:
+    direction: bytes
+    data: BufferType
+    packet_header: typing.Optional[PacketHeader]  # None if data is not a bundle
+    message_buffer: typing.Optional[memoryview] = None
+    error: typing.Optional[zlib.error] = None
+    offset: typing.Optional[int] = None  # of the record in its log, when read out of one
+
+
+def _inflate(packet_header: PacketHeader, data: BufferType) -> typing.Tuple[typing.Optional[memoryview],
+                                                                           typing.Optional[zlib.error]]:
+    try:
+        return inflate_bundle(packet_header, data), None
+    except zlib.error as e:
+        return None, e
+
+
+def iter_inflated(records: typing.Iterable, max_workers: typing.Optional[int] = None,
+                  queue_depth: int = 64) -> typing.Iterator[InflatedBundle]:
+    # Records are anything with direction and data. Deflated bundles are inflated on a thread pool (zlib releases the
+    # GIL while at it) up to queue_depth bundles ahead of the consumer, and come out in the order they went in.
+    if max_workers == 0:
+        for record in records:
+            packet_header = read_bundle_header(record.data)
+            offset = getattr(record, "offset", None)
+            if packet_header is None:
+                yield InflatedBundle(record.direction, record.data, None, offset=offset)
+            else:
+                message_buffer, error = _inflate(packet_header, record.data)
+                yield InflatedBundle(record.direction, record.data, packet_header, message_buffer, error, offset)
+        return
+
+    pending: typing.Deque[typing.Tuple[InflatedBundle, typing.Optional[concurrent.futures.Future]]] = \
+        collections.deque()
+
+    def complete(bundle: InflatedBundle, future: typing.Optional[concurrent.futures.Future]) -> InflatedBundle:
+        if future is not None:
+            bundle.message_buffer, bundle.error = future.result()
+        return bundle
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for record in records:
+            packet_header = read_bundle_header(record.data)
+            bundle = InflatedBundle(record.direction, record.data, packet_header,
+                                    offset=getattr(record, "offset", None))
+            if packet_header is None:
+                future = None
+            elif packet_header.is_deflated:
+                future = executor.submit(_inflate, packet_header, record.data)
+            else:
+                future = None
+                bundle.message_buffer = inflate_bundle(packet_header, record.data)
+            pending.append((bundle, future))
+
+            while pending and (len(pending) > queue_depth or pending[0][1] is None or pending[0][1].done()):
+                yield complete(*pending.popleft())
+
+        while pending:
+            yield complete(*pending.popleft())
@@ -0,0 +1,117 @@
+import bisect
+import dataclasses
+import json
+import os
+import struct
+import typing
+import zlib
+
+# A header, then one record per snapshot: the bundle timestamp it was taken after, the offset of the first log record
+# left to feed, and the zlib compressed JSON of Parser.export_state. No pickles, so that loading a checkpoint cannot
+# run code, and so that it survives the classes changing; snapshots of an unknown version are refused.
+# The header also tells which log the snapshots were taken out of (see LogIdentity), as their offsets mean nothing in
+# any other one.
+CHECKPOINT_MAGIC = b"XIVCKPT\x00"
+CHECKPOINT_VERSION = 2
+CHECKPOINT_HEADER = struct.Struct("<8sHQII")  # magic, version, log size, log prefix length, CRC-32 of the log prefix
+CHECKPOINT_RECORD = struct.Struct("<qQI")  # bundle timestamp in ms, log offset to resume from, payload size
+
+# How much of the start of a log goes into its identity; that is where the v2 header is, and the first bundles.
+LOG_PREFIX_SIZE = 64 * 1024
+
+
+def checkpoint_path(log_path: str) -> str:
+    return log_path + ".ckpt"
+
+
+@dataclasses.dataclass(frozen=True)
+class LogIdentity:
+    """Size of a log when checkpointed, and a checksum of its start. Logs only ever grow, so the same log may have
+    grown since, but it still starts the same way."""
+    size: int
+    prefix_length: int
+    prefix_crc: int
+
+    @classmethod
+    def of(cls, fp: typing.BinaryIO) -> "LogIdentity":
+        size = os.fstat(fp.fileno()).st_size
+        prefix_length = min(size, LOG_PREFIX_SIZE)
+        fp.seek(0)
+        return cls(size, prefix_length, zlib.crc32(fp.read(prefix_length)))
+
+    def matches(self, fp: typing.BinaryIO) -> bool:
+        if os.fstat(fp.fileno()).st_size < self.size:
+            return False
+        fp.seek(0)
+        return zlib.crc32(fp.read(self.prefix_length)) == self.prefix_crc
+
+
+@dataclasses.dataclass
+class Checkpoint:
+    timestamp_ms: int
+    resume_offset: int
+    state: typing.Dict[str, typing.Any]
+
+
+class CheckpointWriter:
+    def __init__(self, fp: typing.BinaryIO, interval: float, log: LogIdentity):
+        self._fp = fp
+        self._interval_ms = int(interval * 1000)
+        self._next_ms: typing.Optional[int] = None
+        fp.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, log.size, log.prefix_length,
+                                        log.prefix_crc))
+
+    def due(self, timestamp_ms: int) -> bool:
+        if self._next_ms is None:
+            self._next_ms = timestamp_ms + self._interval_ms
+            return False
+        return timestamp_ms >= self._next_ms
+
+    def write(self, timestamp_ms: int, resume_offset: int, state: typing.Dict[str, typing.Any]):
+        payload = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+        self._fp.write(CHECKPOINT_RECORD.pack(timestamp_ms, resume_offset, len(payload)))
+        self._fp.write(payload)
+        self._fp.flush()
+        self._next_ms = timestamp_ms + self._interval_ms
+
+
+class CheckpointReader:
+    """Finds the snapshots in a checkpoint file up front, and only loads the one asked for.
+
+    log_fp is the log about to be resumed; a checkpoint taken out of any other log is refused."""
+
+    def __init__(self, fp: typing.BinaryIO, log_fp: typing.BinaryIO):
+        self._fp = fp
+        header = fp.read(CHECKPOINT_HEADER.size)
+        if len(header) < CHECKPOINT_HEADER.size or header[:len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC:
+            raise ValueError("not a checkpoint file")
+        magic, version, *log = CHECKPOINT_HEADER.unpack(header)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"unsupported checkpoint version {version}")
+        if not LogIdentity(*log).matches(log_fp):
+            raise ValueError("checkpoint was taken out of another log")
+
+        # timestamp in ms, log offset to resume from, payload offset, payload size
+        self.entries: typing.List[typing.Tuple[int, int, int, int]] = []
+        end = fp.seek(0, 2)
+        position = CHECKPOINT_HEADER.size
+        while position + CHECKPOINT_RECORD.size <= end:
+            fp.seek(position)
+            timestamp_ms, resume_offset, size = CHECKPOINT_RECORD.unpack(fp.read(CHECKPOINT_RECORD.size))
+            payload_position = position + CHECKPOINT_RECORD.size
+            if payload_position + size > end:
+                break  # last one is still being written
+            self.entries.append((timestamp_ms, resume_offset, payload_position, size))
+            position = payload_position + size
+
+    def nearest(self, timestamp_ms: int) -> typing.Optional[Checkpoint]:
+        """Returns the last snapshot taken at or before timestamp_ms."""
+        i = bisect.bisect_right(self.entries, timestamp_ms, key=lambda x: x[0]) - 1
+        if i < 0:
+            return None
+        timestamp_ms, resume_offset, position, size = self.entries[i]
+        self._fp.seek(position)
+        payload = self._fp.read(size)
+        if len(payload) != size:
+            return None
+        return Checkpoint(timestamp_ms, resume_offset, json.loads(zlib.decompress(payload).decode("utf-8")))
@@ -1,13 +1,24 @@
+import argparse
+import concurrent.futures
 import contextlib
 import ctypes
 import dataclasses
+import heapq
 import ipaddress
+import os
+import pathlib
+import pickle
+import signal
 import struct
+import tempfile
+import time
 import typing
 
-import pyshark
 import sys
 
+from logfile import LogWriter, DIRECTION_FROM_SERVER, DIRECTION_FROM_CLIENT
+from pcap import iter_tcp_frames, CaptureReader, TcpFrame, TCP_SYN, TCP_ACK, TCP_RST, TCP_FIN, decode_tcp_frame, \
+    tcp_endpoints, ticks_to_datetime
 from pyxivdata.network.packet import PacketHeader
 
 
@@ -27,38 +38,183 @@ class AddressPair:
         return cls(addr1, port1, addr2, port2)
 
 
+BUNDLE_SIGNATURES = (PacketHeader.SIGNATURE_1, PacketHeader.SIGNATURE_2)
+BUNDLE_HEADER_SIZE = ctypes.sizeof(PacketHeader)
+MAX_BUNDLE_SIZE = 0x100000
+
+
+def _bundle_size_at(data: memoryview, ptr: int) -> typing.Optional[int]:
+    packet_header = PacketHeader.from_buffer_copy(data[ptr:ptr + BUNDLE_HEADER_SIZE])
+    if bytes(packet_header.signature) not in BUNDLE_SIGNATURES:
+        return None
+    if not BUNDLE_HEADER_SIZE <= packet_header.size <= MAX_BUNDLE_SIZE:
+        return None
+    return packet_header.size
+
+
+def _seq_distance(seq: int, base: int) -> int:
+    return ((seq - base + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+class ReassemblyBuffer:
+    def __init__(self):
+        self._data = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._data) - self._offset
+
+    def append(self, data: typing.Union[bytes, bytearray, memoryview]):
+        if not data:
+            return
+        try:
+            if self._offset and self._offset * 2 >= len(self._data):
+                del self._data[:self._offset]
+                self._offset = 0
+            self._data += data
+        except BufferError:
+            # A consumer is still holding a view from the previous round; leave that storage to it.
+            self._data = self._data[self._offset:] + data
+            self._offset = 0
+
+    def view(self) -> memoryview:
+        return memoryview(self._data)[self._offset:]
+
+    def find(self, sub: bytes, start: int = 0) -> int:
+        ptr = self._data.find(sub, self._offset + start)
+        return -1 if ptr == -1 else ptr - self._offset
+
+    def consume(self, size: int):
+        self._offset += size
+
+
 class ConnectionStream:
     addr: ipaddress.IPv4Address
     port: int
     seq: typing.Optional[int]
     fin: bool
+    pending: typing.Dict[int, typing.Tuple[int, bytes]]
+    buffer: ReassemblyBuffer
+
+    MAX_PENDING_SEGMENTS = 1024
+    MAX_PENDING_BYTES = 16 * 1024 * 1024
 
     def __init__(self, addr: ipaddress.IPv4Address, port: int, seq: typing.Optional[int]):
         self.addr = addr
         self.port = port
         self.seq = seq
+        # seq, unwrapped: how far the stream has gone since seq was first known, past 2 ** 32 if need be.
+        self.position = 0
         self.fin = False
         self.pending = {}
-        self.assembled = []
-        self.seqs = []
+        # (position, seq) of the pending segments, earliest first; entries whose seq is no longer pending are skipped.
+        self.pending_order: typing.List[typing.Tuple[int, int]] = []
+        self.pending_bytes = 0
+        self.buffer = ReassemblyBuffer()
+        self.resync_scanned = 0
+        # Bytes ever appended to buffer, and where in those bytes something is missing before the next byte: a segment
+        # cut short by the snap length, or a hole given up on.
+        self.appended = 0
+        self.gaps: typing.List[int] = []
+
+    def start(self, seq: int):
+        """Sets the sequence number the stream starts at, once it is known (from the SYN-ACK)."""
+        self.seq = seq
+        self.position = 0
+        self.pending_order = [(_seq_distance(x, seq), x) for x in self.pending]
+        heapq.heapify(self.pending_order)
+
+    def _store_pending(self, seq: int, nxtseq: int, data: bytes):
+        previous = self.pending.get(seq, None)
+        if previous is not None:
+            if len(previous[1]) >= len(data):
+                return  # retransmission of an out-of-order segment we already hold
+            self.pending_bytes -= len(previous[1])
+        elif self.seq is not None:
+            heapq.heappush(self.pending_order, (self.position + _seq_distance(seq, self.seq), seq))
+        self.pending[seq] = nxtseq, data
+        self.pending_bytes += len(data)
+
+        if self.seq is None:
+            # Nothing can be put in order yet, so there is no telling which segments matter; keep the latest ones.
+            while len(self.pending) > self.MAX_PENDING_SEGMENTS or self.pending_bytes > self.MAX_PENDING_BYTES:
+                self.pending_bytes -= len(self.pending.pop(next(iter(self.pending)))[1])
+
+    def _earliest_pending(self) -> typing.Optional[typing.Tuple[int, int]]:
+        order = self.pending_order
+        while order and order[0][1] not in self.pending:
+            heapq.heappop(order)
+        return order[0] if order else None
+
+    def _append(self, seq: int, nxtseq: int, data: bytes) -> bool:
+        distance = _seq_distance(nxtseq, self.seq)
+        if distance <= 0:
+            return False  # nothing new in this segment
+        overlap = -_seq_distance(seq, self.seq)
+        if overlap > 0:
+            data = data[overlap:]
+        self.buffer.append(data)
+        self.appended += len(data)
+        if len(data) < distance:  # also the SYN and FIN, which take a sequence number each and hold no data
+            self._add_gap()
+        self.seq = nxtseq
+        self.position += distance
+        return True
+
+    def _add_gap(self):
+        if not self.gaps or self.gaps[-1] != self.appended:
+            self.gaps.append(self.appended)
+
+    def gap_within(self, start: int, end: int) -> typing.Optional[int]:
+        """Returns the first gap after start and before end, both counted like appended."""
+        for gap in self.gaps:
+            if gap >= end:
+                break
+            if gap > start:
+                return gap
+        return None
+
+    def consume(self, size: int):
+        self.buffer.consume(size)
+        consumed = self.appended - len(self.buffer)
+        while self.gaps and self.gaps[0] <= consumed:
+            del self.gaps[0]
+
+    def _drain(self) -> bool:
+        fed = False
+        while True:
+            earliest = self._earliest_pending()
+            if earliest is None or earliest[0] > self.position:
+                return fed
+            heapq.heappop(self.pending_order)
+            seq = earliest[1]
+            entry = self.pending.pop(seq)
+            self.pending_bytes -= len(entry[1])
+            fed = self._append(seq, *entry) or fed
+
+    def _skip_hole(self):
+        # Whatever is missing is not coming any more; go on from the earliest segment after the hole.
+        position, seq = self._earliest_pending()
+        self.seq = seq
+        self.position = position
+        self._add_gap()
 
-    def later(self, data: typing.Union[bytes, bytearray, memoryview]):
-        self.assembled = [data]
+    def feed(self, seq: int, nxtseq: int, data: typing.Optional[bytes]) -> bool:
+        data = data or b""
+        if self.seq is None or _seq_distance(seq, self.seq) > 0:
+            self._store_pending(seq, nxtseq, data)
+            if self.seq is None:
+                return False
+            fed = False
+        else:
+            fed = self._append(seq, nxtseq, data)
 
-    def feed(self, seq: int, nxtseq: int, data: typing.Optional[bytes]):
-        self.pending[seq] = (data or b""), nxtseq
-        while True:
-            data = self.pending.pop(self.seq, None)
-            if data is None:
-                break
-            data, nxtseq = data
-            self.seqs.append(self.seq)
-            self.seq = nxtseq
-            self.assembled.append(data)
-        data = b"".join(self.assembled)
-        self.assembled = []
-        if data:
-            yield data
+        fed = self._drain() or fed
+        while len(self.pending) > self.MAX_PENDING_SEGMENTS or self.pending_bytes > self.MAX_PENDING_BYTES:
+            self._skip_hole()
+            fed = self._drain() or fed
+
+        return fed and len(self.buffer) > 0
 
 
 class Connection:
@@ -80,99 +236,398 @@ class Connection:
             self.stream2.fin = True
         return self.stream1.fin and self.stream2.fin
 
-    def _feed(self, srcaddr: ipaddress.IPv4Address, srcport: int, seq: int, nxtseq: int,
-              data: typing.Optional[bytes]):
-        if srcaddr == self.stream1.addr and srcport == self.stream1.port:
-            for x in self.stream1.feed(seq, nxtseq, data):
-                yield Connection.SRC, self.stream1, x
-
-        elif srcaddr == self.stream2.addr and srcport == self.stream2.port:
-            for x in self.stream2.feed(seq, nxtseq, data):
-                yield Connection.DST, self.stream2, x
-
     def process(self, srcaddr: ipaddress.IPv4Address, srcport: int,
                 seq: int, nxtseq: int, data: typing.Optional[bytes]):
-        for who, stream, assembled in self._feed(srcaddr, srcport, seq, nxtseq, data):
-            assembled = bytearray(assembled)
+        # Yielded bundles are views into the stream buffer, and are only valid until the next call.
+        if srcaddr == self.stream1.addr and srcport == self.stream1.port:
+            who, stream = Connection.SRC, self.stream1
+        elif srcaddr == self.stream2.addr and srcport == self.stream2.port:
+            who, stream = Connection.DST, self.stream2
+        else:
+            return
+
+        if not stream.feed(seq, nxtseq, data):
+            return
+
+        assembled = stream.buffer.view()
+        start = stream.appended - len(assembled)
+        ptr = 0
+        try:
+            while ptr + BUNDLE_HEADER_SIZE <= len(assembled):
+                size = _bundle_size_at(assembled, ptr)
+                resync_from = ptr + 1
+                if size is not None:
+                    # A bundle running into a gap is missing some of its bytes; it goes out as garbage along with
+                    # whatever follows the gap up to the next bundle.
+                    gap = stream.gap_within(start + ptr, start + ptr + size)
+                    if gap is not None:
+                        size, resync_from = None, gap - start
+                if size is None:
+                    resync, scanned = self._resync(stream, assembled, max(resync_from, stream.resync_scanned))
+                    if resync is None:
+                        # Keep the garbage around until we know where it ends, so that it goes out as one record,
+                        # unless it grew too big to hold on to.
+                        if len(assembled) - ptr < MAX_BUNDLE_SIZE:
+                            stream.resync_scanned = scanned - ptr
+                            break
+                        resync = scanned
+                    stream.resync_scanned = 0
+                    yield who, assembled[ptr:resync]
+                    ptr = resync
+                    continue
 
-            ptr = 0
-            while ptr < len(assembled):
-                if ptr + ctypes.sizeof(PacketHeader) > len(assembled):
-                    break
-                packet_header = PacketHeader.from_buffer(assembled, ptr)
-                if ptr + packet_header.size > len(assembled):
+                if ptr + size > len(assembled):
                     break
+                yield who, assembled[ptr:ptr + size]
+                ptr += size
+        finally:
+            assembled.release()
+            stream.consume(ptr)
+
+    @staticmethod
+    def _resync(stream: ConnectionStream, assembled: memoryview,
+                ptr: int) -> typing.Tuple[typing.Optional[int], int]:
+        # Returns where the next bundle starts, if one does; otherwise, where to pick the search up again once more data
+        # is in, which is a signature that cannot be told from garbage yet, if any.
+        while True:
+            candidates = [x for x in (stream.buffer.find(signature, ptr) for signature in BUNDLE_SIGNATURES)
+                          if x != -1]
+            if not candidates:
+                return None, max(ptr, len(assembled) - len(PacketHeader.SIGNATURE_1) + 1)
+
+            ptr = min(candidates)
+            if ptr + BUNDLE_HEADER_SIZE > len(assembled):
+                return None, ptr
+            if _bundle_size_at(assembled, ptr) is not None:
+                return ptr, ptr
+            ptr += 1
+
+
+OutputKey = typing.Tuple[ipaddress.IPv4Address, int]
+
+
+class CaptureConverter:
+    connections: typing.Dict[AddressPair, Connection]
+
+    def __init__(self, output_dir: pathlib.Path, state: typing.Optional[typing.Dict[str, typing.Any]] = None,
+                 log_version: int = 1):
+        self.output_dir = output_dir
+        self.log_version = log_version
+        self.connections = {}
+        self._files: typing.Dict[OutputKey, LogWriter] = {}
+
+        if state is not None:
+            self.connections = state["connections"]
+            self.log_version = state["log_version"]
+            for key, writer_state in state["files"].items():
+                # Anything written after the checkpoint will be produced again from the capture.
+                # noinspection PyTypeChecker
+                self._files[key] = LogWriter(open(self.output_path(*key), "r+b"), self.log_version,
+                                             state=writer_state)
+
+    def flush(self):
+        for writer in self._files.values():
+            writer.flush()
+
+    def state(self) -> typing.Dict[str, typing.Any]:
+        self.flush()
+        return {
+            "connections": self.connections,
+            "log_version": self.log_version,
+            "files": {key: writer.state() for key, writer in self._files.items()},
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for writer in self._files.values():
+            writer.close()
+        self._files.clear()
+
+    def output_path(self, addr: ipaddress.IPv4Address, port: int) -> pathlib.Path:
+        return self.output_dir / f"{addr}.{port}.log"
+
+    def _open(self, key: OutputKey) -> LogWriter:
+        writer = self._files.get(key, None)
+        if writer is None:
+            # noinspection PyTypeChecker
+            writer = self._files[key] = LogWriter(open(self.output_path(*key), "wb"), self.log_version)
+        return writer
+
+    def feed(self, index: int, frame: TcpFrame):
+        srcaddr, srcport = frame.src, frame.srcport
+        dstaddr, dstport = frame.dst, frame.dstport
+
+        addr_pair = AddressPair.from_pair(srcaddr, srcport, dstaddr, dstport)
+        connection: Connection = self.connections.get(addr_pair, None)
+
+        tcp_flags = frame.flags
+
+        if tcp_flags & TCP_SYN:
+            if tcp_flags & TCP_ACK:
+                if connection is None:
+                    return
+                connection.stream2.start(frame.seq)
+            else:
+                connection = self.connections[addr_pair] = Connection(srcaddr, srcport, dstaddr, dstport, frame.seq)
+                print(f"\r[{index:>7}] New connection {addr_pair}")
+                self._open((connection.stream2.addr, connection.stream2.port))
+        if connection is None:
+            return  # don't know, don't care
+
+        if tcp_flags & TCP_RST:
+            del self.connections[addr_pair]
+            return
+
+        if tcp_flags & (TCP_FIN | TCP_ACK) == TCP_FIN | TCP_ACK:
+            if connection.set_fin_ack(srcaddr, srcport):
+                del self.connections[addr_pair]
+                return
+
+        if frame.truncated:
+            # The stream moves on past the whole segment; what was not captured makes a gap, and whatever bundle it
+            # cuts goes out as a single garbage record.
+            print(f"\r[{index:>7}] Truncated segment from {srcaddr}:{srcport} at seq {frame.seq}: "
+                  f"{len(frame.payload)} bytes captured of {_seq_distance(frame.nxtseq, frame.seq)}")
+
+        writer = self._files[connection.stream2.addr, connection.stream2.port]
+        for who, packet in connection.process(srcaddr, srcport, frame.seq, frame.nxtseq, frame.payload):
+            writer.write(DIRECTION_FROM_SERVER if who is Connection.DST else DIRECTION_FROM_CLIENT, packet)
+
+
+def convert(capture_path: pathlib.Path, output_dir: pathlib.Path, log_version: int = 1):
+    # noinspection PyTypeChecker
+    with open(capture_path, "rb") as capture, CaptureConverter(output_dir, log_version=log_version) as converter:
+        for i, frame in enumerate(iter_tcp_frames(capture)):
+            if i % 100 == 0:
+                print(f"\r[{i:>7}] ", end="")
+                sys.stdout.flush()
+            converter.feed(i, frame)
 
-                if bytes(packet_header.signature) not in (PacketHeader.SIGNATURE_1, PacketHeader.SIGNATURE_2):
-                    yield who, assembled[ptr:ptr + 1]
-                    ptr += 1
-                else:
-                    yield who, assembled[ptr:ptr + packet_header.size]
-                    ptr += packet_header.size
 
-            if ptr < len(assembled):
-                stream.later(assembled[ptr:])
+CHECKPOINT_VERSION = 3
 
 
-def __main__():
-    path = r"D:\OneDrive\Misc\xivcapture\Network_22106_20211025"
-    c = pyshark.FileCapture(fr"{path}.pcapng")
+def _load_checkpoint(path: typing.Optional[pathlib.Path]) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    if path is None or not path.exists():
+        return None
+    with open(path, "rb") as fp:
+        checkpoint = pickle.load(fp)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {checkpoint.get('version')}")
+    return checkpoint
 
-    connections = {}
-    with contextlib.ExitStack() as exit_stack:
-        files: typing.Dict[typing.Tuple[ipaddress.IPv4Address, int], typing.BinaryIO] = {}
 
-        for i, pkt in enumerate(c):
-            print(f"\r[{i:>7}] ", end="")
-            if i % 100 == 0:
-                sys.stdout.flush()
+def _save_checkpoint(path: pathlib.Path, checkpoint: typing.Dict[str, typing.Any]):
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "wb") as fp:
+        pickle.dump(checkpoint, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
 
-            try:
-                srcaddr, srcport = ipaddress.ip_address(pkt.ip.src), int(pkt.tcp.srcport)
-                dstaddr, dstport = ipaddress.ip_address(pkt.ip.dst), int(pkt.tcp.dstport)
-            except AttributeError:
-                continue
 
-            addr_pair = AddressPair.from_pair(srcaddr, srcport, dstaddr, dstport)
-            connection: Connection = connections.get(addr_pair, None)
-
-            tcp_flags = pkt.tcp.flags.hex_value
-
-            if tcp_flags & 0x02:  # SYN
-                if tcp_flags & 0x10:  # ACK
-                    if connection is None:
-                        continue
-                    connection.stream2.seq = int(pkt.tcp.seq)
-                else:
-                    connection = connections[addr_pair] = Connection(srcaddr, srcport, dstaddr, dstport,
-                                                                     int(pkt.tcp.seq))
-                    print(f"\r[{i:>7}] New connection {addr_pair}")
-                    # noinspection PyTypeChecker
-                    fp = exit_stack.enter_context(
-                        open(rf"{path}\{dstaddr}.{dstport}.log", "wb"))
-                    files[connection.stream2.addr, connection.stream2.port] = fp
-            if connection is None:
-                continue  # don't know, don't care
-
-            if tcp_flags & 0x04:  # RST
-                del connections[addr_pair]
+def convert_follow(capture_path: typing.Optional[pathlib.Path], output_dir: pathlib.Path,
+                   checkpoint_path: typing.Optional[pathlib.Path] = None, checkpoint_interval: float = 10.,
+                   poll_interval: float = 0.5, log_version: int = 1):
+    # Reading from stdin when capture_path is None. Connection state survives a restart (or a rotation to another
+    # capture file) through the checkpoint; the capture offset is only reused when it is the same file again.
+    checkpoint = _load_checkpoint(checkpoint_path)
+    capture_name = None if capture_path is None else str(capture_path.resolve())
+
+    reader_state = None
+    frame_index = 0
+    if checkpoint is not None:
+        frame_index = checkpoint["frame_index"]
+        if capture_name is not None and checkpoint["capture"] == capture_name:
+            reader_state = checkpoint["reader"]
+
+    with contextlib.ExitStack() as exit_stack:
+        if capture_path is None:
+            capture = sys.stdin.buffer
+        else:
+            # noinspection PyTypeChecker
+            capture = exit_stack.enter_context(open(capture_path, "rb"))
+
+        converter = exit_stack.enter_context(
+            CaptureConverter(output_dir, None if checkpoint is None else checkpoint["converter"], log_version))
+        last_checkpoint = time.monotonic()
+
+        def save():
+            nonlocal last_checkpoint
+            converter.flush()
+            if checkpoint_path is not None:
+                _save_checkpoint(checkpoint_path, {
+                    "version": CHECKPOINT_VERSION,
+                    "capture": capture_name,
+                    "reader": reader.state(),
+                    "frame_index": frame_index,
+                    "converter": converter.state(),
+                })
+            last_checkpoint = time.monotonic()
+
+        stop_requested = False
+
+        def request_stop(_signum, _frame):
+            nonlocal stop_requested
+            stop_requested = True
+
+        def on_idle():
+            # The reader state never includes a partly read block or file header, so this is a safe point to stop at.
+            if stop_requested:
+                raise KeyboardInterrupt
+            if time.monotonic() - last_checkpoint >= checkpoint_interval:
+                save()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            exit_stack.callback(signal.signal, signum, signal.signal(signum, request_stop))
+
+        reader = CaptureReader(capture, follow=True, poll_interval=poll_interval, on_idle=on_idle,
+                               state=reader_state)
+        try:
+            for frame in reader:
+                if frame_index % 100 == 0:
+                    print(f"\r[{frame_index:>7}] ", end="")
+                    sys.stdout.flush()
+                converter.feed(frame_index, frame)
+                frame_index += 1
+                on_idle()
+        except KeyboardInterrupt:
+            pass
+        save()
+
+
+# Frame index, then the capture record as CaptureReader.records() yields it: linktype, ticks, ticks per second, and
+# the length of the captured bytes that follow, copied through as they are.
+SHARD_RECORD = struct.Struct("<QHQQI")
+SHARD_FLUSH_SIZE = 256 * 1024
+
+
+def _iter_shard(path: pathlib.Path) -> typing.Iterator[typing.Tuple[int, TcpFrame]]:
+    # noinspection PyTypeChecker
+    with open(path, "rb") as fp:
+        while True:
+            header = fp.read(SHARD_RECORD.size)
+            if not header:
+                return
+            index, linktype, ticks, ticks_per_second, length = SHARD_RECORD.unpack(header)
+            yield index, decode_tcp_frame(linktype, ticks_to_datetime(ticks, ticks_per_second), fp.read(length))
+
+
+def _shard_capture(capture_path: pathlib.Path, shard_dir: pathlib.Path) -> typing.List[typing.List[pathlib.Path]]:
+    # Frames are split per address pair. Pairs that end up writing into the same output file (same server endpoint)
+    # are grouped together, so that each group can be converted on its own and still produce the exact same files.
+    # Only the endpoints are looked at here; records are copied as they are, and decoded by whoever converts them.
+    # Endpoints are address and port bytes (see tcp_endpoints), and a pair is both of them, the smaller one first.
+    shard_paths: typing.Dict[bytes, pathlib.Path] = {}
+    buffers: typing.Dict[bytes, bytearray] = {}
+    groups: typing.Dict[bytes, bytes] = {}
+    parents: typing.Dict[bytes, bytes] = {}
+
+    def find(key: bytes) -> bytes:
+        while parents.setdefault(key, key) != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    def flush(pair: bytes):
+        with open(shard_paths[pair], "ab") as fp:
+            fp.write(buffers[pair])
+        buffers[pair].clear()
+
+    i = 0
+    # noinspection PyTypeChecker
+    with open(capture_path, "rb") as capture:
+        for linktype, ticks, ticks_per_second, data in CaptureReader(capture).records():
+            endpoints = tcp_endpoints(linktype, data)
+            if endpoints is None:
                 continue
+            if i % 100 == 0:
+                print(f"\r[{i:>7}] ", end="")
+                sys.stdout.flush()
 
-            if tcp_flags & 0x11 == 0x11:  # FIN ACK
-                if connection.set_fin_ack(srcaddr, srcport):
-                    del connections[addr_pair]
-                    continue
+            src, dst, flags = endpoints
+            addr_pair = src + dst if src <= dst else dst + src
+            if flags & (TCP_SYN | TCP_ACK) == TCP_SYN:
+                key = find(dst)
+                if addr_pair in groups:
+                    parents[find(groups[addr_pair])] = key
+                groups[addr_pair] = key
+                if addr_pair not in shard_paths:
+                    shard_paths[addr_pair] = shard_dir / f"{len(shard_paths)}.bin"
+                    buffers[addr_pair] = bytearray()
+
+            buffer = buffers.get(addr_pair, None)
+            if buffer is not None:  # otherwise no connection was ever opened for this pair; the converter ignores it
+                buffer += SHARD_RECORD.pack(i, linktype, ticks, ticks_per_second, len(data))
+                buffer += data
+                if len(buffer) >= SHARD_FLUSH_SIZE:
+                    flush(addr_pair)
+            i += 1
+
+    for addr_pair in buffers:
+        flush(addr_pair)
+
+    grouped: typing.Dict[bytes, typing.List[pathlib.Path]] = {}
+    for addr_pair, key in groups.items():
+        grouped.setdefault(find(key), []).append(shard_paths[addr_pair])
+    return list(grouped.values())
+
+
+def _convert_shards(shard_paths: typing.List[pathlib.Path], output_dir: pathlib.Path, log_version: int):
+    with CaptureConverter(output_dir, log_version=log_version) as converter:
+        for index, frame in heapq.merge(*(_iter_shard(x) for x in shard_paths), key=lambda x: x[0]):
+            converter.feed(index, frame)
+
+
+def convert_parallel(capture_path: pathlib.Path, output_dir: pathlib.Path, jobs: typing.Optional[int] = None,
+                     log_version: int = 1):
+    with tempfile.TemporaryDirectory(prefix="shards-", dir=output_dir) as shard_dir:
+        groups = _shard_capture(capture_path, pathlib.Path(shard_dir))
+        print(f"\rConverting {len(groups)} connection groups")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(_convert_shards, group, output_dir, log_version) for group in groups]:
+                future.result()
 
-            try:
-                data = pkt.tcp.payload.binary_value
-            except AttributeError:
-                data = b""
-            fp = files[connection.stream2.addr, connection.stream2.port]
-            for who, packet in connection.process(srcaddr, srcport, int(pkt.tcp.seq), int(pkt.tcp.nxtseq), data):
-                hdr = struct.pack("<cI", b'<' if who is Connection.DST else b'>', len(packet))
-                fp.write(hdr)
-                print(fp.tell(), len(packet))
-                fp.write(packet)
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Extracts FFXIV bundles per TCP connection from a capture file.")
+    parser.add_argument("capture", help="pcap or pcapng file; - to read a pcap stream from stdin (with --follow)")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path,
+                        help="where to write <server address>.<server port>.log files "
+                             "(default: capture path without its extension)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="convert connections on this many processes; 0 to use every core (default: 1)")
+    parser.add_argument("--log-version", type=int, choices=(1, 2), default=1,
+                        help="2 to write a header and a timestamp index for seeking (default: 1)")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="keep converting as the capture grows, until interrupted")
+    parser.add_argument("--checkpoint", type=pathlib.Path,
+                        help="with --follow, resume from and periodically save progress to this file")
+    parser.add_argument("--checkpoint-interval", type=float, default=10.,
+                        help="seconds between checkpoints (default: 10)")
+    parser.add_argument("--poll-interval", type=float, default=0.5,
+                        help="seconds to wait for the capture to grow (default: 0.5)")
+    args = parser.parse_args()
+
+    capture_path = None if args.capture == "-" else pathlib.Path(args.capture)
+    if capture_path is None and not (args.follow and args.output_dir):
+        parser.error("reading from stdin requires --follow and --output-dir")
+    if args.follow and args.jobs != 1:
+        parser.error("--follow converts on a single process")
+
+    output_dir: pathlib.Path = args.output_dir or capture_path.with_suffix("")
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.follow:
+        convert_follow(capture_path, output_dir, args.checkpoint, args.checkpoint_interval, args.poll_interval,
+                       args.log_version)
+    elif args.jobs == 1:
+        convert(capture_path, output_dir, args.log_version)
+    else:
+        convert_parallel(capture_path, output_dir, args.jobs or os.cpu_count(), args.log_version)
 
     return 0
 
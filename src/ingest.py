@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import contextlib
+import sys
+import traceback
+import typing
+
+import zlib
+
+from app import Parser, dispatch_bundle
+from bundle import read_bundle_header, inflate_bundle
+from logfile import LogReader, RECORD_HEADER
+from manager.event_text import TextSink
+from pyxivdata.common import GameLanguage
+from pyxivdata.installation.resource_reader import GameResourceReader
+
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+
+class RecordProtocol(asyncio.Protocol):
+    """Frames <cI records out of a byte stream, and stops reading while the record queue is full."""
+
+    def __init__(self, queue: asyncio.Queue):
+        # Receives (direction, bundle) tuples, and then None once the stream ends.
+        self._queue = queue
+        self._buffer = bytearray()
+        self._transport: typing.Optional[asyncio.Transport] = None
+        self._paused = False
+        self._eof = False
+        self._eof_queued = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+
+    @property
+    def peer(self) -> typing.Any:
+        return None if self._transport is None else self._transport.get_extra_info("peername")
+
+    def close(self):
+        # Stops reading for good; whatever is still queued is left alone.
+        self._eof = True
+        if self._transport is not None:
+            self._transport.close()
+
+    def data_received(self, data: bytes):
+        self._buffer += data
+        self._drain()
+
+    def eof_received(self):
+        self._eof = True
+        self._drain()
+        return False
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        self._eof = True
+        self._drain()
+
+    def resume(self):
+        # Called by the consumer after it took a record off the queue.
+        if self._paused and not self._queue.full():
+            self._paused = False
+            if not self._eof:
+                self._transport.resume_reading()
+        self._drain()
+
+    def _drain(self):
+        buffer = self._buffer
+        ptr = 0
+        while not self._queue.full() and ptr + RECORD_HEADER.size <= len(buffer):
+            direction, length = RECORD_HEADER.unpack_from(buffer, ptr)
+            if length > MAX_RECORD_SIZE:
+                print(f"Record of {length} bytes is too big; dropping the connection", file=sys.stderr)
+                del buffer[:]
+                self._eof = True
+                self._transport.close()
+                break
+            if ptr + RECORD_HEADER.size + length > len(buffer):
+                break
+            ptr += RECORD_HEADER.size
+            self._queue.put_nowait((direction, buffer[ptr:ptr + length]))
+            ptr += length
+        del buffer[:ptr]
+
+        if self._queue.full():
+            if not self._paused and not self._eof:
+                self._transport.pause_reading()
+            self._paused = True
+        elif self._eof and not self._eof_queued:
+            # Whatever is left in the buffer is a record cut short by the disconnection.
+            self._eof_queued = True
+            self._queue.put_nowait(None)
+
+
+class IngestSession:
+    def __init__(self, parser: Parser, queue_depth: int):
+        self.parser = parser
+        self.queue = asyncio.Queue(queue_depth)
+        self.protocol = RecordProtocol(self.queue)
+        self.bundles = 0
+        self.task: typing.Optional[asyncio.Task] = None
+
+    async def run(self):
+        # A handler that raises leaves the parser in no state to go on with; drop the stream instead of leaving it to
+        # stall once its queue fills up with nobody taking records off it.
+        try:
+            await self._run()
+        except Exception as e:
+            print(f"{self.protocol.peer}: dropping the connection after {self.bundles} bundles: "
+                  f"{type(e).__name__}: {e}", file=sys.stderr)
+            traceback.print_exc()
+            self.protocol.close()
+            self.parser.events.close()
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            self.protocol.resume()
+            if item is None:
+                self.parser.events.close()
+                return
+
+            direction, data = item
+            packet_header = read_bundle_header(data)
+            if packet_header is None:
+                self.parser.events.flush()
+                print(f"skipped {len(data)} bytes")
+                continue
+            try:
+                message_buffer = inflate_bundle(packet_header, data)
+            except zlib.error as e:
+                self.parser.events.flush()
+                print(f"zlib error: {e}")
+                continue
+
+            dispatch_bundle(self.parser, direction, packet_header, message_buffer)
+            self.bundles += 1
+            if self.bundles % 64 == 0:
+                await asyncio.sleep(0)  # let the other streams have their turn
+
+
+class IngestService:
+    """Runs one Parser per incoming stream; streams are independent of each other."""
+
+    def __init__(self, parser_factory: typing.Callable[[], Parser], queue_depth: int = 256):
+        self._parser_factory = parser_factory
+        self._queue_depth = queue_depth
+        self.sessions: typing.Set[IngestSession] = set()
+
+    def _protocol_factory(self) -> RecordProtocol:
+        session = IngestSession(self._parser_factory(), self._queue_depth)
+        session.task = asyncio.get_running_loop().create_task(session.run())
+        self.sessions.add(session)
+        session.task.add_done_callback(lambda _: self.sessions.discard(session))
+        return session.protocol
+
+    async def serve_tcp(self, host: typing.Optional[str], port: int) -> asyncio.AbstractServer:
+        return await asyncio.get_running_loop().create_server(self._protocol_factory, host, port)
+
+    async def serve_unix(self, path: str) -> asyncio.AbstractServer:
+        return await asyncio.get_running_loop().create_unix_server(self._protocol_factory, path)
+
+    async def connect(self, host: str, port: int):
+        # Pulls records from a server that streams them, such as serve_replay.
+        await asyncio.get_running_loop().create_connection(self._protocol_factory, host, port)
+
+    async def wait_idle(self):
+        while self.sessions:
+            await asyncio.gather(*(x.task for x in list(self.sessions)))
+
+
+async def _replay_logs(paths: typing.Sequence[str], reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        for path in paths:
+            # noinspection PyTypeChecker
+            with open(path, "rb") as fp, LogReader(fp) as log:
+                for record in log:
+                    writer.write(RECORD_HEADER.pack(record.direction, len(record.data)))
+                    writer.write(record.data)
+                    await writer.drain()
+        writer.write_eof()
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_replay(paths: typing.Sequence[str], host: typing.Optional[str], port: int) -> asyncio.AbstractServer:
+    """Streams the given logs, one after another, to every client that connects."""
+    return await asyncio.start_server(lambda r, w: _replay_logs(paths, r, w), host, port)
+
+
+def _printing_parser(res: GameResourceReader) -> Parser:
+    parser = Parser(res)
+    parser.events.add_sink(TextSink(sys.stdout, parser.resource_reader, parser.actor_manager))
+    return parser
+
+
+async def _main(args: argparse.Namespace):
+    if args.command == "replay":
+        server = await serve_replay(args.logs, args.host, args.port)
+        async with server:
+            await server.serve_forever()
+        return
+
+    with GameResourceReader(default_language=[GameLanguage.English]) as res:
+        service = IngestService(lambda: _printing_parser(res), args.queue_depth)
+        if args.command == "connect":
+            await service.connect(args.host, args.port)
+            await service.wait_idle()
+            return
+
+        if args.unix:
+            server = await service.serve_unix(args.unix)
+        else:
+            server = await service.serve_tcp(args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Feeds the parser from records streamed over sockets.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="accept record streams from capture agents")
+    serve.add_argument("--host", default=None)
+    serve.add_argument("--port", type=int, default=50055)
+    serve.add_argument("--unix", help="listen on this unix socket instead of TCP")
+    serve.add_argument("--queue-depth", type=int, default=256,
+                       help="records buffered per stream before reading from it pauses (default: 256)")
+
+    connect = subparsers.add_parser("connect", help="read one record stream from a server, such as replay")
+    connect.add_argument("host")
+    connect.add_argument("port", type=int)
+    connect.add_argument("--queue-depth", type=int, default=256)
+
+    replay = subparsers.add_parser("replay", help="stream existing logs to whoever connects")
+    replay.add_argument("logs", nargs="+")
+    replay.add_argument("--host", default="127.0.0.1")
+    replay.add_argument("--port", type=int, default=50056)
+
+    args = parser.parse_args()
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(_main(args))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(__main__())
@@ -0,0 +1,208 @@
+import bisect
+import ctypes
+import dataclasses
+import datetime
+import mmap
+import os
+import struct
+import typing
+
+from pyxivdata.network.packet import PacketHeader
+
+# v1 is a bare sequence of records. v2 adds a header up front, and a sparse index of record offsets by bundle
+# timestamp after the last record, which is found through the fixed size footer at the very end of the file.
+LOG_V2_MAGIC = b"XIVLOG\x00\x02"
+LOG_V2_INDEX_MAGIC = b"XIVLOGIX"
+LOG_V2_HEADER = struct.Struct("<8sHHII")  # magic, version, header size, index every n bundles, index every n ms
+LOG_V2_INDEX_ENTRY = struct.Struct("<Qq")  # record offset, timestamp in ms
+LOG_V2_FOOTER = struct.Struct("<QQ8s")  # index offset, index entry count, index magic
+
+RECORD_HEADER = struct.Struct("<cI")
+
+DIRECTION_FROM_SERVER = b'<'
+DIRECTION_FROM_CLIENT = b'>'
+
+
+def timestamp_to_ms(timestamp: datetime.datetime) -> int:
+    return int(timestamp.timestamp() * 1000)
+
+
+def bundle_timestamp_ms(bundle: typing.Union[bytes, bytearray, memoryview]) -> typing.Optional[int]:
+    if len(bundle) < ctypes.sizeof(PacketHeader):
+        return None
+    packet_header = PacketHeader.from_buffer_copy(bundle[:ctypes.sizeof(PacketHeader)])
+    if bytes(packet_header.signature) not in (PacketHeader.SIGNATURE_1, PacketHeader.SIGNATURE_2):
+        return None
+    return timestamp_to_ms(packet_header.timestamp)
+
+
+@dataclasses.dataclass
+class LogRecord:
+    offset: int
+    direction: bytes
+    data: memoryview
+
+
+class LogWriter:
+    def __init__(self, fp: typing.BinaryIO, version: int = 1,
+                 index_every_bundles: int = 1024, index_every_seconds: float = 10.,
+                 state: typing.Optional[typing.Dict[str, typing.Any]] = None):
+        if version not in (1, 2):
+            raise ValueError(f"Unsupported log version {version}")
+        self._fp = fp
+        self.version = version
+        self._index_every_bundles = index_every_bundles
+        self._index_every_ms = int(index_every_seconds * 1000)
+        self._index: typing.List[typing.Tuple[int, int]] = []
+        self._bundles_since_index = 0
+        self._last_timestamp = None
+
+        if state is not None:
+            self._index = list(state["index"])
+            self._bundles_since_index = state["bundles_since_index"]
+            self._last_timestamp = state["last_timestamp"]
+            # Anything after the last checkpointed record (including a previously written index) goes away.
+            self._fp.seek(state["records_end"])
+            self._fp.truncate()
+        elif version == 2:
+            self._fp.write(LOG_V2_HEADER.pack(LOG_V2_MAGIC, version, LOG_V2_HEADER.size,
+                                              self._index_every_bundles, self._index_every_ms))
+
+    def state(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "records_end": self._fp.tell(),
+            "index": list(self._index),
+            "bundles_since_index": self._bundles_since_index,
+            "last_timestamp": self._last_timestamp,
+        }
+
+    def write(self, direction: bytes, bundle: typing.Union[bytes, bytearray, memoryview]):
+        if self.version == 2:
+            timestamp = bundle_timestamp_ms(bundle)
+            if timestamp is not None:
+                if self._last_timestamp is not None:
+                    # Keep the index sorted even if the two directions disagree on the time a little.
+                    timestamp = max(timestamp, self._last_timestamp)
+                if (not self._index
+                        or self._bundles_since_index >= self._index_every_bundles
+                        or timestamp - self._index[-1][1] >= self._index_every_ms):
+                    self._index.append((self._fp.tell(), timestamp))
+                    self._bundles_since_index = 0
+                self._bundles_since_index += 1
+                self._last_timestamp = timestamp
+
+        self._fp.write(RECORD_HEADER.pack(direction, len(bundle)))
+        self._fp.write(bundle)
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        if self.version == 2:
+            index_offset = self._fp.tell()
+            for entry in self._index:
+                self._fp.write(LOG_V2_INDEX_ENTRY.pack(*entry))
+            self._fp.write(LOG_V2_FOOTER.pack(index_offset, len(self._index), LOG_V2_INDEX_MAGIC))
+        self._fp.close()
+
+
+class LogReader:
+    """Reads records straight out of a memory mapped log; record data are views, valid until the reader is closed."""
+    version: int
+    index: typing.List[typing.Tuple[int, int]]
+
+    def __init__(self, fp: typing.BinaryIO):
+        self._fp = fp
+        self.version = 1
+        self.index = []
+
+        if os.fstat(fp.fileno()).st_size:
+            # Copy-on-write, so that the records can be handed to ctypes from_buffer without touching the file.
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self._view = memoryview(bytearray())
+        self._records_start = 0
+        self._records_end = len(self._view)
+
+        if len(self._view) >= LOG_V2_HEADER.size and self._view[:len(LOG_V2_MAGIC)] == LOG_V2_MAGIC:
+            _, self.version, self._records_start, _, _ = LOG_V2_HEADER.unpack_from(self._view)
+            self._read_index()
+        self._position = self._records_start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # someone still holds a view into it; it goes away along with the last one of those
+            self._mmap = None
+
+    def _read_index(self):
+        size = len(self._view)
+        if size < self._records_start + LOG_V2_FOOTER.size:
+            return
+        index_offset, count, magic = LOG_V2_FOOTER.unpack_from(self._view, size - LOG_V2_FOOTER.size)
+        if magic != LOG_V2_INDEX_MAGIC or index_offset + count * LOG_V2_INDEX_ENTRY.size + LOG_V2_FOOTER.size != size:
+            return  # still being written, or cut short; the records are still readable without the index
+
+        self.index = list(LOG_V2_INDEX_ENTRY.iter_unpack(
+            self._view[index_offset:index_offset + count * LOG_V2_INDEX_ENTRY.size]))
+        self._records_end = index_offset
+
+    def __iter__(self) -> typing.Iterator[LogRecord]:
+        view = self._view
+        end = self._records_end
+        while self._position + RECORD_HEADER.size <= end:
+            offset = self._position
+            direction, length = RECORD_HEADER.unpack_from(view, offset)
+            data_offset = offset + RECORD_HEADER.size
+            if data_offset + length > end:
+                return  # last record is still being written
+            self._position = data_offset + length
+            yield LogRecord(offset, direction, view[data_offset:self._position])
+
+    def rewind(self):
+        self._position = self._records_start
+
+    def seek(self, timestamp: datetime.datetime):
+        """Positions the reader on the first record whose bundle is not older than timestamp."""
+        target = timestamp_to_ms(timestamp)
+        i = bisect.bisect_right(self.index, target, key=lambda x: x[1]) - 1
+        self._position = self.index[i][0] if i >= 0 else self._records_start
+
+        for record in self:
+            record_timestamp = bundle_timestamp_ms(record.data)
+            if record_timestamp is not None and record_timestamp >= target:
+                self._position = record.offset
+                return
+
+    def seek_offset(self, offset: int):
+        """Positions the reader on the record at offset, as given by LogRecord.offset."""
+        self._position = max(offset, self._records_start)
+
+    def iter_range(self, start: typing.Optional[datetime.datetime],
+                   end: typing.Optional[datetime.datetime],
+                   start_offset: typing.Optional[int] = None) -> typing.Iterator[LogRecord]:
+        if start_offset is not None:
+            self.seek_offset(start_offset)
+        elif start is None:
+            self.rewind()
+        else:
+            self.seek(start)
+
+        end_ms = None if end is None else timestamp_to_ms(end)
+        for record in self:
+            if end_ms is not None:
+                record_timestamp = bundle_timestamp_ms(record.data)
+                if record_timestamp is not None and record_timestamp >= end_ms:
+                    return
+            yield record
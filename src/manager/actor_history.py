@@ -0,0 +1,110 @@
+import collections
+import datetime
+import typing
+
+try:
+    import numpy
+except ImportError:  # optional; only needed for actor history
+    numpy = None
+
+HISTORY_COLUMNS = ("timestamp", "x", "y", "z", "rotation", "hp", "mp")  # timestamp in seconds since the epoch
+
+DEFAULT_HISTORY_CAPACITY = 4096
+DEFAULT_HISTORY_ACTORS = 1024
+
+
+class _Ring:
+    __slots__ = ("samples", "count")
+
+    def __init__(self, capacity: int):
+        self.samples = numpy.full((capacity, len(HISTORY_COLUMNS)), numpy.nan)
+        self.count = 0  # ever written; the next sample goes to count % capacity
+
+    def ordered(self) -> 'numpy.ndarray':
+        capacity = len(self.samples)
+        if self.count <= capacity:
+            return self.samples[:self.count]
+        position = self.count % capacity
+        return numpy.concatenate((self.samples[position:], self.samples[:position]))
+
+
+def _seconds(timestamp: typing.Optional[datetime.datetime]) -> typing.Optional[float]:
+    return None if timestamp is None else timestamp.timestamp()
+
+
+class ActorHistory:
+    """Last capacity samples of position, rotation, hp and mp of up to max_actors actors, in preallocated NumPy ring
+    buffers; the buffer of the actor recorded least recently is reused once there are more. Unknown values are NaN."""
+
+    def __init__(self, capacity: int = DEFAULT_HISTORY_CAPACITY, max_actors: int = DEFAULT_HISTORY_ACTORS):
+        if numpy is None:
+            raise RuntimeError("Actor history needs NumPy")
+        self.capacity = capacity
+        self.max_actors = max_actors
+        self._rings: typing.Dict[int, _Ring] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._rings)
+
+    def __contains__(self, actor_id: int):
+        return actor_id in self._rings
+
+    def actor_ids(self) -> typing.List[int]:
+        return list(self._rings)
+
+    def record(self, timestamp: datetime.datetime, actor_id: int,
+               x: typing.Optional[float], y: typing.Optional[float], z: typing.Optional[float],
+               rotation: typing.Optional[float], hp: typing.Optional[int], mp: typing.Optional[int]):
+        ring = self._rings.get(actor_id)
+        if ring is None:
+            if len(self._rings) >= self.max_actors:
+                _, ring = self._rings.popitem(last=False)
+                ring.count = 0
+            else:
+                ring = _Ring(self.capacity)
+            self._rings[actor_id] = ring
+        else:
+            self._rings.move_to_end(actor_id)
+
+        # NumPy turns None into NaN on its own when assigning a row.
+        ring.samples[ring.count % self.capacity] = (timestamp.timestamp(), x, y, z, rotation, hp, mp)
+        ring.count += 1
+
+    def forget(self, actor_id: int):
+        self._rings.pop(actor_id, None)
+
+    def clear(self):
+        self._rings.clear()
+
+    def window(self, actor_id: int, start: typing.Optional[datetime.datetime] = None,
+               end: typing.Optional[datetime.datetime] = None) -> typing.Dict[str, 'numpy.ndarray']:
+        """Returns the samples of an actor taken in [start, end), oldest first, one array per column."""
+        ring = self._rings.get(actor_id)
+        samples = numpy.empty((0, len(HISTORY_COLUMNS))) if ring is None else ring.ordered()
+        samples = samples[self._mask(samples, _seconds(start), _seconds(end))]
+        return {name: samples[:, i].copy() for i, name in enumerate(HISTORY_COLUMNS)}
+
+    def window_all(self, start: typing.Optional[datetime.datetime] = None,
+                   end: typing.Optional[datetime.datetime] = None) -> typing.Dict[str, 'numpy.ndarray']:
+        """Same as window, for every actor at once; the actor_id column tells the samples apart."""
+        start_seconds, end_seconds = _seconds(start), _seconds(end)
+        actor_ids = []
+        parts = []
+        for actor_id, ring in self._rings.items():
+            samples = ring.ordered()
+            samples = samples[self._mask(samples, start_seconds, end_seconds)]
+            actor_ids.append(numpy.full(len(samples), actor_id, dtype=numpy.int64))
+            parts.append(samples)
+        samples = numpy.concatenate(parts) if parts else numpy.empty((0, len(HISTORY_COLUMNS)))
+        result = {"actor_id": numpy.concatenate(actor_ids) if actor_ids else numpy.empty(0, dtype=numpy.int64)}
+        result.update((name, samples[:, i].copy()) for i, name in enumerate(HISTORY_COLUMNS))
+        return result
+
+    @staticmethod
+    def _mask(samples: 'numpy.ndarray', start: typing.Optional[float], end: typing.Optional[float]) -> 'numpy.ndarray':
+        mask = numpy.ones(len(samples), dtype=bool)
+        if start is not None:
+            mask &= samples[:, 0] >= start
+        if end is not None:
+            mask &= samples[:, 0] < end
+        return mask
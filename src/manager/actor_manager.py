@@ -1,3 +1,4 @@
+import collections
 import dataclasses
 import datetime
 import itertools
@@ -5,6 +6,11 @@ import weakref
 
 import math
 
+from manager.actor_history import ActorHistory
+from manager.actor_store import ActorColumnStore, ColumnField
+from manager.events import PartyEvent, AllianceEvent, SpawnEvent, DespawnEvent, ZoneChangeEvent
+from manager.spatial import SpatialGrid, AoeShapeType
+from manager.status_expiry import StatusEffectScheduler
 from manager.stubs import IpcFeedTarget
 from pyxivdata.installation.resource_reader import GameResourceReader
 from pyxivdata.network.client_ipc import IpcRequestMove, IpcRequestMoveInstance
@@ -125,17 +131,93 @@ class Actor:
         return "".join(r)
 
 
+def _timestamp_state(timestamp: typing.Optional[datetime.datetime]) -> typing.Optional[str]:
+    return None if timestamp is None else timestamp.isoformat()
+
+
+def _timestamp_from_state(value: typing.Optional[str]) -> typing.Optional[datetime.datetime]:
+    return None if value is None else datetime.datetime.fromisoformat(value)
+
+
+def actor_state(actor: Actor) -> typing.Dict[str, typing.Any]:
+    # By field name, so that snapshots taken before a field was added still load.
+    state = {}
+    for field in dataclasses.fields(Actor):
+        value = getattr(actor, field.name)
+        if field.name == "last_updated_timestamp":
+            value = _timestamp_state(value)
+        elif field.name == "status_effects":
+            value = [[x.effect_id, x.param, _timestamp_state(x.expiry), x.source_actor_id] for x in value]
+        elif field.name == "outgoing_enmity_per_actor":
+            value = list(value.items())
+        state[field.name] = value
+    return state
+
+
+def load_actor_state(actor: Actor, state: typing.Dict[str, typing.Any]):
+    for field in dataclasses.fields(Actor):
+        if field.name == "id" or field.name not in state:
+            continue
+        value = state[field.name]
+        if field.name == "last_updated_timestamp":
+            value = _timestamp_from_state(value)
+        elif field.name == "status_effects":
+            value = [ActorStatusEffect(effect_id, param, _timestamp_from_state(expiry), source_actor_id)
+                     for effect_id, param, expiry, source_actor_id in value]
+        elif field.name == "outgoing_enmity_per_actor":
+            value = {actor_id: enmity for actor_id, enmity in value}
+        setattr(actor, field.name, value)
+
+
+DEFAULT_MAX_ACTORS = 4096
+DEFAULT_GRAVEYARD_SIZE = 1024
+
+
+class ColumnarActor(Actor):
+    """Actor whose position, rotation, hp, mp and class_job live in its slot of an ActorColumnStore."""
+    x = ColumnField("x")
+    y = ColumnField("y")
+    z = ColumnField("z")
+    rotation = ColumnField("rotation")
+    hp = ColumnField("hp")
+    max_hp = ColumnField("max_hp")
+    mp = ColumnField("mp")
+    class_job = ColumnField("class_job")
+
+    # noinspection PyShadowingBuiltins
+    def __init__(self, store: ActorColumnStore, id: int, **kwargs):
+        self._store = store
+        self._slot = store.allocate(id)
+        weakref.finalize(self, store.release, id, self._slot)
+        super().__init__(id, **kwargs)
+
+
 # noinspection DuplicatedCode
 class ActorManager(IpcFeedTarget):
-    __actors: typing.Union[typing.Dict[int, Actor], weakref.WeakValueDictionary]
+    """Keeps the actors currently around, least recently used first.
+
+    Despawned actors, and everyone left behind on a zone change, go to a graveyard of limited size, so that messages
+    arriving late about them still find them. Past max_actors, the least recently used actors are moved there too,
+    except for the player, and party and alliance members."""
+    __actors: typing.Dict[int, Actor]
 
     def __init__(self, resource_reader: GameResourceReader,
-                 server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes):
+                 server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes,
+                 actor_store: typing.Optional[ActorColumnStore] = None,
+                 max_actors: int = DEFAULT_MAX_ACTORS, graveyard_size: int = DEFAULT_GRAVEYARD_SIZE,
+                 history: typing.Optional[ActorHistory] = None):
         super().__init__(resource_reader, server_opcodes, client_opcodes)
+        self.__store = actor_store
+        self.__history = history
+        self.__grid = SpatialGrid()
+        self.__status_effects = StatusEffectScheduler()
+        self.__max_actors = max_actors
+        self.__graveyard_size = graveyard_size
         self.__root_actor = Actor(id=0xE0000000, name="(root)")
-        self.__actors = weakref.WeakValueDictionary({
+        self.__actors = collections.OrderedDict({
             0xE0000000: self.__root_actor,
         })
+        self.__graveyard: typing.Dict[int, Actor] = collections.OrderedDict()
         self.__player = None
         self.__party: typing.List[typing.Union[Actor, str]] = []
         self.__party_id: typing.Optional[int] = None
@@ -153,6 +235,7 @@ class ActorManager(IpcFeedTarget):
             actor.last_updated_timestamp = bundle_header.timestamp
             actor.hp = data.hp
             actor.mp = data.mp
+            self.__record_history(bundle_header.timestamp, actor)
 
         @self._server_opcode_handler(server_opcodes.PartyList)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcPartyList):
@@ -173,16 +256,20 @@ class ActorManager(IpcFeedTarget):
                     actor.class_job = member.class_job
                     actor.level = member.level
                     actor.name = member.name
+                    self.__record_history(bundle_header.timestamp, actor)
                     self.__party.append(actor)
 
-            print("Party: ", ",".join("-" if p is None else p.format(self._resource_reader) for p in self.__party))
+            if self._events.active:
+                self._events.publish(PartyEvent(bundle_header.timestamp, self.__party_id,
+                                                [None if p is None else p.id for p in self.__party]))
 
         @self._server_opcode_handler(server_opcodes.PartyModify)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcPartyModify):
             if data.party_size <= 1:
                 self.__party.clear()
                 self.__party_id = None
-                print("Party: -")
+                if self._events.active:
+                    self._events.publish(PartyEvent(bundle_header.timestamp, None, []))
 
         @self._server_opcode_handler(server_opcodes.AllianceList)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcAllianceList):
@@ -199,14 +286,17 @@ class ActorManager(IpcFeedTarget):
                 actor.max_hp = member.max_hp
                 actor.name = member.name
                 actor.home_world_id = member.home_world_id
+                self.__record_history(bundle_header.timestamp, actor)
 
-            print("Alliance: ", ",".join("-" if p is None else p.format(self._resource_reader) for p in self.__alliance))
+            if self._events.active:
+                self._events.publish(AllianceEvent(bundle_header.timestamp,
+                                                   [None if p is None else p.id for p in self.__alliance]))
 
         @self._server_opcode_handler(server_opcodes.ActorSpawn, server_opcodes.ActorSpawnNpc,
                                      server_opcodes.ActorSpawnNpc2)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader,
               data: typing.Union[IpcActorSpawn, IpcActorSpawnNpc]):
-            self.__spawns[data.spawn_id] = actor = self[header.actor_id]
+            self.__spawns[data.spawn_id] = actor = self.__revive(header.actor_id)
             if isinstance(data, IpcActorSpawn):
                 actor.home_world_id = data.home_world_id
             else:
@@ -225,11 +315,16 @@ class ActorManager(IpcFeedTarget):
             actor.mp = data.mp
             actor.update_status_effects_from_list(bundle_header.timestamp, data.status_effects,
                                                   self._resource_reader)
+            self.__track_status_effects(actor, range(len(data.status_effects)))
             actor.x = data.position_vector.x
             actor.y = data.position_vector.y
             actor.z = data.position_vector.z
             actor.rotation = data.rotation
-            # print("Spawn", actor.spawn_id, actor.name)
+            self.__grid.update(actor.id, data.position_vector.x, data.position_vector.y)
+            self.__record_history(bundle_header.timestamp, actor)
+            if self._events.active:
+                self._events.publish(SpawnEvent(bundle_header.timestamp, actor.id, data.spawn_id, data.name,
+                                                data.owner_id, data.bnpc_name, actor.x, actor.y, actor.z))
             if isinstance(data, IpcActorSpawn):
                 pass
             else:
@@ -239,7 +334,7 @@ class ActorManager(IpcFeedTarget):
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcActorDespawn):
             me = self[header.login_actor_id]
             msg = ["Despawn"]
-            actor = self.__actors.get(data.actor_id, None)
+            actor = self.get(data.actor_id)
             spawn = self.__spawns.get(data.spawn_id, None)
             if data.actor_id != 0:
                 if data.actor_id in self.__actors:
@@ -257,7 +352,10 @@ class ActorManager(IpcFeedTarget):
             if actor is not spawn:
                 breakpoint()
             del self.__spawns[spawn.spawn_id]
-            print(f"Despawn: {actor.format(self._resource_reader)}")
+            if self._events.active:
+                # Before burying, so that sinks still see the actor as it was.
+                self._events.publish(DespawnEvent(bundle_header.timestamp, data.actor_id, data.spawn_id))
+            self.__bury(spawn.id)
             pass  # TODO
 
         @self._server_opcode_handler(server_opcodes.ActorSetPos, server_opcodes.ActorMove)
@@ -270,6 +368,9 @@ class ActorManager(IpcFeedTarget):
             actor.y = data.position_vector.y
             actor.z = data.position_vector.z
             actor.rotation = data.rotation
+            if actor.id in self.__actors:  # [] hands out buried actors too, and the grid only holds live ones
+                self.__grid.update(actor.id, data.position_vector.x, data.position_vector.y)
+            self.__record_history(bundle_header.timestamp, actor)
 
         @self._server_opcode_handler(server_opcodes.ActorModelEquip)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcActorModelEquip):
@@ -296,13 +397,21 @@ class ActorManager(IpcFeedTarget):
         @self._server_opcode_handler(server_opcodes.InitZone)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcInitZone):
             self.__spawns.clear()
-            actor = self.__actors[header.login_actor_id]
+            self.__grid.clear()
+            keep = self.__pinned() | {header.login_actor_id}  # the player may not be known yet
+            for actor_id in [x for x in self.__actors if x not in keep]:
+                self.__bury(actor_id)
+            actor = self[header.login_actor_id]
             actor.last_updated_timestamp = bundle_header.timestamp
             actor.zone_id = data.zone_id
             actor.x = data.position_vector.x
             actor.y = data.position_vector.y
             actor.z = data.position_vector.z
-            print(f"Zone: {self._resource_reader.get_territory_name(data.zone_id)}")
+            if actor.id in self.__actors:  # as for movement
+                self.__grid.update(actor.id, data.position_vector.x, data.position_vector.y)
+            self.__record_history(bundle_header.timestamp, actor)
+            if self._events.active:
+                self._events.publish(ZoneChangeEvent(bundle_header.timestamp, data.zone_id))
 
         @self._server_opcode_handler(server_opcodes.EffectResult)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcEffectResult):
@@ -314,6 +423,8 @@ class ActorManager(IpcFeedTarget):
             actor.shield_ratio = data.shield_percentage / 100.
             actor.update_status_effects_from_modification_info(bundle_header.timestamp, data.entries[:data.entry_count],
                                                                self._resource_reader)
+            self.__track_status_effects(actor, (entry.index for entry in data.entries[:data.entry_count]))
+            self.__record_history(bundle_header.timestamp, actor)
 
         @self._server_opcode_handler(server_opcodes.ActorStatusEffectList, server_opcodes.ActorStatusEffectList2,
                                      server_opcodes.ActorStatusEffectListBoss)
@@ -329,6 +440,8 @@ class ActorManager(IpcFeedTarget):
             actor.shield_ratio = data.shield_percentage / 100.
             actor.update_status_effects_from_list(bundle_header.timestamp, data.effects,
                                                   self._resource_reader)
+            self.__track_status_effects(actor, range(len(data.effects)))
+            self.__record_history(bundle_header.timestamp, actor)
 
         @self._actor_control_handler
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: ActorControlClassJobChange):
@@ -348,12 +461,232 @@ class ActorManager(IpcFeedTarget):
             actor.last_updated_timestamp = bundle_header.timestamp
             actor.aggroed = data.aggroed
 
+    def begin_bundle(self, bundle_header: PacketHeader):
+        self.__status_effects.advance(bundle_header.timestamp)
+
     def __getitem__(self, actor_id: int) -> Actor:
         actor = self.__actors.get(actor_id, None)
+        if actor is not None:
+            self.__actors.move_to_end(actor_id)
+            return actor
+
+        actor = self.__graveyard.get(actor_id, None)
+        if actor is not None:
+            self.__graveyard.move_to_end(actor_id)
+            return actor
+
+        self.__actors[actor_id] = actor = self.__new_actor(actor_id)
+        if len(self.__actors) > self.__max_actors:
+            self.__evict()
+        return actor
+
+    def __new_actor(self, actor_id: int) -> Actor:
+        if self.__store is None:
+            return Actor(actor_id)
+        return ColumnarActor(self.__store, actor_id)
+
+    def get(self, actor_id: int) -> typing.Optional[Actor]:
+        # Unlike [], neither creates the actor nor counts as a use of it.
+        actor = self.__actors.get(actor_id, None)
+        if actor is None:
+            actor = self.__graveyard.get(actor_id, None)
+        return actor
+
+    def __contains__(self, actor_id: int) -> bool:
+        return actor_id in self.__actors
+
+    def __len__(self):
+        return len(self.__actors)
+
+    @property
+    def graveyard_size(self) -> int:
+        return len(self.__graveyard)
+
+    def __pinned(self) -> typing.Set[int]:
+        pinned = {self.__root_actor.id}
+        if self.__player is not None:
+            pinned.add(self.__player.id)
+        for actor in itertools.chain(self.__party, self.__alliance):
+            if isinstance(actor, Actor):
+                pinned.add(actor.id)
+        # Spawned actors must still be around when their despawn arrives.
+        pinned.update(actor.id for actor in self.__spawns.values())
+        return pinned
+
+    def __revive(self, actor_id: int) -> Actor:
+        actor = self.__graveyard.pop(actor_id, None)
         if actor is None:
-            self.__actors[actor_id] = actor = Actor(actor_id)
+            return self[actor_id]
+        self.__actors[actor_id] = actor
+        if len(self.__actors) > self.__max_actors:
+            self.__evict()
         return actor
 
+    def __record_history(self, timestamp: datetime.datetime, actor: Actor):
+        if self.__history is not None:
+            self.__history.record(timestamp, actor.id, actor.x, actor.y, actor.z, actor.rotation, actor.hp, actor.mp)
+
+    @property
+    def history(self) -> typing.Optional[ActorHistory]:
+        return self.__history
+
+    def __track_status_effects(self, actor: Actor, indices: typing.Iterable[int]):
+        for index in indices:
+            effect = actor.status_effects[index]
+            self.__status_effects.set(actor.id, index, effect.effect_id, effect.param, effect.source_actor_id,
+                                      effect.expiry)
+
+    @property
+    def status_effects(self) -> StatusEffectScheduler:
+        return self.__status_effects
+
+    def __bury(self, actor_id: int):
+        actor = self.__actors.pop(actor_id, None)
+        if actor is None:
+            return
+        self.__grid.remove(actor_id)
+        self.__status_effects.remove_actor(actor_id)
+        self.__graveyard[actor_id] = actor
+        self.__graveyard.move_to_end(actor_id)
+        while len(self.__graveyard) > self.__graveyard_size:
+            self.__graveyard.popitem(last=False)
+
+    def __evict(self):
+        pinned = self.__pinned()
+        excess = len(self.__actors) - self.__max_actors
+        victims = []
+        for actor_id in self.__actors:  # least recently used first
+            if len(victims) >= excess:
+                break
+            if actor_id not in pinned:
+                victims.append(actor_id)
+        for actor_id in victims:
+            self.__bury(actor_id)
+
+    @property
+    def actor_store(self) -> typing.Optional[ActorColumnStore]:
+        return self.__store
+
+    def __columns(self) -> ActorColumnStore:
+        if self.__store is None:
+            raise RuntimeError("Columnar queries need an ActorManager created with an actor_store")
+        return self.__store
+
+    def distance_matrix(self, actor_ids: typing.Optional[typing.Iterable[int]] = None,
+                        other_ids: typing.Optional[typing.Iterable[int]] = None
+                        ) -> typing.Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']:
+        """ActorColumnStore.distance_matrix; rows default to the actors currently around."""
+        return self.__columns().distance_matrix(list(self.__actors) if actor_ids is None else actor_ids, other_ids)
+
+    def hp_percentages(self, actor_ids: typing.Optional[typing.Iterable[int]] = None
+                       ) -> typing.Tuple['numpy.ndarray', 'numpy.ndarray']:
+        """ActorColumnStore.hp_percentages; defaults to the actors currently around."""
+        return self.__columns().hp_percentages(list(self.__actors) if actor_ids is None else actor_ids)
+
+    def ids_within_radius(self, x: float, y: float, radius: float) -> 'numpy.ndarray':
+        """Ids of the actors currently around within radius of (x, y), in one vectorized pass over the store."""
+        return self.__columns().within_radius(x, y, radius, list(self.__actors))
+
+    @property
+    def spatial_index(self) -> SpatialGrid:
+        return self.__grid
+
+    def _located(self, found: typing.List[typing.Tuple[int, float]],
+                 exclude: typing.Optional[Actor] = None) -> typing.List[typing.Tuple[Actor, float]]:
+        result = []
+        for actor_id, distance in found:
+            actor = self.__actors.get(actor_id)
+            if actor is not None and actor is not exclude:
+                result.append((actor, distance))
+        return result
+
+    def actors_within_radius(self, center: Actor, radius: float) -> typing.List[Actor]:
+        """Returns every other actor within radius of center."""
+        if center.x is None:
+            return []
+        return [actor for actor, _ in self._located(self.__grid.within_radius(center.x, center.y, radius), center)]
+
+    def nearest_actors(self, center: Actor, count: int,
+                       max_radius: typing.Optional[float] = None) -> typing.List[typing.Tuple[Actor, float]]:
+        """Returns (actor, distance) of up to count other actors closest to center, closest first."""
+        if center.x is None:
+            return []
+        # One more, for center itself.
+        return self._located(self.__grid.nearest(center.x, center.y, count + 1, max_radius), center)[:count]
+
+    def actors_in_aoe(self, center: Actor, shape: AoeShapeType,
+                      rotation: typing.Optional[float] = None) -> typing.List[typing.Tuple[Actor, float]]:
+        """Returns (actor, distance) of every other actor inside shape, placed at center and facing its rotation unless
+        given another one."""
+        if center.x is None:
+            return []
+        if rotation is None:
+            rotation = center.rotation or 0.
+        return self._located(self.__grid.within_shape(center.x, center.y, rotation, shape), center)
+
+    def export_state(self) -> typing.Dict[str, typing.Any]:
+        # Spawned actors, and the player, party and alliance members, may have dropped out of the table and graveyard
+        # while still being referred to; those are kept aside as detached.
+        detached: typing.Dict[int, Actor] = {}
+
+        def ref(actor: typing.Optional[Actor]) -> typing.Optional[int]:
+            if actor is None:
+                return None
+            if self.__actors.get(actor.id) is not actor and self.__graveyard.get(actor.id) is not actor:
+                detached[actor.id] = actor
+            return actor.id
+
+        state = {
+            "actors": [actor_state(x) for x in self.__actors.values()],
+            "graveyard": [actor_state(x) for x in self.__graveyard.values()],
+            "player": ref(self.__player),
+            "party": [ref(x) for x in self.__party],
+            "party_id": self.__party_id,
+            "alliance": [ref(x) for x in self.__alliance],
+            "spawns": [[spawn_id, ref(x)] for spawn_id, x in self.__spawns.items()],
+            "spatial_index": [actor_id for actor_id in self.__actors if actor_id in self.__grid],
+            "status_effects_now": _timestamp_state(self.__status_effects.now),
+            "status_effects": [
+                [x.actor_id, x.index, x.effect_id, x.param, x.source_actor_id, _timestamp_state(x.expiry)]
+                for x in self.__status_effects.active()
+            ],
+        }
+        state["detached"] = [actor_state(x) for x in detached.values()]
+        return state
+
+    def import_state(self, state: typing.Dict[str, typing.Any]):
+        def load(actor_state_: typing.Dict[str, typing.Any]) -> Actor:
+            actor_id = actor_state_["id"]
+            actor = self.__root_actor if actor_id == self.__root_actor.id else self.__new_actor(actor_id)
+            load_actor_state(actor, actor_state_)
+            return actor
+
+        self.__actors = collections.OrderedDict((x["id"], load(x)) for x in state["actors"])
+        self.__actors.setdefault(self.__root_actor.id, self.__root_actor)
+        self.__graveyard = collections.OrderedDict((x["id"], load(x)) for x in state["graveyard"])
+        detached = {x["id"]: load(x) for x in state["detached"]}
+
+        def deref(actor_id: typing.Optional[int]) -> typing.Optional[Actor]:
+            if actor_id is None:
+                return None
+            return self.__actors.get(actor_id) or self.__graveyard.get(actor_id) or detached[actor_id]
+
+        self.__player = deref(state["player"])
+        self.__party = [deref(x) for x in state["party"]]
+        self.__party_id = state["party_id"]
+        self.__alliance = [deref(x) for x in state["alliance"]]
+        self.__spawns = {spawn_id: deref(actor_id) for spawn_id, actor_id in state["spawns"]}
+
+        self.__grid.clear()
+        for actor_id in state["spatial_index"]:
+            actor = self.__actors[actor_id]
+            self.__grid.update(actor_id, actor.x, actor.y)
+
+        self.__status_effects.clear()
+        self.__status_effects.now = _timestamp_from_state(state["status_effects_now"])
+        for actor_id, index, effect_id, param, source_actor_id, expiry in state["status_effects"]:
+            self.__status_effects.set(actor_id, index, effect_id, param, source_actor_id, _timestamp_from_state(expiry))
+
     @property
     def party(self) -> typing.Sequence[typing.Union[Actor, str]]:
         return tuple(self.__party)
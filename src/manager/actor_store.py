@@ -0,0 +1,123 @@
+import typing
+
+try:
+    import numpy
+except ImportError:  # optional; only needed for the columnar actor store
+    numpy = None
+
+# Float columns are float64 and hold NaN for None; integer ones are int64 and hold MISSING for None.
+FLOAT_COLUMNS = ("x", "y", "z", "rotation")
+INT_COLUMNS = ("hp", "max_hp", "mp", "class_job")
+COLUMNS = FLOAT_COLUMNS + INT_COLUMNS
+
+FREE_SLOT = -1
+MISSING = -(1 << 63)  # lowest int64; none of the integer columns can be negative otherwise
+
+
+def _empty_column(name: str, size: int) -> 'numpy.ndarray':
+    if name in INT_COLUMNS:
+        return numpy.full(size, MISSING, dtype=numpy.int64)
+    return numpy.full(size, numpy.nan, dtype=numpy.float64)
+
+
+class ActorColumnStore:
+    """Keeps position, rotation, hp/max_hp, mp and class_job of every actor in NumPy columns, one slot per actor, so
+    that questions about all actors at once run vectorized."""
+
+    def __init__(self, capacity: int = 1024):
+        if numpy is None:
+            raise RuntimeError("The columnar actor store needs NumPy")
+        self._capacity = capacity
+        self.ids = numpy.full(capacity, FREE_SLOT, dtype=numpy.int64)
+        self.columns: typing.Dict[str, 'numpy.ndarray'] = {name: _empty_column(name, capacity) for name in COLUMNS}
+        self._slots: typing.Dict[int, int] = {}
+        self._free: typing.List[int] = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _grow(self):
+        old = self._capacity
+        self._capacity *= 2
+        self.ids = numpy.concatenate([self.ids, numpy.full(old, FREE_SLOT, dtype=numpy.int64)])
+        for name, column in self.columns.items():
+            self.columns[name] = numpy.concatenate([column, _empty_column(name, old)])
+        self._free.extend(range(self._capacity - 1, old - 1, -1))
+
+    def allocate(self, actor_id: int) -> int:
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        self.ids[slot] = actor_id
+        for name, column in self.columns.items():
+            column[slot] = MISSING if name in INT_COLUMNS else numpy.nan
+        self._slots[actor_id] = slot
+        return slot
+
+    def release(self, actor_id: int, slot: int):
+        if self._slots.get(actor_id) != slot:
+            return  # already taken over by a newer actor with the same id
+        del self._slots[actor_id]
+        self.ids[slot] = FREE_SLOT
+        self._free.append(slot)
+
+    def slot_of(self, actor_id: int) -> typing.Optional[int]:
+        return self._slots.get(actor_id)
+
+    def get(self, slot: int, name: str) -> typing.Union[int, float, None]:
+        value = self.columns[name][slot]
+        if name in INT_COLUMNS:
+            return None if value == MISSING else int(value)
+        return None if value != value else float(value)
+
+    def set(self, slot: int, name: str, value: typing.Union[int, float, None]):
+        if value is None:
+            value = MISSING if name in INT_COLUMNS else numpy.nan
+        self.columns[name][slot] = value
+
+    def _slots_for(self, actor_ids: typing.Iterable[int]) -> 'numpy.ndarray':
+        # Slots also outlive their actors' stay in ActorManager (graveyard, eviction), so callers say who to look at;
+        # ids without a slot are left out.
+        slots = self._slots
+        return numpy.fromiter((slots[x] for x in actor_ids if x in slots), dtype=numpy.intp)
+
+    def distance_matrix(self, actor_ids: typing.Iterable[int], other_ids: typing.Optional[typing.Iterable[int]] = None
+                        ) -> typing.Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']:
+        """Returns (row ids, column ids, distances) on the x/y plane, as Actor.distance; NaN where a position is not
+        known. Columns default to the same actors as rows."""
+        rows = self._slots_for(actor_ids)
+        cols = rows if other_ids is None else self._slots_for(other_ids)
+        x, y = self.columns["x"], self.columns["y"]
+        distances = numpy.hypot(x[rows, None] - x[None, cols], y[rows, None] - y[None, cols])
+        return self.ids[rows], self.ids[cols], distances
+
+    def within_radius(self, x: float, y: float, radius: float, actor_ids: typing.Iterable[int]) -> 'numpy.ndarray':
+        """Returns the ids of those actors whose x/y position is within radius of (x, y)."""
+        slots = self._slots_for(actor_ids)
+        dx = self.columns["x"][slots] - x
+        dy = self.columns["y"][slots] - y
+        return self.ids[slots[dx * dx + dy * dy <= radius * radius]]
+
+    def hp_percentages(self, actor_ids: typing.Iterable[int]) -> typing.Tuple['numpy.ndarray', 'numpy.ndarray']:
+        """Returns (ids, hp / max_hp * 100); NaN where either is not known or max_hp is 0."""
+        slots = self._slots_for(actor_ids)
+        hp = self.columns["hp"][slots]
+        max_hp = self.columns["max_hp"][slots]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            percentages = numpy.where((hp != MISSING) & (max_hp > 0), hp / max_hp * 100., numpy.nan)
+        return self.ids[slots], percentages
+
+
+class ColumnField:
+    """Actor attribute living in the actor's slot of its ActorColumnStore."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._store.get(instance._slot, self._name)
+
+    def __set__(self, instance, value):
+        instance._store.set(instance._slot, self._name, value)
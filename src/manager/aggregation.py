@@ -0,0 +1,158 @@
+import bisect
+import dataclasses
+import datetime
+import typing
+
+DAMAGE = "damage"
+HEAL = "heal"
+
+DIMENSION_SOURCE = "source"
+DIMENSION_OWNER = "owner"  # pets and other owned actors counted along with their owner
+DIMENSION_ACTION = "action"  # ("action", action id) for effects, ("status", status effect id) for over time ones
+DIMENSION_TARGET = "target"
+DIMENSIONS = (DIMENSION_SOURCE, DIMENSION_OWNER, DIMENSION_ACTION, DIMENSION_TARGET)
+
+DEFAULT_WINDOWS = (1., 10., 60.)  # seconds
+
+ROOT_ACTOR_ID = 0xE0000000
+
+
+@dataclasses.dataclass
+class AggregateRow:
+    key: typing.Hashable
+    total: int
+    count: int
+    per_second: typing.Dict[float, float]  # by window
+
+
+class _Series:
+    """Running total, and sums over the last few windows of time. Events stay in a list, in time order, until they fall
+    out of the longest window; each window keeps the index of its oldest event, so adding or expiring one is O(1).
+
+    An event older than the latest one (now) is counted in the total, but only in the windows it is still inside as of
+    now, and is not kept at all when it is out of all of them."""
+    __slots__ = ("total", "count", "times", "amounts", "starts", "sums")
+
+    def __init__(self, window_count: int):
+        self.total = 0
+        self.count = 0
+        self.times: typing.List[float] = []
+        self.amounts: typing.List[int] = []
+        self.starts = [0] * window_count
+        self.sums = [0] * window_count
+
+    def add(self, time: float, now: float, amount: int, windows: typing.Sequence[float]):
+        self.total += amount
+        self.count += 1
+        self.expire(now, windows)
+        if time <= now - windows[-1]:
+            return
+
+        times, starts, sums = self.times, self.starts, self.sums
+        if not times or time >= times[-1]:
+            position = len(times)
+        else:
+            position = bisect.bisect_right(times, time, starts[-1])
+        times.insert(position, time)
+        self.amounts.insert(position, amount)
+        for i, window in enumerate(windows):
+            if time > now - window:
+                sums[i] += amount
+            else:
+                starts[i] += 1  # in front of this window's oldest event, which has moved up by one
+
+    def sums_at(self, now: float, windows: typing.Sequence[float]) -> typing.List[int]:
+        """Window sums as of a time no earlier than the latest event, leaving the series as it is."""
+        times, amounts = self.times, self.amounts
+        sums = []
+        for window, start, total in zip(windows, self.starts, self.sums):
+            end = bisect.bisect_right(times, now - window, start)
+            sums.append(total - sum(amounts[start:end]))
+        return sums
+
+    def expire(self, now: float, windows: typing.Sequence[float]):
+        times, amounts, starts, sums = self.times, self.amounts, self.starts, self.sums
+        for i, window in enumerate(windows):
+            start = starts[i]
+            cutoff = now - window
+            while start < len(times) and times[start] <= cutoff:
+                sums[i] -= amounts[start]
+                start += 1
+            starts[i] = start
+
+        # Windows are sorted, so the longest one holds on to the oldest event.
+        oldest = starts[-1]
+        if oldest > 64 and oldest * 2 > len(times):
+            del times[:oldest], amounts[:oldest]
+            for i in range(len(starts)):
+                starts[i] -= oldest
+
+
+class EffectAggregator:
+    """Damage and healing totals, and per second rates over sliding windows, by source, owner, action and target."""
+
+    def __init__(self, windows: typing.Sequence[float] = DEFAULT_WINDOWS):
+        self.windows = tuple(sorted(windows))
+        self._series: typing.Dict[str, typing.Dict[str, typing.Dict[typing.Hashable, _Series]]] = {
+            kind: {dimension: {} for dimension in DIMENSIONS} for kind in (DAMAGE, HEAL)
+        }
+        self.now: typing.Optional[float] = None
+
+    def reset(self):
+        for by_dimension in self._series.values():
+            for by_key in by_dimension.values():
+                by_key.clear()
+        self.now = None
+
+    def add(self, timestamp: datetime.datetime, kind: str, amount: int, source_id: typing.Optional[int],
+            owner_id: typing.Optional[int], action_key: typing.Hashable, target_id: int):
+        time = timestamp.timestamp()
+        if self.now is None or time > self.now:
+            self.now = time
+
+        by_dimension = self._series[kind]
+        keys = [(DIMENSION_ACTION, action_key), (DIMENSION_TARGET, target_id)]
+        if source_id is not None:
+            keys.append((DIMENSION_SOURCE, source_id))
+            keys.append((DIMENSION_OWNER, source_id if owner_id in (None, 0, ROOT_ACTOR_ID) else owner_id))
+        for dimension, key in keys:
+            series = by_dimension[dimension].get(key)
+            if series is None:
+                series = by_dimension[dimension][key] = _Series(len(self.windows))
+            series.add(time, self.now, amount, self.windows)
+
+    def export_state(self) -> typing.Dict[str, typing.Any]:
+        # Only the events still inside the longest window are kept; that is all the rates need.
+        series_state = []
+        for kind, by_dimension in self._series.items():
+            for dimension, by_key in by_dimension.items():
+                for key, series in by_key.items():
+                    if self.now is not None:
+                        series.expire(self.now, self.windows)
+                    oldest = series.starts[-1]
+                    series_state.append([kind, dimension, list(key) if isinstance(key, tuple) else key,
+                                         series.total, series.count, series.times[oldest:], series.amounts[oldest:]])
+        return {"now": self.now, "series": series_state}
+
+    def import_state(self, state: typing.Dict[str, typing.Any]):
+        self.reset()
+        self.now = state["now"]
+        for kind, dimension, key, total, count, times, amounts in state["series"]:
+            series = _Series(len(self.windows))
+            series.total, series.count, series.times, series.amounts = total, count, times, amounts
+            series.sums = [sum(amounts)] * len(self.windows)
+            if self.now is not None:
+                series.expire(self.now, self.windows)
+            self._series[kind][dimension][tuple(key) if isinstance(key, list) else key] = series
+
+    def snapshot(self, dimension: str, kind: str = DAMAGE, now: typing.Optional[datetime.datetime] = None,
+                 top: typing.Optional[int] = None) -> typing.List[AggregateRow]:
+        """Rows of a dimension as of now (default: the latest event), highest total first."""
+        now_seconds = self.now if now is None else now.timestamp()
+        rows = []
+        for key, series in self._series[kind][dimension].items():
+            sums = series.sums if now_seconds is None else series.sums_at(now_seconds, self.windows)
+            rows.append(AggregateRow(key, series.total, series.count,
+                                     {window: total / window for window, total in zip(self.windows, sums)}))
+        rows.sort(key=lambda x: x.total, reverse=True)
+        return rows[:top]
@@ -0,0 +1,248 @@
+import ctypes
+import functools
+import operator
+import struct
+import typing
+
+from pyxivdata.network import server_ipc
+from pyxivdata.network.common import IpcStructure
+
+# Most of the traffic; worth trading ctypes descriptor access for one struct.unpack_from per message. The Effect*
+# family is busy as well, but it is mostly arrays that handlers only partly read, and from_buffer is lazy about those;
+# bench_decode.py has it slower when decoded up front. Decoded ActorControl* messages go into the actor control
+# wrappers as they are; bench_decode.py also checks that every wrapper reads the same out of them as out of ctypes.
+HOT_SERVER_OPCODE_FIELDS = (
+    "ActorMove", "ActorSetPos", "EffectResult", "ActorStats",
+    "ActorControl", "ActorControlSelf", "ActorControlTarget",
+)
+
+_STRUCTURE_BASES = (ctypes.Structure, ctypes.LittleEndianStructure, ctypes.BigEndianStructure)
+_SKIPPED_ATTRIBUTES = {"_fields_", "_pack_", "_anonymous_", "_swappedbytes_", "__dict__", "__weakref__", "__module__",
+                       "__qualname__", "__slots__", "__init__", "__new__"}
+_INTEGER_CODES = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+# Scalar arrays up to this long are unpacked along with the rest; longer ones, and arrays of anything else, are kept
+# as bytes and only decoded when read.
+MAX_INLINE_ARRAY_LENGTH = 16
+
+# Given the index of the first value of a field in the tuple of unpacked values, makes the function reading the field
+# back out of that tuple.
+GetterFactoryType = typing.Callable[[int], typing.Callable[[tuple], typing.Any]]
+
+
+class UnsupportedStructure(TypeError):
+    pass
+
+
+class ArrayView(tuple):
+    """Stands in for a ctypes array of structures or arrays; elements are decoded when they are asked for.
+
+    Made as a (raw, start, stride, length, read) tuple, which is cheaper to create than an object with an __init__."""
+    __slots__ = ()
+
+    def __len__(self):
+        return tuple.__getitem__(self, 3)
+
+    def __getitem__(self, index):
+        raw, start, stride, length, read = tuple.__iter__(self)
+        if isinstance(index, slice):
+            return [read(raw, start + i * stride) for i in range(*index.indices(length))]
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("invalid index")
+        return read(raw, start + index * stride)
+
+    def __iter__(self):
+        raw, start, stride, length, read = tuple.__iter__(self)
+        for i in range(length):
+            yield read(raw, start + i * stride)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"[{', '.join(repr(x) for x in self)}]"
+
+
+def _fields(cls: typing.Type[ctypes.Structure]) -> typing.List[typing.Tuple[str, typing.Any]]:
+    if cls.__dict__.get("_anonymous_"):
+        raise UnsupportedStructure(f"{cls.__name__}: anonymous fields")
+    fields = []
+    for base in reversed(cls.__mro__):
+        for field in base.__dict__.get("_fields_", ()):
+            if len(field) != 2:
+                raise UnsupportedStructure(f"{cls.__name__}.{field[0]}: bit fields")
+            fields.append(field)
+    return fields
+
+
+def _scalar_code(t: typing.Any) -> str:
+    code = getattr(t, "_type_", None)
+    if not isinstance(code, str):
+        raise UnsupportedStructure(f"{t!r}")
+    if code in "fd?c":
+        return code
+    if code in "bhilq":
+        return _INTEGER_CODES[ctypes.sizeof(t)]
+    if code in "BHILQ":
+        return _INTEGER_CODES[ctypes.sizeof(t)].upper()
+    raise UnsupportedStructure(f"{t!r}")
+
+
+def _endian(cls: typing.Type[ctypes.Structure]) -> str:
+    if issubclass(cls, ctypes.BigEndianStructure):
+        return ">"
+    if issubclass(cls, ctypes.LittleEndianStructure):
+        return "<"
+    return "="
+
+
+def _array_reader(t: typing.Type[ctypes.Array], endian: str) -> typing.Callable[[bytes, int], typing.Any]:
+    element = t._type_
+    length = t._length_
+    element_size = ctypes.sizeof(element)
+    if element is ctypes.c_char:
+        return lambda raw, offset: raw[offset:offset + length].split(b"\0", 1)[0]
+    if isinstance(element, type) and issubclass(element, _STRUCTURE_BASES):
+        read_element = fast_class(element).from_buffer
+        return lambda raw, offset: tuple.__new__(ArrayView, (raw, offset, element_size, length, read_element))
+    if isinstance(element, type) and issubclass(element, ctypes.Array):
+        read_element = _array_reader(element, endian)
+        return lambda raw, offset: tuple.__new__(ArrayView, (raw, offset, element_size, length, read_element))
+    if isinstance(element, type) and issubclass(element, ctypes.Union):
+        raise UnsupportedStructure(f"{element!r}: unions")
+    return struct.Struct(f"{endian}{length}{_scalar_code(element)}").unpack_from
+
+
+def _layout(t: typing.Any, offset: int,
+            endian: str) -> typing.Tuple[typing.List[typing.Tuple[int, str]], GetterFactoryType]:
+    """Returns the (offset, struct code) of every value making up a field of type t, and how to read the field back
+    out of the unpacked values, the way ctypes would return it."""
+    if isinstance(t, type) and issubclass(t, _STRUCTURE_BASES):
+        fast_type = fast_class(t)
+        leaves = [(offset + x, code) for x, code in fast_type._layout_]
+        width = len(leaves)
+        return leaves, lambda i: lambda values: tuple.__new__(fast_type, values[i:i + width])
+
+    if isinstance(t, type) and issubclass(t, ctypes.Union):
+        raise UnsupportedStructure(f"{t!r}: unions")
+
+    if isinstance(t, type) and issubclass(t, ctypes.Array):
+        element = t._type_
+        length = t._length_
+        if element is ctypes.c_char:
+            # ctypes hands out char arrays as bytes cut at the first NUL.
+            return [(offset, f"{length}s")], lambda i: lambda values: values[i].split(b"\0", 1)[0]
+
+        if length <= MAX_INLINE_ARRAY_LENGTH and not issubclass(element, (ctypes.Array, ctypes.Union) + _STRUCTURE_BASES):
+            code = _scalar_code(element)
+            element_size = ctypes.sizeof(element)
+            return ([(offset + i * element_size, code) for i in range(length)],
+                    lambda i: lambda values: values[i:i + length])
+
+        read_array = _array_reader(t, endian)
+        return [(offset, f"{ctypes.sizeof(t)}s")], lambda i: lambda values: read_array(values[i], 0)
+
+    return [(offset, _scalar_code(t))], operator.itemgetter
+
+
+def _struct_format(cls: typing.Type[ctypes.Structure], leaves: typing.List[typing.Tuple[int, str]]) -> str:
+    fmt = [_endian(cls)]
+
+    position = 0
+    for offset, code in sorted(leaves):
+        if offset < position:
+            raise UnsupportedStructure(f"{cls.__name__}: overlapping fields")
+        if offset > position:
+            fmt.append(f"{offset - position}x")
+        fmt.append(code)
+        position = offset + struct.calcsize(f"<{code}")
+    if position < ctypes.sizeof(cls):
+        fmt.append(f"{ctypes.sizeof(cls) - position}x")
+    return "".join(fmt)
+
+
+@functools.lru_cache(maxsize=None)
+def fast_class(cls: typing.Type[ctypes.Structure]) -> type:
+    """Returns a tuple subclass standing in for cls: from_buffer decodes all of it with a single struct.unpack_from.
+
+    Fields are read through properties, and come out the way ctypes would return them; everything else cls defines
+    (properties, methods, constants) is carried over. Instances do not refer to the buffer they were decoded from."""
+    namespace = {}
+    for base in reversed(cls.__mro__):
+        if base is object or base.__module__ in ("ctypes", "_ctypes"):
+            continue
+        for k, v in vars(base).items():
+            if k in _SKIPPED_ATTRIBUTES or type(v).__name__ == "CField":
+                continue
+            namespace[k] = v
+
+    leaves = []
+    field_names = []
+    for name, t in _fields(cls):
+        field_leaves, getter_factory = _layout(t, getattr(cls, name).offset, _endian(cls))
+        namespace[name] = property(getter_factory(len(leaves)))
+        leaves.extend(field_leaves)
+        field_names.append(name)
+
+    if [x for x, _ in leaves] != sorted(x for x, _ in leaves):
+        raise UnsupportedStructure(f"{cls.__name__}: fields out of order")
+
+    unpacker = struct.Struct(_struct_format(cls, leaves))
+    unpack_from = unpacker.unpack_from
+    size = unpacker.size
+
+    def from_buffer(buffer, offset: int = 0):
+        if len(buffer) - offset < size:
+            raise ValueError(f"Buffer size too small ({len(buffer) - offset} instead of at least {size} bytes)")
+        return tuple.__new__(fast_type, unpack_from(buffer, offset))
+
+    namespace.update({
+        "__slots__": (),
+        "_ctypes_type_": cls,
+        "_layout_": tuple(leaves),
+        "struct": unpacker,
+        "from_buffer": staticmethod(from_buffer),
+        "from_buffer_copy": staticmethod(from_buffer),
+    })
+    namespace.setdefault("__repr__", lambda self: f"{type(self).__name__}(" + ", ".join(
+        f"{k}={getattr(self, k)!r}" for k in field_names) + ")")
+    fast_type = type(cls.__name__, (tuple,), namespace)
+    return fast_type
+
+
+def structure_bytes(value: typing.Any) -> typing.Tuple[typing.Type[ctypes.Structure], bytes]:
+    """Returns the ctypes type of a decoded structure, fast or not, and the bytes it would be decoded from again."""
+    ctypes_type = getattr(type(value), "_ctypes_type_", None)
+    if ctypes_type is None:
+        return type(value), bytes(value)
+    # Fast instances are the very values unpacked; padding comes back as zeroes.
+    return ctypes_type, type(value).struct.pack(*value)
+
+
+def compile_decoders(types: typing.Iterable[typing.Type[ctypes.Structure]]) -> typing.Dict[type, type]:
+    # Structures using what struct cannot express (bit fields, unions, pointers...) stay with ctypes.
+    decoders = {}
+    for t in types:
+        try:
+            decoders[t] = fast_class(t)
+        except UnsupportedStructure:
+            pass
+    return decoders
+
+
+@functools.lru_cache(maxsize=None)
+def server_decoders(opcode_fields: typing.Tuple[str, ...]) -> typing.Dict[type, type]:
+    return compile_decoders(
+        t for t in vars(server_ipc).values()
+        if isinstance(t, type) and issubclass(t, IpcStructure) and t.OPCODE_FIELD in opcode_fields)
+
+
+def hot_server_decoders() -> typing.Dict[type, type]:
+    return server_decoders(HOT_SERVER_OPCODE_FIELDS)
@@ -0,0 +1,156 @@
+import collections
+import ctypes
+import time
+import typing
+
+from manager.metrics import DispatchMetrics, DIRECTION_SERVER, DIRECTION_CLIENT, DIRECTION_ACTOR_CONTROL, callback_name
+from manager.stubs import IpcFeedTarget, IpcCallbackType, SupportedIpcDataTypes, ActorControlCallbackType
+from pyxivdata.network.packet import PacketHeader, MessageHeader, IpcMessageHeader
+from pyxivdata.network.server_ipc.actor_control import ActorControlBase
+
+# The last item of each entry is the name of the callback in dispatch metrics, worked out once when building the table.
+ActorControlTableType = typing.Dict[int, typing.Tuple[typing.Tuple[ActorControlCallbackType,
+                                                                   typing.Type[ActorControlBase], str], ...]]
+# Plain handlers have no actor control table; ActorControl* dispatch entries carry the table of their target.
+DispatchEntryType = typing.Tuple[IpcCallbackType, SupportedIpcDataTypes, typing.Optional[ActorControlTableType], str]
+DispatchTableType = typing.Dict[int, typing.Tuple[DispatchEntryType, ...]]
+
+
+class IpcDispatcher:
+    """Feeds messages to any number of IpcFeedTargets in one pass, calling handlers in the same order as feeding each
+    target in turn would. Headers are parsed once per message, and each structure is decoded once per message."""
+
+    def __init__(self, *targets: IpcFeedTarget, decoders: typing.Optional[typing.Dict[type, type]] = None):
+        self._targets: typing.List[IpcFeedTarget] = []
+        # Structure types to decode with something else instead, such as the ones from decoders.compile_decoders.
+        self._decoders = decoders or {}
+        self._server_table: typing.Optional[DispatchTableType] = None
+        self._client_table: typing.Optional[DispatchTableType] = None
+        self._bundle_header: typing.Optional[PacketHeader] = None
+        self.metrics: typing.Optional[DispatchMetrics] = None
+        for target in targets:
+            self.add_target(target)
+
+    def add_target(self, target: IpcFeedTarget):
+        self._targets.append(target)
+        target.add_handler_listener(self._invalidate)
+        self._invalidate()
+
+    def set_metrics(self, metrics: typing.Optional[DispatchMetrics]):
+        if metrics is not None:
+            for target in self._targets:
+                for known_type, callbacks in target.actor_control_handlers().items():
+                    metrics.name_actor_control(known_type, callbacks[0][1].__name__)
+        self.metrics = metrics
+
+    def _invalidate(self):
+        self._server_table = self._client_table = None
+
+    def _build_table(self, server: bool) -> DispatchTableType:
+        table: typing.Dict[int, typing.List[DispatchEntryType]] = collections.defaultdict(list)
+        for target in self._targets:
+            type2_map = target.server_handlers() if server else target.client_handlers()
+            # A target only sees catch-all handler calls for the opcodes it has a specific handler for.
+            wildcards = [(cb, data_type, None, callback_name(cb)) for cb, data_type in type2_map.get(None, ())]
+            for opcode, callbacks in type2_map.items():
+                if opcode is None or not callbacks:
+                    continue
+                for cb, data_type in callbacks:
+                    data_type = self._decoders.get(data_type, data_type)
+                    if server and cb is target.actor_control_dispatch:
+                        actor_control_table = {
+                            k: tuple((x, t, callback_name(x)) for x, t in v)
+                            for k, v in target.actor_control_handlers().items() if v
+                        }
+                        if actor_control_table:
+                            table[opcode].append((cb, data_type, actor_control_table, callback_name(cb)))
+                    else:
+                        table[opcode].append((cb, data_type, None, callback_name(cb)))
+                table[opcode].extend(wildcards)
+        return {k: tuple(v) for k, v in table.items() if v}
+
+    def feed_from_server(self, bundle_header: PacketHeader, data: typing.Union[bytearray, memoryview]):
+        if self._server_table is None:
+            self._server_table = self._build_table(True)
+        self._feed(bundle_header, data, self._server_table, DIRECTION_SERVER)
+
+    def feed_from_client(self, bundle_header: PacketHeader, data: typing.Union[bytearray, memoryview]):
+        if self._client_table is None:
+            self._client_table = self._build_table(False)
+        self._feed(bundle_header, data, self._client_table, DIRECTION_CLIENT)
+
+    def _feed(self, bundle_header: PacketHeader, data: typing.Union[bytearray, memoryview],
+              table: DispatchTableType, direction: str):
+        if bundle_header is not self._bundle_header:
+            # Messages of a bundle all come with the same header.
+            self._bundle_header = bundle_header
+            for target in self._targets:
+                target.begin_bundle(bundle_header)
+
+        if self.metrics is not None:
+            self.metrics.count_message(direction, data)
+
+        if MessageHeader.from_buffer(data).type != MessageHeader.TYPE_IPC:
+            return
+
+        header = IpcMessageHeader.from_buffer(data)
+        if header.type1 != IpcMessageHeader.TYPE1_IPC:
+            return
+
+        entries = table.get(header.type2)
+        if entries is None:
+            return
+
+        body = memoryview(data)[ctypes.sizeof(header):header.size]
+        if self.metrics is not None:
+            return self._feed_measured(bundle_header, header, body, entries, direction)
+
+        decoded = {None: body}
+        for cb, data_type, actor_control_table, _ in entries:
+            ipc = decoded.get(data_type)
+            if ipc is None:
+                ipc = decoded[data_type] = data_type.from_buffer(body)
+
+            if actor_control_table is None:
+                cb(bundle_header, header, ipc)
+                continue
+
+            for actor_control_cb, actor_control_type, _ in actor_control_table.get(ipc.known_type, ()):
+                actor_control = decoded.get(actor_control_type)
+                if actor_control is None:
+                    actor_control = decoded[actor_control_type] = actor_control_type(ipc)
+                actor_control_cb(bundle_header, header, actor_control)
+
+    def _feed_measured(self, bundle_header: PacketHeader, header: IpcMessageHeader, body: memoryview,
+                       entries: typing.Tuple[DispatchEntryType, ...], direction: str):
+        metrics = self.metrics
+        stats = metrics.get(direction, header.type2)
+        decoded = {None: body}
+        for cb, data_type, actor_control_table, name in entries:
+            ipc = decoded.get(data_type)
+            if ipc is None:
+                t0 = time.perf_counter()
+                ipc = decoded[data_type] = data_type.from_buffer(body)
+                metrics.add_decode(stats, time.perf_counter() - t0)
+
+            if actor_control_table is None:
+                t0 = time.perf_counter()
+                cb(bundle_header, header, ipc)
+                metrics.add_callback(stats, name, time.perf_counter() - t0)
+                continue
+
+            # The ActorControl* handler itself is not timed: its time is that of the handlers below, counted as
+            # actor_control, and counting it again under the opcode would count it twice in the totals.
+            actor_control_entries = actor_control_table.get(ipc.known_type, ())
+            if not actor_control_entries:
+                continue
+            actor_control_stats = metrics.get(DIRECTION_ACTOR_CONTROL, ipc.known_type)
+            for actor_control_cb, actor_control_type, actor_control_name in actor_control_entries:
+                actor_control = decoded.get(actor_control_type)
+                if actor_control is None:
+                    t0 = time.perf_counter()
+                    actor_control = decoded[actor_control_type] = actor_control_type(ipc)
+                    metrics.add_decode(actor_control_stats, time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                actor_control_cb(bundle_header, header, actor_control)
+                metrics.add_callback(actor_control_stats, actor_control_name, time.perf_counter() - t0)
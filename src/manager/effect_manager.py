@@ -1,7 +1,13 @@
-import dataclasses
+import base64
+import ctypes
 import datetime
+import importlib
 
 from manager.actor_manager import ActorManager, Actor
+from manager.aggregation import EffectAggregator, DAMAGE, HEAL
+from manager.decoders import structure_bytes
+from manager.events import EffectEvent, EffectOverTimeEvent
+from manager.pending_effects import PendingEffect, PendingEffectTable, PendingEffectStats
 from manager.stubs import IpcFeedTarget
 from pyxivdata.installation.resource_reader import GameResourceReader
 from pyxivdata.network.client_ipc.opcodes import ClientIpcOpcodes
@@ -12,12 +18,26 @@ from pyxivdata.network.server_ipc.common import ActionEffect
 from pyxivdata.network.server_ipc.opcodes import ServerIpcOpcodes
 
 
-@dataclasses.dataclass
-class PendingEffect:
-    timestamp: datetime.datetime
-    source_actor: Actor
-    effect: IpcEffectStub
-    effects_per_target: typing.Dict[int, typing.List[ActionEffect]]
+SERVER_IPC_MODULE = "pyxivdata.network.server_ipc"
+
+
+def _structure_state(value: typing.Any) -> typing.List[str]:
+    t, raw = structure_bytes(value)
+    return [f"{t.__module__}:{t.__qualname__}", base64.b64encode(raw).decode("ascii")]
+
+
+def _structure_from_state(state: typing.List[str]) -> typing.Any:
+    # Checkpoints come from files, so only ever look up server IPC structures, and never import anything else.
+    path, raw = state
+    module_name, qualname = path.split(":")
+    if module_name != SERVER_IPC_MODULE and not module_name.startswith(SERVER_IPC_MODULE + "."):
+        raise ValueError(f"{path}: not a server IPC structure")
+    t = importlib.import_module(module_name)
+    for part in qualname.split("."):
+        t = getattr(t, part, None)
+    if not (isinstance(t, type) and issubclass(t, ctypes.Structure)):
+        raise ValueError(f"{path}: not a server IPC structure")
+    return t.from_buffer_copy(base64.b64decode(raw))
 
 
 class EffectManager(IpcFeedTarget):
@@ -26,29 +46,31 @@ class EffectManager(IpcFeedTarget):
                  actor_manager: ActorManager):
         super().__init__(resource_reader, server_opcodes, client_opcodes)
         self._actors = actor_manager
-        self._pending_effects: typing.Dict[int, PendingEffect] = {}
+        self._pending_effects = PendingEffectTable()
+        self.aggregator = EffectAggregator()
         self._battles = []
 
         @self._server_opcode_handler(server_opcodes.Effect01, server_opcodes.Effect08, server_opcodes.Effect16,
                                      server_opcodes.Effect24, server_opcodes.Effect32)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcEffectStub):
-            self._pending_effects[data.global_sequence_id] = PendingEffect(
+            if isinstance(data, ctypes.Structure):
+                # Kept around until the results arrive, so it must not keep pointing into the bundle buffer.
+                data = type(data).from_buffer_copy(data)
+            self._pending_effects.add(data.global_sequence_id, PendingEffect(
                 timestamp=bundle_header.timestamp,
                 source_actor=self._actors[header.actor_id],
                 effect=data,
                 effects_per_target=data.valid_known_effects_per_target,
-            )
+            ))
 
         @self._server_opcode_handler(server_opcodes.EffectResult)
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: IpcEffectResult):
-            try:
-                pending_effect = self._pending_effects[data.global_sequence_id]
-                effects = pending_effect.effects_per_target.pop(header.actor_id)
-                if not pending_effect.effects_per_target:
-                    del self._pending_effects[data.global_sequence_id]
-            except KeyError:
+            self._pending_effects.expire(bundle_header.timestamp)
+            found = self._pending_effects.pop_target(data.global_sequence_id, header.actor_id)
+            if found is None:
                 # TODO: log
                 return
+            pending_effect, effects = found
 
             source_actor = pending_effect.source_actor
             timestamp = bundle_header.timestamp
@@ -65,40 +87,62 @@ class EffectManager(IpcFeedTarget):
 
         @self._actor_control_handler
         def _(bundle_header: PacketHeader, header: IpcMessageHeader, data: ActorControlDeath):
-            for seq_id, pending_effect in list(self._pending_effects.items()):
-                if pending_effect.source_actor.id == header.actor_id:
-                    # Effect won't take effect if the source actor is defeated at the time of effect application.
-                    del self._pending_effects[seq_id]
-            pass
+            # Effect won't take effect if the source actor is defeated at the time of effect application.
+            self._pending_effects.invalidate_source(header.actor_id)
+
+    def export_state(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "pending_effects": [{
+                "global_sequence_id": sequence_id,
+                "timestamp": pending_effect.timestamp.isoformat(),
+                "source_actor_id": pending_effect.source_actor.id,
+                "effect": _structure_state(pending_effect.effect),
+                "effects_per_target": [[target_id, [_structure_state(x) for x in effects]]
+                                       for target_id, effects in pending_effect.effects_per_target.items()],
+            } for sequence_id, pending_effect in self._pending_effects.items()],
+            "aggregator": self.aggregator.export_state(),
+        }
+
+    def import_state(self, state: typing.Dict[str, typing.Any]):
+        self._pending_effects.clear()
+        for x in state["pending_effects"]:
+            self._pending_effects.add(x["global_sequence_id"], PendingEffect(
+                timestamp=datetime.datetime.fromisoformat(x["timestamp"]),
+                source_actor=self._actors[x["source_actor_id"]],
+                effect=_structure_from_state(x["effect"]),
+                effects_per_target={target_id: [_structure_from_state(y) for y in effects]
+                                    for target_id, effects in x["effects_per_target"]},
+            ))
+        if "aggregator" in state:
+            self.aggregator.import_state(state["aggregator"])
+
+    @property
+    def pending_effect_stats(self) -> PendingEffectStats:
+        return self._pending_effects.stats()
 
     def _on_effect(self, timestamp: datetime.datetime, source: Actor, target: Actor,
                    pending_effect: IpcEffectStub, effect: ActionEffect):
         if effect.known_effect_type not in (EffectType.Damage, EffectType.Heal):
             return
 
-        d = [
-            f"{timestamp:%Y-%m-%d %H:%M:%S.%f}",
-            f"{source.format(self._resource_reader, self._actors[source.owner_id])}",
-            f"=> {target.format(self._resource_reader, self._actors[target.owner_id])}",
-            f"{effect.value * (-1 if effect.known_effect_type == EffectType.Damage else 1):>+7}",
-            f"{self._resource_reader.get_action_name(pending_effect.action_id, fallback_format='?')}({pending_effect.action_id})",
-            f"=> {target.hp:,}/{target.max_hp:,} ({100 * target.hp / target.max_hp:.02f}%)"
-        ]
-        print(*d)
-        pass  # TODO
+        kind = DAMAGE if effect.known_effect_type == EffectType.Damage else HEAL
+        self.aggregator.add(timestamp, kind, effect.value, source.id, source.owner_id,
+                            ("action", pending_effect.action_id), target.id)
+
+        if self._events.active:
+            self._events.publish(EffectEvent(timestamp, source.id, source.owner_id, target.id, target.owner_id, kind,
+                                             effect.value, pending_effect.action_id, target.hp, target.max_hp))
 
     def _on_effect_over_time(self, timestamp: datetime.datetime, target: Actor,
                              buff_id: int, effect_type: int, amount: int, source: typing.Optional[Actor]):
         if effect_type not in (EffectType.Damage, EffectType.Heal):
             return
 
-        d = [
-            f"{timestamp:%Y-%m-%d %H:%M:%S.%f}",
-            f"{'?' if source is None else source.format(self._resource_reader, None if source.owner_id is None else self._actors[source.owner_id])}",
-            f"=> {target.format(self._resource_reader, self._actors[target.owner_id])}",
-            f"{amount * (-1 if effect_type == EffectType.Damage else 1):>+7}",
-            f"{self._resource_reader.get_status_effect_name(buff_id, fallback_format='?')}({buff_id}, *)" if buff_id else "?(*)",
-            f"=> {target.hp:,}/{target.max_hp:,} ({100 * target.hp / target.max_hp:.02f}%)"
-        ]
-        print(*d)
-        pass  # TODO
+        kind = DAMAGE if effect_type == EffectType.Damage else HEAL
+        source_id = None if source is None else source.id
+        source_owner_id = None if source is None else source.owner_id
+        self.aggregator.add(timestamp, kind, amount, source_id, source_owner_id, ("status", buff_id), target.id)
+
+        if self._events.active:
+            self._events.publish(EffectOverTimeEvent(timestamp, source_id, source_owner_id, target.id, target.owner_id,
+                                                     kind, amount, buff_id, target.hp, target.max_hp))
@@ -0,0 +1,114 @@
+import typing
+
+from manager.actor_manager import ActorManager, Actor
+from manager.aggregation import DAMAGE
+from manager.events import EventSink, Event, EffectEvent, EffectOverTimeEvent, ChatEvent, NpcYellEvent, \
+    ContentTextEvent, DespawnEvent, ZoneChangeEvent, PartyEvent, AllianceEvent
+from pyxivdata.installation.resource_reader import GameResourceReader
+
+
+class TextSink(EventSink):
+    """The human readable lines the managers used to print.
+
+    Names come from the actors as they are when the event is published, so lines are formatted right away, and only
+    writing them out is batched."""
+
+    def __init__(self, fp: typing.TextIO, resource_reader: GameResourceReader, actor_manager: ActorManager,
+                 batch_size: int = 64):
+        super().__init__(batch_size)
+        self._fp = fp
+        self._resource_reader = resource_reader
+        self._actors = actor_manager
+        self._lines: typing.List[str] = []
+        self._formatters: typing.Dict[typing.Type[Event], typing.Callable[[typing.Any], str]] = {
+            EffectEvent: self._format_effect,
+            EffectOverTimeEvent: self._format_effect_over_time,
+            ChatEvent: self._format_chat,
+            NpcYellEvent: self._format_npc_yell,
+            ContentTextEvent: self._format_content_text,
+            DespawnEvent: self._format_despawn,
+            ZoneChangeEvent: self._format_zone_change,
+            PartyEvent: self._format_party,
+            AllianceEvent: self._format_alliance,
+        }
+
+    def write(self, event: Event):
+        formatter = self._formatters.get(type(event))
+        if formatter is None:
+            return
+        self._lines.append(formatter(event))
+        if len(self._lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._lines.append("")
+            self._fp.write("\n".join(self._lines))
+            self._lines = []
+
+    def _actor(self, actor_id: int) -> Actor:
+        # Formatting must not change what the manager knows, so actors it has never seen are not added to it.
+        actor = self._actors.get(actor_id)
+        return Actor(actor_id) if actor is None else actor
+
+    def _format_actor(self, actor_id: int, owner_id: typing.Optional[int] = None) -> str:
+        owner = None if owner_id is None else self._actor(owner_id)
+        return self._actor(actor_id).format(self._resource_reader, owner)
+
+    def _format_members(self, member_ids: typing.List[typing.Optional[int]]) -> str:
+        return ",".join("-" if x is None else self._format_actor(x) for x in member_ids)
+
+    def _format_effect(self, event: EffectEvent) -> str:
+        return " ".join((
+            f"{event.timestamp:%Y-%m-%d %H:%M:%S.%f}",
+            self._format_actor(event.source_id, event.source_owner_id),
+            f"=> {self._format_actor(event.target_id, event.target_owner_id)}",
+            f"{event.amount * (-1 if event.kind == DAMAGE else 1):>+7}",
+            f"{self._resource_reader.get_action_name(event.action_id, fallback_format='?')}({event.action_id})",
+            f"=> {event.target_hp:,}/{event.target_max_hp:,} ({100 * event.target_hp / event.target_max_hp:.02f}%)",
+        ))
+
+    def _format_effect_over_time(self, event: EffectOverTimeEvent) -> str:
+        buff_id = event.status_effect_id
+        return " ".join((
+            f"{event.timestamp:%Y-%m-%d %H:%M:%S.%f}",
+            "?" if event.source_id is None else self._format_actor(event.source_id, event.source_owner_id),
+            f"=> {self._format_actor(event.target_id, event.target_owner_id)}",
+            f"{event.amount * (-1 if event.kind == DAMAGE else 1):>+7}",
+            f"{self._resource_reader.get_status_effect_name(buff_id, fallback_format='?')}({buff_id}, *)"
+            if buff_id else "?(*)",
+            f"=> {event.target_hp:,}/{event.target_max_hp:,} ({100 * event.target_hp / event.target_max_hp:.02f}%)",
+        ))
+
+    def _format_chat(self, event: ChatEvent) -> str:
+        from_name = ".".join([x[0:1] for x in event.from_name.split(" ")]) + "."
+        world = self._resource_reader.get_world_name(event.from_world_id)
+        if event.chat_type == "Tell":
+            return f"{from_name}@{world} >> {event.message}"
+        elif event.chat_type == "TellReceive":
+            return f">> {from_name}@{world}: {event.message}"
+        else:
+            return f"[{event.chat_type}] {from_name}@{world}: {event.message}"
+
+    def _format_npc_yell(self, event: NpcYellEvent) -> str:
+        return (f"[NpcYell] {self._format_actor(event.actor_id)}({event.name_sheet}:{event.name_id}={event.name}): "
+                f"{event.row_id}={event.text}")
+
+    def _format_content_text(self, event: ContentTextEvent) -> str:
+        return (f"[ContentTextData] someobjid={event.some_object_id:08x} "
+                f"{self._format_actor(event.actor_id)}({event.bnpcname_id}={event.name}): "
+                f"{event.text_sheet}:{event.row_id}={event.text} ({event.duration_ms}ms)")
+
+    def _format_despawn(self, event: DespawnEvent) -> str:
+        return f"Despawn: {self._format_actor(event.actor_id)}"
+
+    def _format_zone_change(self, event: ZoneChangeEvent) -> str:
+        return f"Zone: {self._resource_reader.get_territory_name(event.zone_id)}"
+
+    def _format_party(self, event: PartyEvent) -> str:
+        if event.party_id is None:
+            return "Party: -"
+        return f"Party:  {self._format_members(event.member_ids)}"
+
+    def _format_alliance(self, event: AllianceEvent) -> str:
+        return f"Alliance:  {self._format_members(event.member_ids)}"
@@ -0,0 +1,255 @@
+import contextlib
+import dataclasses
+import datetime
+import json
+import struct
+import typing
+
+DEFAULT_BATCH_SIZE = 256
+
+
+@dataclasses.dataclass
+class Event:
+    timestamp: datetime.datetime
+
+
+@dataclasses.dataclass
+class EffectEvent(Event):
+    source_id: int
+    source_owner_id: typing.Optional[int]
+    target_id: int
+    target_owner_id: typing.Optional[int]
+    kind: str  # aggregation.DAMAGE or aggregation.HEAL
+    amount: int
+    action_id: int
+    target_hp: typing.Optional[int]
+    target_max_hp: typing.Optional[int]
+
+
+@dataclasses.dataclass
+class EffectOverTimeEvent(Event):
+    source_id: typing.Optional[int]
+    source_owner_id: typing.Optional[int]
+    target_id: int
+    target_owner_id: typing.Optional[int]
+    kind: str
+    amount: int
+    status_effect_id: int
+    target_hp: typing.Optional[int]
+    target_max_hp: typing.Optional[int]
+
+
+@dataclasses.dataclass
+class ChatEvent(Event):
+    chat_type: str  # ChatType name
+    from_id: typing.Optional[int]
+    from_name: str
+    from_world_id: int
+    message: str  # as repr(SeString) shows it
+    to_name: typing.Optional[str] = None
+    to_world_id: typing.Optional[int] = None
+
+
+@dataclasses.dataclass
+class NpcYellEvent(Event):
+    actor_id: int
+    name_sheet: str
+    name_id: int
+    name: str
+    row_id: int
+    text: str
+
+
+@dataclasses.dataclass
+class ContentTextEvent(Event):
+    actor_id: int
+    some_object_id: int
+    bnpcname_id: int
+    name: str
+    text_sheet: str
+    row_id: int
+    text: str
+    duration_ms: int
+
+
+@dataclasses.dataclass
+class SpawnEvent(Event):
+    actor_id: int
+    spawn_id: int
+    name: str
+    owner_id: int
+    bnpcname_id: int
+    x: float
+    y: float
+    z: float
+
+
+@dataclasses.dataclass
+class DespawnEvent(Event):
+    actor_id: int
+    spawn_id: int
+
+
+@dataclasses.dataclass
+class ZoneChangeEvent(Event):
+    zone_id: int
+
+
+@dataclasses.dataclass
+class PartyEvent(Event):
+    party_id: typing.Optional[int]  # None once the party is gone
+    member_ids: typing.List[typing.Optional[int]]
+
+
+@dataclasses.dataclass
+class AllianceEvent(Event):
+    member_ids: typing.List[typing.Optional[int]]
+
+
+# Position in this tuple is the type code in the binary format, so only ever append to it.
+EVENT_TYPES: typing.Tuple[typing.Type[Event], ...] = (
+    EffectEvent, EffectOverTimeEvent, ChatEvent, NpcYellEvent, ContentTextEvent,
+    SpawnEvent, DespawnEvent, ZoneChangeEvent, PartyEvent, AllianceEvent,
+)
+_EVENT_CODES = {t: i for i, t in enumerate(EVENT_TYPES)}
+_EVENT_FIELDS = {t: tuple(x.name for x in dataclasses.fields(t)) for t in EVENT_TYPES}
+
+
+def event_values(event: Event) -> typing.List[typing.Any]:
+    """Field values in declaration order, the timestamp as ISO 8601."""
+    values = [getattr(event, name) for name in _EVENT_FIELDS[type(event)]]
+    values[0] = values[0].isoformat()
+    return values
+
+
+def event_from_values(event_type: typing.Type[Event], values: typing.Sequence[typing.Any]) -> Event:
+    event = event_type(*values)
+    event.timestamp = datetime.datetime.fromisoformat(event.timestamp)
+    return event
+
+
+class EventSink:
+    """Takes events one by one, and hands them over to _write_batch batch_size at a time."""
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._pending: typing.List[Event] = []
+
+    def write(self, event: Event):
+        self._pending.append(event)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self._write_batch(pending)
+
+    def close(self):
+        self.flush()
+
+    def _write_batch(self, events: typing.List[Event]):
+        raise NotImplementedError
+
+
+class JsonLinesSink(EventSink):
+    """One JSON object per line, with the event type name under "type"."""
+
+    def __init__(self, fp: typing.TextIO, batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self._fp = fp
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def _write_batch(self, events: typing.List[Event]):
+        lines = []
+        for event in events:
+            record = dict(zip(_EVENT_FIELDS[type(event)], event_values(event)))
+            record["type"] = type(event).__name__
+            lines.append(self._encoder.encode(record))
+        lines.append("")
+        self._fp.write("\n".join(lines))
+
+
+# Each record is its payload size and type code (an index into EVENT_TYPES), then the payload: the UTF-8 JSON array of
+# the field values in declaration order, without the names.
+EVENT_RECORD_HEADER = struct.Struct("<IH")
+
+
+class LengthPrefixedSink(EventSink):
+    def __init__(self, fp: typing.BinaryIO, batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self._fp = fp
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def _write_batch(self, events: typing.List[Event]):
+        parts = []
+        for event in events:
+            payload = self._encoder.encode(event_values(event)).encode("utf-8")
+            parts.append(EVENT_RECORD_HEADER.pack(len(payload), _EVENT_CODES[type(event)]))
+            parts.append(payload)
+        self._fp.write(b"".join(parts))
+
+
+def read_length_prefixed(fp: typing.BinaryIO) -> typing.Iterator[Event]:
+    """Reads back what LengthPrefixedSink wrote, stopping at a truncated record."""
+    while True:
+        header = fp.read(EVENT_RECORD_HEADER.size)
+        if len(header) < EVENT_RECORD_HEADER.size:
+            return
+        size, code = EVENT_RECORD_HEADER.unpack(header)
+        payload = fp.read(size)
+        if len(payload) < size:
+            return
+        yield event_from_values(EVENT_TYPES[code], json.loads(payload.decode("utf-8")))
+
+
+class EventBus:
+    """Hands published events to every sink attached.
+
+    Publishers check active first, and do not even build the event when it is False, so that nothing is spent on events
+    that nobody reads."""
+
+    def __init__(self):
+        self._sinks: typing.List[EventSink] = []
+        self.active = False
+        self._paused = 0
+
+    @property
+    def sinks(self) -> typing.List[EventSink]:
+        return list(self._sinks)
+
+    def add_sink(self, sink: EventSink) -> EventSink:
+        self._sinks.append(sink)
+        self._update_active()
+        return sink
+
+    def remove_sink(self, sink: EventSink):
+        self._sinks.remove(sink)
+        sink.flush()
+        self._update_active()
+
+    def publish(self, event: Event):
+        for sink in self._sinks:
+            sink.write(event)
+
+    def flush(self):
+        for sink in self._sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self._sinks:
+            sink.close()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Turns the bus off for a while, e.g. when replaying only to bring the state up to date."""
+        self._paused += 1
+        self._update_active()
+        try:
+            yield self
+        finally:
+            self._paused -= 1
+            self._update_active()
+
+    def _update_active(self):
+        self.active = bool(self._sinks) and not self._paused
@@ -0,0 +1,145 @@
+import copy
+import ctypes
+import dataclasses
+import sys
+import time
+import typing
+
+from manager.registry import opcode_values
+from pyxivdata.network.client_ipc.opcodes import ClientIpcOpcodes
+from pyxivdata.network.packet import MessageHeader, IpcMessageHeader
+from pyxivdata.network.server_ipc import IpcActorControlStub
+from pyxivdata.network.server_ipc.opcodes import ServerIpcOpcodes
+
+DIRECTION_SERVER = "server"
+DIRECTION_CLIENT = "client"
+DIRECTION_ACTOR_CONTROL = "actor_control"  # keyed by known_type instead of opcode
+
+MetricsKeyType = typing.Tuple[str, int]
+
+
+def callback_name(cb: typing.Callable) -> str:
+    # Handlers are mostly closures named _, so tell them apart by where they are defined.
+    code = getattr(cb, "__code__", None)
+    if code is None:
+        return repr(cb)
+    return f"{cb.__qualname__.split('.<locals>')[0]}:{code.co_firstlineno}"
+
+
+def _opcode_names(opcodes: typing.Any) -> typing.Dict[int, str]:
+    names = {}
+    for name, value in sorted(opcode_values(opcodes).items()):
+        names.setdefault(value, name)
+    return names
+
+
+@dataclasses.dataclass
+class CallbackStats:
+    calls: int = 0
+    seconds: float = 0.
+    max_seconds: float = 0.
+
+
+@dataclasses.dataclass
+class OpcodeStats:
+    direction: str
+    opcode: int
+    name: str
+    count: int = 0
+    bytes: int = 0
+    decodes: int = 0
+    decode_seconds: float = 0.
+    callbacks: typing.Dict[str, CallbackStats] = dataclasses.field(default_factory=dict)
+
+    @property
+    def callback_seconds(self) -> float:
+        return sum(x.seconds for x in self.callbacks.values())
+
+
+class DispatchMetrics:
+    """Per opcode message counts, decode time and handler time; only collected while attached to the feed targets."""
+
+    def __init__(self, server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes,
+                 dump_interval: typing.Optional[float] = None, dump_to: typing.Optional[typing.TextIO] = None):
+        self._names = {
+            DIRECTION_SERVER: _opcode_names(server_opcodes),
+            DIRECTION_CLIENT: _opcode_names(client_opcodes),
+            DIRECTION_ACTOR_CONTROL: {},
+        }
+        self._actor_control_opcodes = {server_opcodes.ActorControl, server_opcodes.ActorControlSelf,
+                                       server_opcodes.ActorControlTarget}
+        self._stats: typing.Dict[MetricsKeyType, OpcodeStats] = {}
+        self.dump_interval = dump_interval
+        self.dump_to = dump_to
+        self._next_dump = None if dump_interval is None else time.perf_counter() + dump_interval
+
+    def name_actor_control(self, known_type: int, name: str):
+        self._names[DIRECTION_ACTOR_CONTROL].setdefault(known_type, name)
+
+    def get(self, direction: str, opcode: int) -> OpcodeStats:
+        stats = self._stats.get((direction, opcode))
+        if stats is None:
+            name = self._names[direction].get(opcode, f"0x{opcode:04x}")
+            stats = self._stats[direction, opcode] = OpcodeStats(direction, opcode, name)
+        return stats
+
+    def count_message(self, direction: str, data: typing.Union[bytearray, memoryview]):
+        if MessageHeader.from_buffer(data).type == MessageHeader.TYPE_IPC:
+            header = IpcMessageHeader.from_buffer(data)
+            if header.type1 == IpcMessageHeader.TYPE1_IPC:
+                stats = self.get(direction, header.type2)
+                stats.count += 1
+                stats.bytes += header.size
+
+                if (direction == DIRECTION_SERVER and header.type2 in self._actor_control_opcodes
+                        and len(data) >= ctypes.sizeof(header) + ctypes.sizeof(IpcActorControlStub)):
+                    stub = IpcActorControlStub.from_buffer(data, ctypes.sizeof(header))
+                    stats = self.get(DIRECTION_ACTOR_CONTROL, stub.known_type)
+                    stats.count += 1
+                    stats.bytes += header.size
+
+        if self._next_dump is not None:
+            now = time.perf_counter()
+            if now >= self._next_dump:
+                self._next_dump = now + self.dump_interval
+                self.dump()
+
+    def add_decode(self, stats: OpcodeStats, seconds: float):
+        stats.decodes += 1
+        stats.decode_seconds += seconds
+
+    def add_callback(self, stats: OpcodeStats, name: str, seconds: float):
+        # name as given by callback_name, which the caller keeps instead of formatting it on every call
+        callback_stats = stats.callbacks.get(name)
+        if callback_stats is None:
+            callback_stats = stats.callbacks[name] = CallbackStats()
+        callback_stats.calls += 1
+        callback_stats.seconds += seconds
+        if seconds > callback_stats.max_seconds:
+            callback_stats.max_seconds = seconds
+
+    def reset(self):
+        self._stats.clear()
+
+    def snapshot(self, direction: typing.Optional[str] = None) -> typing.List[OpcodeStats]:
+        """Copies of the collected stats, busiest (decode and handler time) first."""
+        result = [copy.deepcopy(x) for x in self._stats.values() if direction is None or x.direction == direction]
+        result.sort(key=lambda x: x.decode_seconds + x.callback_seconds, reverse=True)
+        return result
+
+    def format(self, top: typing.Optional[int] = None) -> str:
+        lines = [f"{'direction':<14}{'opcode':>8}  {'name':<32}{'count':>10}{'bytes':>14}"
+                 f"{'decode ms':>12}{'handler ms':>12}"]
+        for stats in self.snapshot()[:top]:
+            lines.append(f"{stats.direction:<14}{stats.opcode:>#8x}  {stats.name[:31]:<32}{stats.count:>10,}"
+                         f"{stats.bytes:>14,}{stats.decode_seconds * 1000:>12,.2f}"
+                         f"{stats.callback_seconds * 1000:>12,.2f}")
+            for name, callback_stats in sorted(stats.callbacks.items(), key=lambda x: -x[1].seconds):
+                lines.append(f"{'':<24}{name[:43]:<44}{callback_stats.calls:>10,}"
+                             f"{'max ' + format(callback_stats.max_seconds * 1000, ',.3f'):>14}{'':>12}"
+                             f"{callback_stats.seconds * 1000:>12,.2f}")
+        return "\n".join(lines)
+
+    def dump(self, fp: typing.Optional[typing.TextIO] = None, top: typing.Optional[int] = None):
+        fp = fp or self.dump_to or sys.stderr
+        print(self.format(top), file=fp, flush=True)
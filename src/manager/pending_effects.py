@@ -0,0 +1,120 @@
+import collections
+import copy
+import dataclasses
+import datetime
+import typing
+
+from manager.actor_manager import Actor
+from pyxivdata.network.server_ipc import IpcEffectStub
+from pyxivdata.network.server_ipc.common import ActionEffect
+
+DEFAULT_PENDING_EFFECT_TTL = datetime.timedelta(seconds=30)
+DEFAULT_MAX_PENDING_EFFECTS = 4096
+
+
+@dataclasses.dataclass
+class PendingEffect:
+    timestamp: datetime.datetime
+    source_actor: Actor
+    effect: IpcEffectStub
+    effects_per_target: typing.Dict[int, typing.List[ActionEffect]]
+
+
+@dataclasses.dataclass
+class PendingEffectStats:
+    added: int = 0
+    completed: int = 0  # every target got its result
+    replaced: int = 0  # another effect came with the same sequence id while still waiting
+    invalidated: int = 0  # the source died first
+    expired: int = 0  # still waiting after ttl
+    evicted: int = 0  # dropped to stay within max_size
+    unmatched_results: int = 0  # EffectResult with nothing waiting for it
+
+
+class PendingEffectTable:
+    """Effects waiting for their EffectResults, by global sequence id, oldest first, with an index by source actor.
+
+    Entries still waiting ttl after their own timestamp are dropped as newer timestamps come in, and the oldest ones go
+    once there are more than max_size, so results that never arrive do not pile up."""
+
+    def __init__(self, ttl: datetime.timedelta = DEFAULT_PENDING_EFFECT_TTL,
+                 max_size: int = DEFAULT_MAX_PENDING_EFFECTS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: typing.Dict[int, PendingEffect] = collections.OrderedDict()
+        self._by_source: typing.Dict[int, typing.Dict[int, None]] = {}  # source actor id -> ordered set of sequence ids
+        self._stats = PendingEffectStats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, sequence_id: int):
+        return sequence_id in self._entries
+
+    def items(self) -> typing.Iterable[typing.Tuple[int, PendingEffect]]:
+        return self._entries.items()
+
+    def get(self, sequence_id: int) -> typing.Optional[PendingEffect]:
+        return self._entries.get(sequence_id)
+
+    def stats(self) -> PendingEffectStats:
+        return copy.copy(self._stats)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_source.clear()
+
+    def add(self, sequence_id: int, pending_effect: PendingEffect):
+        self.expire(pending_effect.timestamp)
+        if sequence_id in self._entries:
+            self._remove(sequence_id)
+            self._stats.replaced += 1
+        self._entries[sequence_id] = pending_effect
+        self._by_source.setdefault(pending_effect.source_actor.id, {})[sequence_id] = None
+        self._stats.added += 1
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self._stats.evicted += 1
+
+    def pop_target(self, sequence_id: int, target_id: int
+                   ) -> typing.Optional[typing.Tuple[PendingEffect, typing.List[ActionEffect]]]:
+        """Takes out the effects on target_id of a pending effect, forgetting about the latter once every target had
+        its turn; None if nothing is waiting for it."""
+        pending_effect = self._entries.get(sequence_id)
+        if pending_effect is None:
+            self._stats.unmatched_results += 1
+            return None
+        effects = pending_effect.effects_per_target.pop(target_id, None)
+        if effects is None:
+            self._stats.unmatched_results += 1
+            return None
+        if not pending_effect.effects_per_target:
+            self._remove(sequence_id)
+            self._stats.completed += 1
+        return pending_effect, effects
+
+    def invalidate_source(self, actor_id: int):
+        for sequence_id in self._by_source.pop(actor_id, ()):
+            del self._entries[sequence_id]
+            self._stats.invalidated += 1
+
+    def expire(self, timestamp: datetime.datetime):
+        entries = self._entries
+        if not entries:
+            return
+        cutoff = timestamp - self.ttl
+        while entries:
+            sequence_id, pending_effect = next(iter(entries.items()))
+            if pending_effect.timestamp > cutoff:
+                break
+            self._remove(sequence_id)
+            self._stats.expired += 1
+
+    def _remove(self, sequence_id: int):
+        pending_effect = self._entries.pop(sequence_id)
+        source_id = pending_effect.source_actor.id
+        same_source = self._by_source.get(source_id)
+        if same_source is not None:
+            same_source.pop(sequence_id, None)
+            if not same_source:
+                del self._by_source[source_id]
@@ -0,0 +1,75 @@
+import typing
+
+from pyxivdata.network import server_ipc, client_ipc
+from pyxivdata.network.client_ipc.opcodes import ClientIpcOpcodes
+from pyxivdata.network.common import IpcStructure
+from pyxivdata.network.server_ipc.opcodes import ServerIpcOpcodes
+
+RegistryKeyType = typing.Tuple[typing.Tuple[typing.Tuple[str, int], ...], typing.Tuple[typing.Tuple[str, int], ...]]
+
+
+def opcode_values(opcodes: typing.Any) -> typing.Dict[str, int]:
+    values = {}
+    for name in dir(opcodes):
+        if name.startswith("_"):
+            continue
+        value = getattr(opcodes, name)
+        if isinstance(value, int) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def _opcode_types(module: typing.Any, opcodes: typing.Any) -> typing.Dict[int, type]:
+    return {
+        getattr(opcodes, t.OPCODE_FIELD): t
+        for t in vars(module).values()
+        if isinstance(t, type) and issubclass(t, IpcStructure) and t.OPCODE_FIELD is not None
+    }
+
+
+class OpcodeTypeRegistry:
+    """Maps opcodes to the IPC structure types decoding them, for one set of server and client opcodes.
+
+    Each direction's IPC module is scanned the first time someone asks about that direction."""
+
+    def __init__(self, server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes):
+        self._server_opcodes = server_opcodes
+        self._client_opcodes = client_opcodes
+        self._server_types: typing.Optional[typing.Dict[int, type]] = None
+        self._client_types: typing.Optional[typing.Dict[int, type]] = None
+
+    def server_type(self, opcode: int) -> typing.Optional[type]:
+        if self._server_types is None:
+            self._server_types = _opcode_types(server_ipc, self._server_opcodes)
+        return self._server_types.get(opcode)
+
+    def client_type(self, opcode: int) -> typing.Optional[type]:
+        if self._client_types is None:
+            self._client_types = _opcode_types(client_ipc, self._client_opcodes)
+        return self._client_types.get(opcode)
+
+
+def registry_key(server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes) -> RegistryKeyType:
+    # Opcode sets are mutable and may not be hashable, so registries are told apart by the opcode values.
+    return (tuple(sorted(opcode_values(server_opcodes).items())),
+            tuple(sorted(opcode_values(client_opcodes).items())))
+
+
+_registries: typing.Dict[RegistryKeyType, OpcodeTypeRegistry] = {}
+
+# The opcode objects last asked about, and their registry; a Parser hands the same ones to each of its managers.
+_last_used: typing.Optional[typing.Tuple[ServerIpcOpcodes, ClientIpcOpcodes, OpcodeTypeRegistry]] = None
+
+
+def get_registry(server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes) -> OpcodeTypeRegistry:
+    """Returns the registry shared by every IpcFeedTarget in this process using the same opcodes."""
+    global _last_used
+    if _last_used is not None and _last_used[0] is server_opcodes and _last_used[1] is client_opcodes:
+        return _last_used[2]
+
+    key = registry_key(server_opcodes, client_opcodes)
+    registry = _registries.get(key)
+    if registry is None:
+        registry = _registries[key] = OpcodeTypeRegistry(server_opcodes, client_opcodes)
+    _last_used = server_opcodes, client_opcodes, registry
+    return registry
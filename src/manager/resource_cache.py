@@ -0,0 +1,128 @@
+import collections
+import copy
+import dataclasses
+import sys
+import typing
+
+from pyxivdata.installation.resource_reader import GameResourceReader
+
+# Lookups whose result only depends on their arguments; each gets a cache of its own. get_excel_string gets one per
+# sheet instead.
+CACHED_METHODS = ("get_status", "get_world_name", "get_action_name", "get_status_effect_name", "get_territory_name",
+                  "get_bnpc_name")
+
+# What a lookup raises when the row is not there; remembered like any other result.
+MISSING_ROW_EXCEPTIONS = (KeyError, IndexError)
+
+DEFAULT_CACHE_SIZE = 4096
+
+
+@dataclasses.dataclass
+class CacheStats:
+    sheet: str
+    hits: int = 0
+    negative_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size: int = 0
+
+
+class _LruCache:
+    __slots__ = ("entries", "maxsize", "stats")
+
+    def __init__(self, sheet: str, maxsize: int):
+        self.entries: typing.Dict[typing.Hashable, typing.Tuple[bool, typing.Any]] = collections.OrderedDict()
+        self.maxsize = maxsize
+        self.stats = CacheStats(sheet)
+
+    def call(self, key: typing.Hashable, fn: typing.Callable, args: tuple, kwargs: dict) -> typing.Any:
+        entries = self.entries
+        try:
+            found, value = entries[key]
+        except KeyError:
+            self.stats.misses += 1
+            try:
+                found, value = True, fn(*args, **kwargs)
+            except MISSING_ROW_EXCEPTIONS as e:
+                found, value = False, e
+            entries[key] = found, value
+            if len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self.stats.evictions += 1
+        else:
+            entries.move_to_end(key)
+            if found:
+                self.stats.hits += 1
+            else:
+                self.stats.negative_hits += 1
+
+        if found:
+            return value
+        raise value.with_traceback(None)
+
+
+def _key(args: tuple, kwargs: dict) -> typing.Hashable:
+    return (args, tuple(sorted(kwargs.items()))) if kwargs else args
+
+
+class CachingResourceReader:
+    """Stands in for a GameResourceReader, remembering the last maxsize results of each lookup, and of each sheet for
+    get_excel_string, rows that are not there included. Everything else goes straight to the reader."""
+
+    def __init__(self, reader: GameResourceReader, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.reader = reader
+        self.maxsize = maxsize
+        self._caches: typing.Dict[str, _LruCache] = {}
+        for name in CACHED_METHODS:
+            if hasattr(reader, name):
+                setattr(self, name, self._cached(name, getattr(reader, name)))
+        self._get_excel_string = reader.get_excel_string
+
+    def __getattr__(self, name: str):
+        return getattr(self.reader, name)
+
+    def _cache(self, sheet: str) -> _LruCache:
+        cache = self._caches.get(sheet)
+        if cache is None:
+            cache = self._caches[sheet] = _LruCache(sheet, self.maxsize)
+        return cache
+
+    def _cached(self, sheet: str, fn: typing.Callable) -> typing.Callable:
+        cache = self._cache(sheet)
+
+        def cached(*args, **kwargs):
+            return cache.call(_key(args, kwargs), fn, args, kwargs)
+
+        cached.__name__ = fn.__name__
+        return cached
+
+    def get_excel_string(self, sheet: str, *args, **kwargs):
+        cache = self._caches.get(sheet)
+        if cache is None:
+            cache = self._cache(sheet)
+        return cache.call(_key(args, kwargs), self._get_excel_string, (sheet,) + args, kwargs)
+
+    def clear(self):
+        for cache in self._caches.values():
+            cache.entries.clear()
+
+    def stats(self) -> typing.List[CacheStats]:
+        """Copies of the counters of every cache, most used first."""
+        result = []
+        for cache in self._caches.values():
+            stats = copy.copy(cache.stats)
+            stats.size = len(cache.entries)
+            result.append(stats)
+        result.sort(key=lambda x: x.hits + x.negative_hits + x.misses, reverse=True)
+        return result
+
+    def format(self) -> str:
+        lines = [f"{'sheet':<32}{'hits':>10}{'negative':>10}{'misses':>10}{'evicted':>10}{'size':>8}"]
+        for stats in self.stats():
+            if stats.hits + stats.negative_hits + stats.misses:
+                lines.append(f"{stats.sheet[:31]:<32}{stats.hits:>10,}{stats.negative_hits:>10,}{stats.misses:>10,}"
+                             f"{stats.evictions:>10,}{stats.size:>8,}")
+        return "\n".join(lines)
+
+    def dump(self, fp: typing.Optional[typing.TextIO] = None):
+        print(self.format(), file=fp or sys.stderr, flush=True)
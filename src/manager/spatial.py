@@ -0,0 +1,214 @@
+import dataclasses
+import heapq
+import math
+import typing
+
+# Positions are taken on the same x/y plane as Actor.distance. Rotation 0 faces +y, and the facing direction is
+# (sin(rotation), cos(rotation)).
+DEFAULT_CELL_SIZE = 10.
+
+CellType = typing.Tuple[int, int]
+
+
+@dataclasses.dataclass(frozen=True)
+class Circle:
+    radius: float
+
+    @property
+    def reach(self) -> float:
+        return self.radius
+
+    def contains(self, forward: float, side: float) -> bool:
+        return forward * forward + side * side <= self.radius * self.radius
+
+
+@dataclasses.dataclass(frozen=True)
+class Donut:
+    inner_radius: float
+    radius: float
+
+    @property
+    def reach(self) -> float:
+        return self.radius
+
+    def contains(self, forward: float, side: float) -> bool:
+        d2 = forward * forward + side * side
+        return self.inner_radius * self.inner_radius <= d2 <= self.radius * self.radius
+
+
+@dataclasses.dataclass(frozen=True)
+class Cone:
+    radius: float
+    angle: float  # full opening angle, in radians
+
+    @property
+    def reach(self) -> float:
+        return self.radius
+
+    def contains(self, forward: float, side: float) -> bool:
+        if forward * forward + side * side > self.radius * self.radius:
+            return False
+        return abs(math.atan2(side, forward)) <= self.angle / 2
+
+
+@dataclasses.dataclass(frozen=True)
+class Rectangle:
+    length: float
+    width: float
+
+    @property
+    def reach(self) -> float:
+        return math.hypot(self.length, self.width / 2)
+
+    def contains(self, forward: float, side: float) -> bool:
+        return 0 <= forward <= self.length and abs(side) <= self.width / 2
+
+
+AoeShapeType = typing.Union[Circle, Donut, Cone, Rectangle]
+
+
+class SpatialGrid:
+    """Uniform grid of positions keyed by anything hashable, such as actor ids.
+
+    Moving a key costs a dict lookup, and only touches the cell sets when the key crosses into another cell. Queries
+    only look at the cells their area overlaps."""
+
+    def __init__(self, cell_size: float = DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self._cells: typing.Dict[CellType, typing.Set[typing.Hashable]] = {}
+        self._positions: typing.Dict[typing.Hashable, typing.Tuple[float, float, CellType]] = {}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key: typing.Hashable):
+        return key in self._positions
+
+    def _cell(self, x: float, y: float) -> CellType:
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def _discard(self, key: typing.Hashable, cell: CellType):
+        keys = self._cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self._cells[cell]
+
+    def update(self, key: typing.Hashable, x: float, y: float):
+        cell = self._cell(x, y)
+        previous = self._positions.get(key)
+        if previous is None or previous[2] != cell:
+            if previous is not None:
+                self._discard(key, previous[2])
+            keys = self._cells.get(cell)
+            if keys is None:
+                keys = self._cells[cell] = set()
+            keys.add(key)
+        self._positions[key] = x, y, cell
+
+    def remove(self, key: typing.Hashable):
+        previous = self._positions.pop(key, None)
+        if previous is not None:
+            self._discard(key, previous[2])
+
+    def clear(self):
+        self._cells.clear()
+        self._positions.clear()
+
+    def position(self, key: typing.Hashable) -> typing.Optional[typing.Tuple[float, float]]:
+        position = self._positions.get(key)
+        return None if position is None else position[:2]
+
+    def _keys_near(self, x: float, y: float, radius: float) -> typing.Iterator[typing.Hashable]:
+        x0, y0 = self._cell(x - radius, y - radius)
+        x1, y1 = self._cell(x + radius, y + radius)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self._cells):
+            # Bigger than what is populated; cheaper to go through the populated cells instead.
+            for (cx, cy), keys in self._cells.items():
+                if x0 <= cx <= x1 and y0 <= cy <= y1:
+                    yield from keys
+            return
+        cells = self._cells
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                keys = cells.get((cx, cy))
+                if keys:
+                    yield from keys
+
+    def within_radius(self, x: float, y: float, radius: float) -> typing.List[typing.Tuple[typing.Hashable, float]]:
+        """Returns (key, distance) of every key within radius of (x, y), in no particular order."""
+        positions = self._positions
+        result = []
+        for key in self._keys_near(x, y, radius):
+            px, py, _ = positions[key]
+            d = math.hypot(px - x, py - y)
+            if d <= radius:
+                result.append((key, d))
+        return result
+
+    def within_shape(self, x: float, y: float, rotation: float,
+                     shape: AoeShapeType) -> typing.List[typing.Tuple[typing.Hashable, float]]:
+        """Returns (key, distance) of every key inside shape, placed at (x, y) and facing rotation."""
+        fx, fy = math.sin(rotation), math.cos(rotation)
+        positions = self._positions
+        result = []
+        for key in self._keys_near(x, y, shape.reach):
+            px, py, _ = positions[key]
+            dx, dy = px - x, py - y
+            if shape.contains(dx * fx + dy * fy, dx * fy - dy * fx):
+                result.append((key, math.hypot(dx, dy)))
+        return result
+
+    def nearest(self, x: float, y: float, count: int,
+                max_radius: typing.Optional[float] = None) -> typing.List[typing.Tuple[typing.Hashable, float]]:
+        """Returns (key, distance) of the count keys closest to (x, y), closest first."""
+        if count <= 0 or not self._positions:
+            return []
+        positions = self._positions
+        cells = self._cells
+        cx, cy = self._cell(x, y)
+        best: typing.List[typing.Tuple[float, int, typing.Hashable]] = []  # max-heap through negated distances
+        seen = 0
+        ring = 0
+        while True:
+            if 8 * ring > len(cells):
+                # Sparse out here; go through what is left of the populated cells at once.
+                ring_cells = [cell for cell in cells if max(abs(cell[0] - cx), abs(cell[1] - cy)) >= ring]
+            else:
+                ring_cells = _ring_cells(cx, cy, ring)
+            for cell in ring_cells:
+                keys = cells.get(cell)
+                if not keys:
+                    continue
+                for key in keys:
+                    seen += 1
+                    px, py, _ = positions[key]
+                    d = math.hypot(px - x, py - y)
+                    if max_radius is not None and d > max_radius:
+                        continue
+                    entry = (-d, seen, key)
+                    if len(best) < count:
+                        heapq.heappush(best, entry)
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, entry)
+
+            # Anything in a cell further out is at least this far away.
+            bound = ring * self.cell_size
+            if seen == len(positions) or (max_radius is not None and bound > max_radius):
+                break
+            if len(best) == count and -best[0][0] <= bound:
+                break
+            ring += 1
+        return [(key, -d) for d, _, key in sorted(best, reverse=True)]
+
+
+def _ring_cells(cx: int, cy: int, ring: int) -> typing.Iterator[CellType]:
+    # The cells at Chebyshev distance ring from (cx, cy).
+    if ring == 0:
+        yield cx, cy
+        return
+    for x in range(cx - ring, cx + ring + 1):
+        yield x, cy - ring
+        yield x, cy + ring
+    for y in range(cy - ring + 1, cy + ring):
+        yield cx - ring, y
+        yield cx + ring, y
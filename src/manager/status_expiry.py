@@ -0,0 +1,176 @@
+import dataclasses
+import datetime
+import heapq
+import itertools
+import typing
+
+StatusEffectKeyType = typing.Tuple[int, int]  # actor id, status effect slot
+
+
+@dataclasses.dataclass
+class ScheduledStatusEffect:
+    actor_id: int
+    index: int
+    effect_id: int
+    param: int
+    source_actor_id: int
+    expiry: typing.Optional[datetime.datetime]
+
+    def active_at(self, timestamp: datetime.datetime) -> bool:
+        return self.expiry is None or self.expiry > timestamp
+
+
+ExpiryCallbackType = typing.Callable[[datetime.datetime, ScheduledStatusEffect], typing.Any]
+
+
+class StatusEffectScheduler:
+    """Status effects in effect on every actor, with a heap of their expiry times.
+
+    Replacing or removing an effect leaves its heap entry behind, and it is skipped when it comes up; the heap gets
+    rebuilt once those outnumber the live entries. Effects are also indexed by effect id and by actor."""
+
+    def __init__(self):
+        self._effects: typing.Dict[StatusEffectKeyType, ScheduledStatusEffect] = {}
+        self._by_effect_id: typing.Dict[int, typing.Dict[StatusEffectKeyType, ScheduledStatusEffect]] = {}
+        self._by_actor: typing.Dict[int, typing.Set[int]] = {}
+        self._heap: typing.List[typing.Tuple[datetime.datetime, int, ScheduledStatusEffect]] = []
+        self._sequence = itertools.count()
+        self._stale = 0
+        self._listeners: typing.List[ExpiryCallbackType] = []
+        self.now: typing.Optional[datetime.datetime] = None
+
+    def __len__(self):
+        return len(self._effects)
+
+    def add_expiry_listener(self, cb: ExpiryCallbackType):
+        self._listeners.append(cb)
+
+    def set(self, actor_id: int, index: int, effect_id: int, param: int, source_actor_id: int,
+            expiry: typing.Optional[datetime.datetime]):
+        if not effect_id:
+            self.remove(actor_id, index)
+            return
+
+        key = actor_id, index
+        previous = self._effects.get(key)
+        if previous is not None:
+            if (previous.effect_id == effect_id and previous.param == param and previous.expiry == expiry
+                    and previous.source_actor_id == source_actor_id):
+                return
+            self._unlink(previous)
+
+        effect = ScheduledStatusEffect(actor_id, index, effect_id, param, source_actor_id, expiry)
+        self._effects[key] = effect
+        self._by_effect_id.setdefault(effect_id, {})[key] = effect
+        self._by_actor.setdefault(actor_id, set()).add(index)
+        if expiry is not None:
+            heapq.heappush(self._heap, (expiry, next(self._sequence), effect))
+
+    def remove(self, actor_id: int, index: int):
+        effect = self._effects.get((actor_id, index))
+        if effect is not None:
+            self._unlink(effect)
+
+    def remove_actor(self, actor_id: int):
+        for index in list(self._by_actor.get(actor_id, ())):
+            self.remove(actor_id, index)
+
+    def clear(self):
+        self._effects.clear()
+        self._by_effect_id.clear()
+        self._by_actor.clear()
+        self._heap.clear()
+        self._stale = 0
+
+    def _drop(self, effect: ScheduledStatusEffect):
+        key = effect.actor_id, effect.index
+        del self._effects[key]
+        same_id = self._by_effect_id[effect.effect_id]
+        del same_id[key]
+        if not same_id:
+            del self._by_effect_id[effect.effect_id]
+        indices = self._by_actor[effect.actor_id]
+        indices.discard(effect.index)
+        if not indices:
+            del self._by_actor[effect.actor_id]
+
+    def _unlink(self, effect: ScheduledStatusEffect):
+        # Its heap entry, if any, stays behind.
+        self._drop(effect)
+        if effect.expiry is not None:
+            self._stale += 1
+            if self._stale > 64 and self._stale > len(self._heap) // 2:
+                effects = self._effects
+                self._heap = [x for x in self._heap if effects.get((x[2].actor_id, x[2].index)) is x[2]]
+                heapq.heapify(self._heap)
+                self._stale = 0
+
+    def advance(self, timestamp: datetime.datetime) -> typing.List[ScheduledStatusEffect]:
+        """Moves the clock to timestamp, and drops the effects expiring by then, telling the listeners about them."""
+        self.now = timestamp
+        heap = self._heap
+        if not heap or heap[0][0] > timestamp:
+            return []
+
+        expired = []
+        while heap and heap[0][0] <= timestamp:
+            _, _, effect = heapq.heappop(heap)
+            if self._effects.get((effect.actor_id, effect.index)) is not effect:
+                self._stale -= 1
+                continue
+            self._drop(effect)
+            expired.append(effect)
+
+        for effect in expired:
+            for cb in self._listeners:
+                cb(timestamp, effect)
+        return expired
+
+    def get(self, actor_id: int, index: int) -> typing.Optional[ScheduledStatusEffect]:
+        return self._effects.get((actor_id, index))
+
+    def of_actor(self, actor_id: int) -> typing.List[ScheduledStatusEffect]:
+        return [self._effects[actor_id, index] for index in sorted(self._by_actor.get(actor_id, ()))]
+
+    def by_effect_id(self, effect_id: int) -> typing.List[ScheduledStatusEffect]:
+        return list(self._by_effect_id.get(effect_id, {}).values())
+
+    def active(self, timestamp: typing.Optional[datetime.datetime] = None,
+               actor_ids: typing.Optional[typing.Iterable[int]] = None,
+               effect_id: typing.Optional[int] = None) -> typing.List[ScheduledStatusEffect]:
+        """Effects still going at timestamp (default: now), which should not be before the clock; optionally only
+        those on actor_ids, or with effect_id."""
+        if effect_id is not None:
+            candidates = self._by_effect_id.get(effect_id, {}).values()
+            if actor_ids is not None:
+                actor_ids = set(actor_ids)
+                candidates = [x for x in candidates if x.actor_id in actor_ids]
+        elif actor_ids is not None:
+            candidates = [x for actor_id in actor_ids for x in self.of_actor(actor_id)]
+        else:
+            candidates = self._effects.values()
+        if timestamp is None:
+            return list(candidates)
+        return [x for x in candidates if x.active_at(timestamp)]
+
+    def expiring_before(self, timestamp: datetime.datetime) -> typing.List[ScheduledStatusEffect]:
+        """Effects expiring before timestamp, soonest first. Only walks the part of the heap that is due by then."""
+        heap = self._heap
+        result = []
+        pending = [0] if heap else []
+        while pending:
+            i = pending.pop()
+            expiry, sequence, effect = heap[i]
+            if expiry >= timestamp:
+                continue
+            if self._effects.get((effect.actor_id, effect.index)) is effect:
+                result.append((expiry, sequence, effect))
+            pending.extend(x for x in (2 * i + 1, 2 * i + 2) if x < len(heap))
+        result.sort()
+        return [effect for _, _, effect in result]
+
+    def expiring_within(self, seconds: float) -> typing.List[ScheduledStatusEffect]:
+        if self.now is None:
+            return []
+        return self.expiring_before(self.now + datetime.timedelta(seconds=seconds))
+
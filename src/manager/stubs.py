@@ -3,12 +3,11 @@ import ctypes
 import inspect
 import typing
 
-import itertools
-
+from manager.events import EventBus
+from manager.metrics import DispatchMetrics
+from manager.registry import get_registry
 from pyxivdata.installation.resource_reader import GameResourceReader
-from pyxivdata.network import server_ipc, client_ipc
 from pyxivdata.network.client_ipc.opcodes import ClientIpcOpcodes
-from pyxivdata.network.common import IpcStructure
 from pyxivdata.network.packet import PacketHeader, MessageHeader, IpcMessageHeader
 from pyxivdata.network.server_ipc import IpcActorControlStub
 from pyxivdata.network.server_ipc.actor_control import ActorControlBase
@@ -25,32 +24,14 @@ IpcCallbackType = typing.Callable[[PacketHeader, IpcMessageHeader, any], typing.
 ActorControlCallbackType = typing.Callable[[PacketHeader, IpcMessageHeader, any], typing.NoReturn]
 
 TYPE2_MAP_TYPE = typing.Dict[typing.Optional[int], typing.List[typing.Tuple[IpcCallbackType, SupportedIpcDataTypes]]]
-
-
-def _feed(bundle_header: PacketHeader, data: bytearray, type2_map: TYPE2_MAP_TYPE):
-    if MessageHeader.from_buffer(data).type != MessageHeader.TYPE_IPC:
-        return
-
-    header = IpcMessageHeader.from_buffer(data)
-    if header.type1 != IpcMessageHeader.TYPE1_IPC:
-        return
-
-    if header.type2 not in type2_map:
-        return
-
-    data_type: SupportedIpcDataTypes
-    for cb, data_type in itertools.chain(type2_map.get(header.type2), type2_map.get(None, ())):
-        if data_type is None:
-            cb(bundle_header, header, data[ctypes.sizeof(header):header.size])
-        else:
-            cb(bundle_header, header, data_type.from_buffer(data[ctypes.sizeof(header):header.size]))
+ACTOR_CONTROL_MAP_TYPE = typing.Dict[int, typing.List[typing.Tuple[ActorControlCallbackType,
+                                                                   typing.Type[ActorControlBase]]]]
 
 
 class IpcFeedTarget:
     __client_type2_map: TYPE2_MAP_TYPE
     __server_type2_map: TYPE2_MAP_TYPE
-    __actor_control_map: typing.Dict[int, typing.List[typing.Tuple[ActorControlCallbackType,
-                                                                   typing.Type[ActorControlBase]]]]
+    __actor_control_map: ACTOR_CONTROL_MAP_TYPE
 
     def __init__(self, resource_reader: GameResourceReader,
                  server_opcodes: ServerIpcOpcodes, client_opcodes: ClientIpcOpcodes):
@@ -59,52 +40,104 @@ class IpcFeedTarget:
         self.__client_type2_map = collections.defaultdict(list)
         self.__server_type2_map = collections.defaultdict(list)
         self.__actor_control_map = collections.defaultdict(list)
+        self._events = EventBus()
+        self.__handler_listeners: typing.List[typing.Callable[[], None]] = []
+        self.__dispatcher = None
 
-        self.__server_opcode_type_map = {
-            getattr(server_opcodes, t.OPCODE_FIELD): t
-            for t in vars(server_ipc).values()
-            if isinstance(t, type) and issubclass(t, IpcStructure) and t.OPCODE_FIELD is not None
-        }
-        self.__client_opcode_type_map = {
-            getattr(client_opcodes, t.OPCODE_FIELD): t
-            for t in vars(client_ipc).values()
-            if isinstance(t, type) and issubclass(t, IpcStructure) and t.OPCODE_FIELD is not None
-        }
+        self.__opcode_types = get_registry(server_opcodes, client_opcodes)
 
         @self._server_opcode_handler(server_opcodes.ActorControl)
         @self._server_opcode_handler(server_opcodes.ActorControlSelf)
         @self._server_opcode_handler(server_opcodes.ActorControlTarget)
         def _(bundle_header: PacketHeader, header: MessageHeader, data: IpcActorControlStub):
+            # IpcDispatcher calls the actor control handlers itself instead of this; see actor_control_dispatch.
             if data.known_type not in self.__actor_control_map:
                 return
 
+            decoded = {}
             data_type: typing.Type[ActorControlBase]
             for cb, data_type in self.__actor_control_map.get(data.known_type):
-                cb(bundle_header, header, data_type(data))
+                actor_control = decoded.get(data_type)
+                if actor_control is None:
+                    actor_control = decoded[data_type] = data_type(data)
+                cb(bundle_header, header, actor_control)
 
-    def feed_from_server(self, bundle_header: PacketHeader, data: bytearray):
+        self.__actor_control_dispatch = _
+
+    def feed_from_server(self, bundle_header: PacketHeader, data: typing.Union[bytearray, memoryview]):
         # if bundle_header.timestamp.hour == 12 \
         #         and bundle_header.timestamp.minute == 47:
         #     if b'\xca\x1b' in data:
         #         breakpoint()
-        return _feed(bundle_header, data, self.__server_type2_map)
+        return self.__own_dispatcher().feed_from_server(bundle_header, data)
+
+    def feed_from_client(self, bundle_header: PacketHeader, data: typing.Union[bytearray, memoryview]):
+        return self.__own_dispatcher().feed_from_client(bundle_header, data)
+
+    def set_metrics(self, metrics: typing.Optional[DispatchMetrics]):
+        self.__own_dispatcher().set_metrics(metrics)
+
+    def __own_dispatcher(self):
+        # Fed on its own, a target goes through the same dispatcher that Parser feeds all of them at once with.
+        if self.__dispatcher is None:
+            from manager.dispatcher import IpcDispatcher  # which imports this module
+            self.__dispatcher = IpcDispatcher(self)
+        return self.__dispatcher
+
+    def set_event_bus(self, events: EventBus):
+        self._events = events
+
+    @property
+    def events(self) -> EventBus:
+        return self._events
+
+    def server_handlers(self) -> TYPE2_MAP_TYPE:
+        return self.__server_type2_map
+
+    def client_handlers(self) -> TYPE2_MAP_TYPE:
+        return self.__client_type2_map
+
+    def actor_control_handlers(self) -> ACTOR_CONTROL_MAP_TYPE:
+        return self.__actor_control_map
+
+    @property
+    def actor_control_dispatch(self) -> IpcCallbackType:
+        # The server opcode handler that hands ActorControl* messages over to the actor control handlers.
+        return self.__actor_control_dispatch
+
+    def add_handler_listener(self, cb: typing.Callable[[], None]):
+        # Called whenever a handler is registered, so that anything built out of the handler maps can be rebuilt.
+        self.__handler_listeners.append(cb)
+
+    def __on_handlers_changed(self):
+        for cb in self.__handler_listeners:
+            cb()
+
+    def begin_bundle(self, bundle_header: PacketHeader):
+        # Called once per bundle before any of its messages, whether or not this target handles any of them.
+        pass
+
+    def export_state(self) -> typing.Dict[str, typing.Any]:
+        # Whatever the handlers keep between messages, as JSON serializable values; see checkpoint.py.
+        return {}
 
-    def feed_from_client(self, bundle_header: PacketHeader, data: bytearray):
-        return _feed(bundle_header, data, self.__client_type2_map)
+    def import_state(self, state: typing.Dict[str, typing.Any]):
+        pass
 
     def _opcode_handler(self, direction: bool, *opcodes: int):
         def wrapper(cb: IpcCallbackType):
             if opcodes:
                 for opcode in opcodes:
                     if direction:
-                        self.__server_type2_map[opcode].append((cb, self.__server_opcode_type_map.get(opcode, None)))
+                        self.__server_type2_map[opcode].append((cb, self.__opcode_types.server_type(opcode)))
                     else:
-                        self.__client_type2_map[opcode].append((cb, self.__client_opcode_type_map.get(opcode, None)))
+                        self.__client_type2_map[opcode].append((cb, self.__opcode_types.client_type(opcode)))
             else:
                 if direction:
                     self.__server_type2_map[None].append((cb, None))
                 else:
                     self.__client_type2_map[None].append((cb, None))
+            self.__on_handlers_changed()
             return cb
 
         return wrapper
@@ -124,6 +157,7 @@ class IpcFeedTarget:
             if type_ is None:
                 type_ = list(inspect.signature(cb).parameters.values())[2].annotation
             self.__actor_control_map[type_.TYPE].append((cb, type_))
+            self.__on_handlers_changed()
             return cb
 
         if callable(type_):
@@ -0,0 +1,336 @@
+import dataclasses
+import datetime
+import ipaddress
+import struct
+import time
+import typing
+
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAPNG_BLOCK_SHB = 0x0A0D0D0A
+PCAPNG_BLOCK_IDB = 0x00000001
+PCAPNG_BLOCK_PB = 0x00000002
+PCAPNG_BLOCK_SPB = 0x00000003
+PCAPNG_BLOCK_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_IF_TSRESOL = 9
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+LINKTYPE_RAW_ALIASES = (12, 14)  # DLT_RAW on some BSDs / OpenBSD
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_TCP = 6
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+
+class CaptureFormatError(ValueError):
+    pass
+
+
+@dataclasses.dataclass
+class TcpFrame:
+    timestamp: datetime.datetime
+    src: ipaddress.IPv4Address
+    srcport: int
+    dst: ipaddress.IPv4Address
+    dstport: int
+    seq: int
+    nxtseq: int
+    flags: int
+    payload: bytes
+    truncated: bool = False  # the capture holds less of the payload than was sent; nxtseq still counts all of it
+
+
+def _ipv4_offset(linktype: int, data: bytes) -> typing.Optional[int]:
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None
+        offset = 12
+        ethertype, = struct.unpack_from(">H", data, offset)
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            if len(data) < offset + 2:
+                return None
+            ethertype, = struct.unpack_from(">H", data, offset)
+        return offset + 2 if ethertype == ETHERTYPE_IPV4 else None
+
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4) or linktype in LINKTYPE_RAW_ALIASES:
+        return 0 if data[:1] and data[0] >> 4 == 4 else None
+
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if len(data) < 4:
+            return None
+        # AF_INET is 2 everywhere; the family is in host byte order for NULL and network byte order for LOOP.
+        return 4 if data[0:4] in (b"\x02\x00\x00\x00", b"\x00\x00\x00\x02") else None
+
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None
+        return 16 if struct.unpack_from(">H", data, 14)[0] == ETHERTYPE_IPV4 else None
+
+    if linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return None
+        return 20 if struct.unpack_from(">H", data, 0)[0] == ETHERTYPE_IPV4 else None
+
+    return None
+
+
+# linktype, timestamp in ticks, ticks per second, and the captured bytes of a frame, as stored in the capture
+CaptureRecord = typing.Tuple[int, int, int, bytes]
+
+
+def ticks_to_datetime(ticks: int, ticks_per_second: int) -> datetime.datetime:
+    seconds, remainder = divmod(ticks, ticks_per_second)
+    return (datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+            + datetime.timedelta(microseconds=remainder * 1_000_000 // ticks_per_second))
+
+
+def _tcp_offsets(linktype: int, data: bytes) -> typing.Optional[typing.Tuple[int, int, int]]:
+    # IP header offset, TCP header offset, and IP total length, of a whole or first fragment TCP over IPv4 frame.
+    ip = _ipv4_offset(linktype, data)
+    if ip is None or len(data) < ip + 20:
+        return None
+
+    version_ihl, total_length, fragment, protocol = data[ip], *struct.unpack_from(">H2xH1xB", data, ip + 2)
+    if version_ihl >> 4 != 4 or protocol != IPPROTO_TCP:
+        return None
+    if fragment & 0x3FFF:  # more fragments, or not the first fragment
+        return None
+
+    tcp = ip + (version_ihl & 0xF) * 4
+    if len(data) < tcp + 20:
+        return None
+    return ip, tcp, total_length
+
+
+def tcp_endpoints(linktype: int, data: bytes) -> typing.Optional[typing.Tuple[bytes, bytes, int]]:
+    """Source and destination as address and port bytes, and TCP flags, of the frames decode_tcp_frame takes, without
+    decoding the rest. The bytes compare the same way as (IPv4Address, port) tuples do."""
+    offsets = _tcp_offsets(linktype, data)
+    if offsets is None:
+        return None
+    ip, tcp, _ = offsets
+    return data[ip + 12:ip + 16] + data[tcp:tcp + 2], data[ip + 16:ip + 20] + data[tcp + 2:tcp + 4], data[tcp + 13]
+
+
+def decode_tcp_frame(linktype: int, timestamp: datetime.datetime, data: bytes) -> typing.Optional[TcpFrame]:
+    offsets = _tcp_offsets(linktype, data)
+    if offsets is None:
+        return None
+    ip, tcp, total_length = offsets
+    srcport, dstport, seq, data_offset, flags = struct.unpack_from(">HHI4xBB", data, tcp)
+    payload_offset = tcp + (data_offset >> 4) * 4
+
+    # Trust the IP header for the segment length (snap length may cut the captured payload short, and Ethernet
+    # frames may carry trailing padding), but never read past what was actually captured. Segments offloaded to the NIC
+    # (TSO/LSO) are captured before it fills in the total length, and leave it at 0; all that was captured is theirs.
+    captured_length = max(0, len(data) - payload_offset)
+    if total_length == 0:
+        payload_length = captured_length
+    else:
+        payload_length = max(0, ip + total_length - payload_offset)
+    payload = data[payload_offset:payload_offset + payload_length]
+
+    nxtseq = seq + payload_length
+    if flags & TCP_SYN:
+        nxtseq += 1
+    if flags & TCP_FIN:
+        nxtseq += 1
+
+    return TcpFrame(
+        timestamp=timestamp,
+        src=ipaddress.IPv4Address(data[ip + 12:ip + 16]),
+        srcport=srcport,
+        dst=ipaddress.IPv4Address(data[ip + 16:ip + 20]),
+        dstport=dstport,
+        seq=seq,
+        nxtseq=nxtseq & 0xFFFFFFFF,
+        flags=flags,
+        payload=payload,
+        truncated=captured_length < payload_length,
+    )
+
+
+class CaptureReader:
+    """Streams TCP over IPv4 frames out of a pcap or pcapng file without going through tshark."""
+
+    STATE_FIELDS = ("offset", "_header_read", "_endian", "_pcapng", "_linktype", "_ts_divisor", "_interfaces")
+
+    def __init__(self, fp: typing.BinaryIO, follow: bool = False, poll_interval: float = 0.5,
+                 on_idle: typing.Optional[typing.Callable[[], None]] = None,
+                 state: typing.Optional[typing.Dict[str, typing.Any]] = None):
+        self._fp = fp
+        self._follow = follow and fp.seekable()  # pipes already block until the writer produces more
+        self._poll_interval = poll_interval
+        self._on_idle = on_idle
+        self._endian = "<"
+        self._pcapng = False
+        self._linktype = LINKTYPE_ETHERNET
+        self._ts_divisor = 1_000_000
+        self._interfaces: typing.List[typing.Tuple[int, int]] = []  # (linktype, ticks per second)
+        self._header_read = False
+
+        # Position right after the last fully read block; resuming from here never splits a block.
+        self.offset = 0
+
+        if state is not None:
+            for k in self.STATE_FIELDS:
+                setattr(self, k, state[k])
+            self._interfaces = list(self._interfaces)
+            self._fp.seek(self.offset)
+
+    def state(self) -> typing.Dict[str, typing.Any]:
+        return {k: getattr(self, k) for k in self.STATE_FIELDS}
+
+    def _read(self, size: int) -> bytes:
+        data = self._fp.read(size)
+        while len(data) != size:
+            if self._follow:
+                # The writer has not caught up yet; wait for the rest instead of treating it as the end.
+                # state() still points at the start of this block (or of the file header), so on_idle may stop here.
+                if self._on_idle is not None:
+                    self._on_idle()
+                time.sleep(self._poll_interval)
+                data += self._fp.read(size - len(data))
+                continue
+
+            if data:
+                raise CaptureFormatError("Unexpected end of capture file")
+            raise EOFError
+        return data
+
+    def _read_file_header(self):
+        magic = self._read(4)
+        if struct.unpack("<I", magic)[0] == PCAPNG_BLOCK_SHB:
+            self._pcapng = True
+            self._read_section_header()
+            return
+
+        for endian in "<>":
+            magic_value, = struct.unpack(f"{endian}I", magic)
+            if magic_value in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise CaptureFormatError(f"Not a pcap or pcapng file (magic {magic.hex()})")
+
+        self._endian = endian
+        self._ts_divisor = 1_000_000 if magic_value == PCAP_MAGIC_USEC else 1_000_000_000
+        _, _, _, _, _, linktype = struct.unpack(f"{endian}HHiIII", self._read(20))
+        # Upper bits carry FCS information in some writers.
+        self._linktype = linktype & 0x0FFFFFFF
+        self.offset += 24
+        self._header_read = True
+
+    def _read_section_header(self):
+        length_bytes = self._read(4)
+        byte_order_magic = self._read(4)
+        if struct.unpack("<I", byte_order_magic)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+            self._endian = "<"
+        elif struct.unpack(">I", byte_order_magic)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+            self._endian = ">"
+        else:
+            raise CaptureFormatError("Invalid pcapng byte order magic")
+        length, = struct.unpack(f"{self._endian}I", length_bytes)
+        self._read(length - 12)
+        self._interfaces = []
+        self.offset += length
+        self._header_read = True
+
+    def _parse_interface(self, body: bytes):
+        linktype, _, _ = struct.unpack_from(f"{self._endian}HHI", body)
+        ticks_per_second = 1_000_000
+        ptr = 8
+        while ptr + 4 <= len(body):
+            code, length = struct.unpack_from(f"{self._endian}HH", body, ptr)
+            if code == 0:
+                break
+            if code == PCAPNG_OPTION_IF_TSRESOL and length >= 1:
+                resolution = body[ptr + 4]
+                if resolution & 0x80:
+                    ticks_per_second = 2 ** (resolution & 0x7F)
+                else:
+                    ticks_per_second = 10 ** resolution
+            ptr += 4 + (length + 3) // 4 * 4
+        self._interfaces.append((linktype, ticks_per_second))
+
+    def _iter_pcap_records(self) -> typing.Iterator[CaptureRecord]:
+        header = struct.Struct(f"{self._endian}IIII")
+        while True:
+            try:
+                seconds, fraction, captured_length, _ = header.unpack(self._read(header.size))
+            except EOFError:
+                return
+            data = self._read(captured_length)
+            self.offset += header.size + captured_length
+            yield self._linktype, seconds * self._ts_divisor + fraction, self._ts_divisor, data
+
+    def _iter_pcapng_records(self) -> typing.Iterator[CaptureRecord]:
+        while True:
+            try:
+                block_type_bytes = self._read(4)
+            except EOFError:
+                return
+
+            if struct.unpack("<I", block_type_bytes)[0] == PCAPNG_BLOCK_SHB:
+                self._read_section_header()
+                continue
+
+            block_type, length = struct.unpack(f"{self._endian}II", block_type_bytes + self._read(4))
+            if length < 12:
+                raise CaptureFormatError(f"Invalid pcapng block length {length}")
+            body = self._read(length - 12)
+            self._read(4)  # trailing block length
+            self.offset += length
+
+            if block_type == PCAPNG_BLOCK_IDB:
+                self._parse_interface(body)
+
+            elif block_type == PCAPNG_BLOCK_EPB:
+                interface_id, ts_high, ts_low, captured_length, _ = struct.unpack_from(f"{self._endian}IIIII", body)
+                linktype, ticks_per_second = self._interfaces[interface_id]
+                yield linktype, (ts_high << 32) | ts_low, ticks_per_second, body[20:20 + captured_length]
+
+            elif block_type == PCAPNG_BLOCK_PB:
+                interface_id, _, ts_high, ts_low, captured_length, _ = struct.unpack_from(
+                    f"{self._endian}HHIIII", body)
+                linktype, ticks_per_second = self._interfaces[interface_id]
+                yield linktype, (ts_high << 32) | ts_low, ticks_per_second, body[20:20 + captured_length]
+
+            elif block_type == PCAPNG_BLOCK_SPB:
+                # Simple packet blocks carry no timestamp and no captured length; the body is padded to 4 bytes.
+                linktype, _ = self._interfaces[0]
+                original_length, = struct.unpack_from(f"{self._endian}I", body)
+                yield linktype, 0, 1, body[4:4 + original_length]
+
+    def records(self) -> typing.Iterator[CaptureRecord]:
+        """Every frame as stored in the capture, undecoded."""
+        if not self._header_read:
+            try:
+                self._read_file_header()
+            except EOFError:
+                return
+
+        yield from self._iter_pcapng_records() if self._pcapng else self._iter_pcap_records()
+
+    def __iter__(self) -> typing.Iterator[TcpFrame]:
+        for linktype, ticks, ticks_per_second, data in self.records():
+            frame = decode_tcp_frame(linktype, ticks_to_datetime(ticks, ticks_per_second), data)
+            if frame is not None:
+                yield frame
+
+
+def iter_tcp_frames(fp: typing.BinaryIO) -> typing.Iterator[TcpFrame]:
+    yield from CaptureReader(fp)
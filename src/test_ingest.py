@@ -0,0 +1,68 @@
+import asyncio
+import contextlib
+import ctypes
+import io
+import unittest
+
+from bundle import BUNDLE_HEADER_SIZE
+from ingest import IngestService
+from logfile import RECORD_HEADER, DIRECTION_FROM_SERVER
+from manager.events import EventBus
+from pyxivdata.network.packet import PacketHeader, MessageHeader, IpcMessageHeader
+
+
+class _FailingParser:
+    """Stands in for Parser, with a server message handler that always raises."""
+
+    def __init__(self):
+        self.events = EventBus()
+        self.fed = 0
+
+    def feed_from_server(self, bundle_header: PacketHeader, data: memoryview):
+        self.fed += 1
+        raise RuntimeError("handler failed")
+
+
+def _bundle_with_one_message() -> bytes:
+    message = IpcMessageHeader()
+    message.size = ctypes.sizeof(IpcMessageHeader)
+    message.type = MessageHeader.TYPE_IPC
+    header = bytearray(BUNDLE_HEADER_SIZE)
+    header[:len(PacketHeader.SIGNATURE_1)] = PacketHeader.SIGNATURE_1
+    return bytes(header) + bytes(message)
+
+
+class IngestSessionTest(unittest.TestCase):
+    def test_handler_error_closes_the_connection(self):
+        parsers = []
+
+        def parser_factory():
+            parsers.append(_FailingParser())
+            return parsers[-1]
+
+        async def run():
+            service = IngestService(parser_factory)
+            server = await service.serve_tcp("127.0.0.1", 0)
+            async with server:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                bundle = _bundle_with_one_message()
+                for _ in range(3):
+                    writer.write(RECORD_HEADER.pack(DIRECTION_FROM_SERVER, len(bundle)) + bundle)
+                await writer.drain()
+
+                # The server hangs up instead of leaving the stream stalled.
+                self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+                writer.close()
+                await asyncio.wait_for(service.wait_idle(), 5)
+                self.assertFalse(service.sessions)
+
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            asyncio.run(run())
+        self.assertEqual([x.fed for x in parsers], [1])
+        self.assertIn("RuntimeError: handler failed", stderr.getvalue())
+        self.assertIn("127.0.0.1", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()